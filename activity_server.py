@@ -1,42 +1,48 @@
-import socket
-
-# database of activities
+import argparse
 import sys
 
-activities = []
-
-# HTTP response template
-response_template = """\
-HTTP/1.1 200 OK
-Content-Type: text/html
+import bulk
+import journal
+import metrics
+import response
+import routing
+import serving
+import store
+import upstream
 
-<html>
-  <body>
-    {message}
-  </body>
-</html>
-"""
+# database of activities
+activities = store.ActivityRegistry()
+# reservation servers to tell about added and removed activities, set with --notify
+subscribers = []
+# request statistics, served on /metrics
+server_metrics = metrics.Metrics("activity")
 
 
 def add_activity(name):
     # add activity to database if it doesn't already exist
-    if name not in activities:
-        activities.append(name)
-        with open("activities.txt", "a") as f:
-            f.write(name + "\n")
-        return True
-    return False
+    if not activities.add(name):
+        return False
+    notify_subscribers(name)
+    return True
 
 
 def remove_activity(name):
     # remove activity from database if it exists
-    if name in activities:
-        activities.remove(name)
-        with open("activities.txt", "w") as f:
-            for activity in activities:
-                f.write(activity + "\n")
-        return True
-    return False
+    if not activities.remove(name):
+        return False
+    notify_subscribers(name)
+    return True
+
+
+def notify_subscribers(name=None):
+    # tell the reservation servers to drop the activity, or every activity, from their caches
+    # a subscriber that cannot be reached catches up when its cache entry expires
+    params = {"name": name} if name is not None else {}
+    for subscriber in subscribers:
+        try:
+            subscriber.post("/activitychanged", "", **params)
+        except upstream.UpstreamError:
+            pass
 
 
 def check_activity(name):
@@ -44,42 +50,55 @@ def check_activity(name):
     return name in activities
 
 
-def handle_request(request):
-    # parse request and call appropriate function
-    request_lines = request.split("\n")
-    request_line = request_lines[0]
-    parts = request_line.split(" ")
-    if len(parts) != 3:
-        return "HTTP/1.1 400 Bad Request\n\nInvalid request."
-    request_type, request_url, _ = parts
-    request_params = {}
-    if "?" in request_url:
-        for param in request_url.split("?")[1].split("&"):
-            key, value = param.split("=")
-            request_params[key] = value
-    if request_type == "GET":
-        if request_url.startswith("/add"):
-            success = add_activity(request_params["name"])
-            if success:
-                message = f"Activity {request_params['name']} added."
-            else:
-                message = f"Activity {request_params['name']} already exists."
-            return response_template.format(message=message)
-        elif request_url.startswith("/remove"):
-            success = remove_activity(request_params["name"])
-            if success:
-                message = f"Activity {request_params['name']} removed."
-            else:
-                message = f"Activity {request_params['name']} does not exist."
-            return response_template.format(message=message)
-        elif request_url.startswith("/check"):
-            exists = check_activity(request_params["name"])
-            if exists:
-                message = f"Activity {request_params['name']} exists."
-                return response_template.format(message=message)
-            else:
-                return "HTTP/1.1 404 Not Found\n\nActivity does not exist."
-    return "HTTP/1.1 400 Bad Request\n\nInvalid request."
+def add_activity_request(name):
+    if add_activity(name):
+        return "200 OK", f"Activity {name} added."
+    return "200 OK", f"Activity {name} already exists."
+
+
+def remove_activity_request(name):
+    if remove_activity(name):
+        return "200 OK", f"Activity {name} removed."
+    return "200 OK", f"Activity {name} does not exist."
+
+
+def check_activity_request(name):
+    if check_activity(name):
+        return "200 OK", f"Activity {name} exists."
+    return "404 Not Found", "Activity does not exist."
+
+
+def search_activities(prefix="", contains="", limit=store.DEFAULT_SEARCH):
+    # activity names starting with prefix and containing contains, for autocompletion
+    names = activities.search(prefix, contains, limit)
+    if not names:
+        return response.html("200 OK", "No activities match.", {"activities": names})
+    return response.html("200 OK", f"Activities: {', '.join(names)}", {"activities": names})
+
+
+def import_activities(request, format):
+    # body: JSON lines of {"activity"} objects or CSV with an activity column
+    answer = bulk.load_activities(activities, request.body, format)
+    # one invalidation of the whole cache instead of one per activity
+    notify_subscribers()
+    return answer
+
+
+def export_activities(format):
+    return bulk.dump_activities(activities, format)
+
+
+handle_request = routing.Router()
+handle_request.add("GET", "/add", add_activity_request, name=routing.text())
+handle_request.add("GET", "/remove", remove_activity_request, name=routing.text())
+handle_request.add("GET", "/check", check_activity_request, name=routing.text())
+handle_request.add("GET", "/search", search_activities, prefix=routing.text(required=False, default=""),
+                   contains=routing.text(required=False, default=""),
+                   limit=routing.integer(1, store.MAX_SEARCH, required=False, default=store.DEFAULT_SEARCH))
+handle_request.add("POST", "/import", import_activities, with_request=True,
+                   format=routing.choice(bulk.FORMATS, default="jsonl"))
+handle_request.add("GET", "/export", export_activities, format=routing.choice(bulk.FORMATS, default="jsonl"))
+server_metrics.add_routes(handle_request.paths())
 
 
 def main():
@@ -87,17 +106,17 @@ def main():
         print("Please specify a port number as an argument.")
         return
     port = int(sys.argv[1])
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.bind(("localhost", port))
-    sock.listen(1)
-    print(f"Listening on port {port}...")
-    while True:
-        conn, addr = sock.accept()
-        request = conn.recv(1024).decode("utf-8")
-        print(request)
-        response = handle_request(request)
-        conn.sendall(response.encode("utf-8"))
-        conn.close()
+    parser = argparse.ArgumentParser()
+    serving.add_arguments(parser)
+    journal.add_arguments(parser)
+    metrics.add_arguments(parser)
+    parser.add_argument("--notify", type=upstream.parse_addresses, default=[],
+                        help="comma separated host:port of the reservation servers to notify of changes")
+    args = parser.parse_args(sys.argv[2:])
+    subscribers[:] = [upstream.UpstreamPool(address, timeout=1, metrics=server_metrics) for address in args.notify]
+    metrics.configure_from_args(args)
+    activities.open_journal(args.data_dir, args.snapshot_every)
+    serving.serve(port, handle_request, metrics=server_metrics, **serving.options_from_args(args))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,41 @@
+import feed
+import schedule
+
+
+def free_times(layout, booked):
+    # start times of the free slots of a day's booked mask
+    return [layout.slot_time(slot) for slot in schedule.open_slots(layout, booked)]
+
+
+def room_event(layout, name, days, event_id=None):
+    # the free times of every day of a room
+    return feed.event("room", {"room": name, "days": {day + 1: free_times(layout, booked)
+                                                      for day, booked in enumerate(days)}}, event_id)
+
+
+def stream(rooms, names=None, since=None):
+    # EventStream of the availability changes of a RoomStore, of the rooms in names or of every room
+    #
+    # a "room" event gives the free times of every day of a room that was added (or of every room
+    # at the start), "day" the free times of one day that changed and "removed" a room that is
+    # gone. Each event has the id to resume from with Last-Event-ID or since.
+    layout = rooms.layout
+
+    def render(change, event_id):
+        name = change[1]
+        if names is not None and name not in names:
+            return None
+        if change[0] == "add":
+            return room_event(layout, name, [0] * layout.days, event_id)
+        if change[0] == "remove":
+            return feed.event("removed", {"room": name}, event_id)
+        return feed.event("day", {"room": name, "day": change[2] + 1, "free": free_times(layout, change[3])},
+                          event_id)
+
+    def snapshot():
+        for name in sorted(rooms.names() if names is None else names):
+            days = rooms.state(name)
+            if days is not None:
+                yield room_event(layout, name, days)
+
+    return feed.stream(rooms.feed, render, snapshot, since)
@@ -0,0 +1,270 @@
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import upstream
+
+RESERVATION_PORT = 8080
+ROOM_PORT = 8081
+ACTIVITY_PORT = 8082
+
+DEFAULT_MIX = "reserve=4,checkavailability=3,display=2,listavailability=1"
+
+# which server each operation is sent to
+OPERATIONS = {
+    "add": "room",
+    "remove": "room",
+    "checkavailability": "room",
+    "reserve": "reservation",
+    "listavailability": "reservation",
+    "search": "reservation",
+    "display": "reservation",
+}
+
+
+def parse_mix(mix):
+    # parse "reserve=4,display=1" into a list of (operation, weight)
+    weights = []
+    for part in mix.split(","):
+        operation, _, weight = part.partition("=")
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {operation}")
+        weights.append((operation, float(weight or 1)))
+    return weights
+
+
+def start_servers(target, data_dir, server_args):
+    # start the servers of a target in subprocesses, returns the processes
+    here = os.path.dirname(os.path.abspath(__file__))
+    common = ["--data-dir", data_dir] + server_args
+    if target == "multithread":
+        commands = [[sys.executable, os.path.join(here, "multiThread.py")] + common]
+    else:
+        commands = [
+            [sys.executable, os.path.join(here, "room_server.py"), str(ROOM_PORT)] + common,
+            [sys.executable, os.path.join(here, "activity_server.py"), str(ACTIVITY_PORT),
+             "--notify", f"localhost:{RESERVATION_PORT}"] + common,
+            [sys.executable, os.path.join(here, "reservation_server.py"), str(RESERVATION_PORT)] + common,
+        ]
+    processes = [subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                 for command in commands]
+    for port in (RESERVATION_PORT, ROOM_PORT, ACTIVITY_PORT):
+        wait_for_port(port)
+    return processes
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("localhost", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def percentile(ordered, fraction):
+    # nearest-rank percentile of a sorted list
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Benchmark:
+    # replays a weighted mix of requests against running servers from many threads
+
+    def __init__(self, args):
+        self.args = args
+        self.mix = args.mix
+        # no circuit breaker, failing requests are part of what is measured
+        self.servers = {
+            "reservation": upstream.UpstreamPool(("localhost", RESERVATION_PORT), size=args.concurrency,
+                                                 breaker_failures=0),
+            "room": upstream.UpstreamPool(("localhost", ROOM_PORT), size=args.concurrency, breaker_failures=0),
+            "activity": upstream.UpstreamPool(("localhost", ACTIVITY_PORT), size=args.concurrency,
+                                              breaker_failures=0),
+        }
+        self.rooms = [f"bench-room-{i}" for i in range(args.rooms)]
+        self.activities = [f"bench-activity-{i}" for i in range(args.activities)]
+        # rooms added by the "add" operation that "remove" can take away again
+        self.added = []
+        self.added_lock = threading.Lock()
+        self.next_room = 0
+        # latencies in seconds and error counts per operation
+        self.latencies = {operation: [] for operation, _ in self.mix}
+        self.errors = {operation: 0 for operation, _ in self.mix}
+
+    def seed(self):
+        for room in self.rooms:
+            self.servers["room"].get("/add", name=room)
+        for activity in self.activities:
+            self.servers["activity"].get("/add", name=activity)
+        # a first round of reservations gives display something to show
+        for i in range(self.args.rooms):
+            self.call("reserve")
+
+    def request(self, operation):
+        # return (server, path parameters) for one random request of an operation
+        room = random.choice(self.rooms)
+        day = random.randint(1, 7)
+        if operation == "add":
+            with self.added_lock:
+                self.next_room += 1
+                name = f"bench-extra-{self.next_room}"
+                self.added.append(name)
+            return "/add", {"name": name}
+        if operation == "remove":
+            with self.added_lock:
+                name = self.added.pop() if self.added else "bench-extra-missing"
+            return "/remove", {"name": name}
+        if operation == "checkavailability":
+            return "/checkavailability", {"name": room, "day": day}
+        if operation == "reserve":
+            return "/reserve", {"room": room, "activity": random.choice(self.activities), "day": day,
+                                "hour": random.randint(9, 17), "duration": 1}
+        if operation == "listavailability":
+            return "/listavailability", {"room": room, "day": day}
+        if operation == "search":
+            return "/search", {"day": day, "hour": random.randint(9, 16), "duration": 1}
+        return "/display", {"id": random.randint(1, self.args.rooms)}
+
+    def call(self, operation):
+        path, params = self.request(operation)
+        status, _ = self.servers[OPERATIONS[operation]].get(path, **params)
+        return status
+
+    def worker(self, deadline, remaining):
+        operations = [operation for operation, _ in self.mix]
+        weights = [weight for _, weight in self.mix]
+        latencies = {operation: [] for operation in operations}
+        errors = dict.fromkeys(operations, 0)
+        while time.monotonic() < deadline:
+            with self.added_lock:
+                if remaining[0] == 0:
+                    break
+                remaining[0] -= 1
+            operation = random.choices(operations, weights)[0]
+            start = time.perf_counter()
+            try:
+                status = self.call(operation)
+            except upstream.UpstreamError:
+                status = None
+            latencies[operation].append(time.perf_counter() - start)
+            # 4xx answers such as a taken slot are normal outcomes, only count failures
+            if status is None or status >= 500:
+                errors[operation] += 1
+        with self.added_lock:
+            for operation in operations:
+                self.latencies[operation].extend(latencies[operation])
+                self.errors[operation] += errors[operation]
+
+    def run(self):
+        # run the configured number of requests or until the duration is over, returns the results
+        deadline = time.monotonic() + (self.args.duration or float("inf"))
+        remaining = [self.args.requests if not self.args.duration else -1]
+        threads = [threading.Thread(target=self.worker, args=(deadline, remaining))
+                   for _ in range(self.args.concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        operations = {}
+        total = 0
+        every = []
+        for operation, latencies in self.latencies.items():
+            latencies.sort()
+            total += len(latencies)
+            every.extend(latencies)
+            operations[operation] = summary(latencies, self.errors[operation], elapsed)
+        every.sort()
+        overall = summary(every, sum(self.errors.values()), elapsed)
+        return {"elapsed": elapsed, "requests": total, "overall": overall, "operations": operations}
+
+
+def summary(latencies, errors, elapsed):
+    # throughput and latency percentiles in milliseconds
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed if elapsed else 0,
+        "p50": milliseconds(percentile(latencies, 0.50)),
+        "p95": milliseconds(percentile(latencies, 0.95)),
+        "p99": milliseconds(percentile(latencies, 0.99)),
+    }
+
+
+def milliseconds(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_report(results):
+    print(f"{'operation':<20}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    rows = list(results["operations"].items()) + [("overall", results["overall"])]
+    for operation, row in rows:
+        print(f"{operation:<20}{row['requests']:>10}{row['errors']:>8}{row['throughput']:>10.0f}"
+              f"{row['p50'] or 0:>10.2f}{row['p95'] or 0:>10.2f}{row['p99'] or 0:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the room reservation servers.")
+    parser.add_argument("--target", choices=("multithread", "standalone", "running"), default="multithread",
+                        help="servers to start, or 'running' to use servers that are already up")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"weighted request mix, operations: {', '.join(OPERATIONS)}")
+    parser.add_argument("--concurrency", type=int, default=16, help="number of concurrent clients")
+    parser.add_argument("--requests", type=int, default=10000, help="number of requests to send")
+    parser.add_argument("--duration", type=float, default=0, help="run for this many seconds instead")
+    parser.add_argument("--rooms", type=int, default=100, help="number of rooms to seed")
+    parser.add_argument("--activities", type=int, default=10, help="number of activities to seed")
+    parser.add_argument("--server-args", default="", help="extra arguments for the started servers")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    processes = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        try:
+            if args.target != "running":
+                processes = start_servers(args.target, data_dir, args.server_args.split())
+            benchmark = Benchmark(args)
+            benchmark.seed()
+            results = benchmark.run()
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait()
+
+    print_report(results)
+    if args.output:
+        config = {"target": args.target, "mix": dict(args.mix), "concurrency": args.concurrency,
+                  "requests": args.requests, "duration": args.duration, "rooms": args.rooms,
+                  "activities": args.activities, "server_args": args.server_args}
+        with open(args.output, "w") as f:
+            json.dump({"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "revision": git_revision(),
+                       "config": config, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
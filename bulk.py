@@ -0,0 +1,274 @@
+import argparse
+import csv
+import http.client
+import io
+import json
+import sys
+
+import availability
+import response
+import upstream
+
+FORMATS = ("jsonl", "csv")
+MEDIA_TYPES = {"jsonl": "application/x-ndjson", "csv": "text/csv; charset=utf-8"}
+# records stored with one journal write
+BATCH = 1000
+# errors listed in the answer to an import, the others are only counted
+MAX_ERRORS = 20
+# bytes of a file the command line sends with one request, below the servers' body limit
+CHUNK_BYTES = 512 * 1024
+
+# what can be loaded and dumped, and the server holding it
+KINDS = {"rooms": ("localhost", 8081), "activities": ("localhost", 8082), "reservations": ("localhost", 8080)}
+
+
+class BulkError(Exception):
+    pass
+
+
+def records(body, format):
+    # (line number, dict) for every record of a JSON-lines or CSV body, read a line at a time
+    # a line that is not a record gives (line number, error message) instead
+    lines = io.TextIOWrapper(io.BytesIO(body), encoding="utf-8", newline="")
+    if format == "csv":
+        reader = csv.DictReader(lines)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield number, "invalid JSON"
+            continue
+        yield number, record if isinstance(record, dict) else "not a JSON object"
+
+
+def load(body, format, fields, store_batch):
+    # feed the records of an import body to store_batch(list of field tuples) BATCH at a time,
+    # which returns None for each record stored and an error message for the others;
+    # returns the JSON answer with the counts and the first errors
+    counts = {"imported": 0, "failed": 0}
+    errors = []
+    batch = []
+
+    def fail(number, error):
+        counts["failed"] += 1
+        if len(errors) < MAX_ERRORS:
+            errors.append({"line": number, "error": error})
+
+    def flush():
+        for (number, _), error in zip(batch, store_batch([values for _, values in batch])):
+            if error is None:
+                counts["imported"] += 1
+            else:
+                fail(number, error)
+        batch.clear()
+
+    try:
+        for number, record in records(body, format):
+            if isinstance(record, str):
+                fail(number, record)
+                continue
+            values = tuple(record.get(field) for field in fields)
+            if any(value is None or value == "" for value in values):
+                fail(number, f"needs {', '.join(fields)}")
+                continue
+            batch.append((number, values))
+            if len(batch) == BATCH:
+                flush()
+    except (UnicodeDecodeError, csv.Error) as error:
+        fail(None, str(error))
+    if batch:
+        flush()
+    return response.json_data("200 OK", dict(counts, errors=errors))
+
+
+class Export(response.Stream):
+    # JSON-lines or CSV dump, streamed in chunks whatever the Accept header says
+
+    __slots__ = ()
+
+    def __init__(self, produce, format):
+        super().__init__("200 OK", produce, f"Content-Type: {MEDIA_TYPES[format]}\r\n".encode())
+
+    def negotiate(self, request):
+        if request.version != "HTTP/1.1":
+            return response.Response(self.status_code, b"".join(self.produce(False)), self.content_type)
+        return self
+
+
+def export(chunks, format, header):
+    # Export of the rows of chunks(), an iterator of lists of dicts with the keys of header
+    def produce(as_json):
+        if format == "csv":
+            yield encode_csv([header])
+        for rows in chunks():
+            if format == "csv":
+                yield encode_csv([[csv_value(row[field]) for field in header] for row in rows])
+            else:
+                yield "".join(json.dumps(row, separators=(",", ":")) + "\n" for row in rows).encode()
+
+    return Export(produce, format)
+
+
+def encode_csv(rows):
+    out = io.StringIO()
+    csv.writer(out, lineterminator="\n").writerows(rows)
+    return out.getvalue().encode()
+
+
+def csv_value(value):
+    # lists, like the free hours of a day, are one space separated cell
+    return " ".join(map(str, value)) if isinstance(value, list) else value
+
+
+def chunked(items, size=BATCH):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def load_rooms(rooms, body, format):
+    # records with a room name, already existing rooms are reported as failed
+    def store(batch):
+        return [None if added else "room already exists" for added in rooms.add_many([str(name) for name, in batch])]
+
+    return load(body, format, ("room",), store)
+
+
+def dump_rooms(rooms, format):
+    # every room with the free hours of each of its days, as day1, day2, ... columns
+    layout = rooms.layout
+    header = ["room"] + [f"day{day + 1}" for day in range(layout.days)]
+
+    def chunks():
+        for names in chunked(sorted(rooms.names())):
+            rows = []
+            for name in names:
+                days = rooms.state(name)
+                if days is not None:
+                    row = {"room": name}
+                    for day, booked in enumerate(days):
+                        row[f"day{day + 1}"] = availability.free_times(layout, booked)
+                    rows.append(row)
+            yield rows
+
+    return export(chunks, format, header)
+
+
+def load_activities(activities, body, format):
+    def store(batch):
+        added = activities.add_many([str(name) for name, in batch])
+        return [None if added else "activity already exists" for added in added]
+
+    return load(body, format, ("activity",), store)
+
+
+def dump_activities(activities, format):
+    # the activities in the order they were added
+    def chunks():
+        for names in chunked(activities.ordered()):
+            yield [{"activity": name} for name in names]
+
+    return export(chunks, format, ["activity"])
+
+
+def dump_reservations(book, format):
+    # every reservation in id order, read from the book a page at a time
+    header = ["id", "room", "activity", "day", "hour", "duration"]
+
+    def chunks():
+        after = 0
+        while True:
+            found = book.page(after, BATCH)
+            if not found:
+                return
+            yield [dict(zip(header, reservation.record()[1:])) for reservation in found]
+            after = found[-1].id
+
+    return export(chunks, format, header)
+
+
+def send_file(address, path, file, format):
+    # POST a file to /import in pieces of about CHUNK_BYTES, a CSV header is repeated in every piece
+    # only one piece is in memory at a time; returns the summed counts and the errors
+    totals = {"imported": 0, "failed": 0, "errors": []}
+    header = file.readline() if format == "csv" else b""
+    lines_before = 1 if header else 0
+    while True:
+        lines = file.readlines(CHUNK_BYTES)
+        if not lines:
+            return totals
+        status, body = post(address, f"{path}?format={format}", header + b"".join(lines), format)
+        if status != 200:
+            raise BulkError(f"{address[0]}:{address[1]} answered {status}: {body.decode(errors='replace')}")
+        reply = json.loads(body)
+        totals["imported"] += reply["imported"]
+        totals["failed"] += reply["failed"]
+        for error in reply["errors"]:
+            if error["line"] is not None:
+                # line numbers of the piece, made into line numbers of the file
+                error["line"] += lines_before - (1 if header else 0)
+            totals["errors"].append(error)
+        lines_before += len(lines)
+
+
+def post(address, path, body, format):
+    connection = http.client.HTTPConnection(*address, timeout=300)
+    try:
+        connection.request("POST", path, body, {"Content-Type": MEDIA_TYPES[format]})
+        reply = connection.getresponse()
+        return reply.status, reply.read()
+    finally:
+        connection.close()
+
+
+def receive_file(address, path, output):
+    # GET an export and write it out as it arrives
+    connection = http.client.HTTPConnection(*address, timeout=300)
+    try:
+        connection.request("GET", path)
+        reply = connection.getresponse()
+        if reply.status != 200:
+            raise BulkError(f"{address[0]}:{address[1]} answered {reply.status}")
+        while True:
+            chunk = reply.read1(65536)
+            if not chunk:
+                return
+            output.write(chunk)
+    finally:
+        connection.close()
+
+
+def main():
+    # python bulk.py import rooms rooms.csv --format csv
+    # python bulk.py export reservations --output reservations.jsonl
+    parser = argparse.ArgumentParser(description="Load or dump rooms, activities and reservations in bulk.")
+    parser.add_argument("action", choices=("import", "export"))
+    parser.add_argument("kind", choices=tuple(KINDS))
+    parser.add_argument("file", nargs="?", help="file to import, standard input when missing")
+    parser.add_argument("--format", choices=FORMATS, default="jsonl")
+    parser.add_argument("--server", type=upstream.parse_address,
+                        help="host:port of the server holding them, the usual port of the kind by default")
+    parser.add_argument("--output", help="file to export to, standard output when missing")
+    args = parser.parse_args()
+    address = args.server or KINDS[args.kind]
+    try:
+        if args.action == "export":
+            output = open(args.output, "wb") if args.output else sys.stdout.buffer
+            with output:
+                receive_file(address, f"/export?format={args.format}", output)
+            return
+        with open(args.file, "rb") if args.file else sys.stdin.buffer as file:
+            totals = send_file(address, "/import", file, args.format)
+    except (OSError, BulkError) as error:
+        raise SystemExit(f"bulk {args.action} failed: {error}")
+    for error in totals["errors"][:MAX_ERRORS]:
+        print(f"line {error['line']}: {error['error']}", file=sys.stderr)
+    print(f"{totals['imported']} {args.kind} imported, {totals['failed']} failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_SIZE = 10000
+# seconds a cached value is trusted, negative results expire sooner
+DEFAULT_TTL = 60
+DEFAULT_NEGATIVE_TTL = 10
+
+
+class TTLCache:
+    # bounded least recently used cache whose entries expire
+    #
+    # invalidate() bumps a generation counter, a value fetched from elsewhere is only stored
+    # if no invalidation happened since the fetch started, so a slow fetch that raced with a
+    # change cannot put the old value back into the cache
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # key -> (value, expiry time), least recently used first
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, key):
+        # return the cached value, None if it is missing or expired
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return value
+
+    def current_generation(self):
+        # take this before fetching a value and pass it to put()
+        with self.lock:
+            return self.generation
+
+    def put(self, key, value, generation):
+        # cache a value unless the cache was invalidated since generation was taken
+        ttl = self.ttl if value else self.negative_ttl
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def invalidate(self, key=None):
+        # drop one key, or everything when key is None
+        with self.lock:
+            self.generation += 1
+            self.stats["invalidations"] += 1
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def snapshot(self):
+        # return a copy of the statistics together with the number of cached entries
+        with self.lock:
+            return dict(self.stats, size=len(self.entries))
+
+
+# seconds the answer to a request with an idempotency key is kept for retries of the request
+DEFAULT_IDEMPOTENCY_TTL = 3600
+# what IdempotencyCache.start() returns instead of a response: the request is to be carried out,
+# the first request with the key is still running, or the key was used for another request
+RUN = None
+RUNNING = "running"
+REUSED = "reused"
+
+
+class IdempotencyCache:
+    # answers by idempotency key, so that a client or proxy retrying a request gets the first
+    # answer back instead of the request being carried out again
+    #
+    # a key belongs to the request it was first sent with, given by a fingerprint of its path and
+    # parameters. Server errors are not kept, the request did not happen and may be tried again.
+    # Least recently stored keys are dropped first when there are too many.
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_IDEMPOTENCY_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (fingerprint, response or None while the request runs, expiry time)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"stored": 0, "replayed": 0, "running": 0, "reused": 0, "evictions": 0}
+
+    def start(self, key, fingerprint):
+        # RUN if the request is to be carried out, and finish() called after it; otherwise the
+        # response it got the first time, RUNNING or REUSED
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[2] < now:
+                self.entries[key] = (fingerprint, None, now + self.ttl)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+                    self.stats["evictions"] += 1
+                return RUN
+            stored_fingerprint, stored, _ = entry
+            if stored_fingerprint != fingerprint:
+                self.stats["reused"] += 1
+                return REUSED
+            if stored is None:
+                self.stats["running"] += 1
+                return RUNNING
+            self.stats["replayed"] += 1
+            return stored
+
+    def finish(self, key, fingerprint, result):
+        # keep the response of a request start() let run, None if it raised
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != fingerprint or entry[1] is not None:
+                return
+            if result is None or result.status >= 500:
+                del self.entries[key]
+                return
+            self.entries[key] = (fingerprint, result, time.monotonic() + self.ttl)
+            self.stats["stored"] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, size=len(self.entries))
@@ -0,0 +1,134 @@
+import json
+import threading
+import time
+from collections import deque
+
+import response
+
+# changes kept for readers that fall behind or reconnect, older ones are only available as current state
+DEFAULT_BACKLOG = 10000
+# seconds between comments sent on a quiet event stream, so that proxies keep it open and a
+# client that went away is noticed
+HEARTBEAT = 15
+EVENT_STREAM = b"Content-Type: text/event-stream\r\n"
+
+
+class ChangeFeed:
+    # numbered changes of a store, readers wait for the ones after the last sequence number they saw
+    # publish() is called under the store's lock, so changes of one key are numbered in the order
+    # they were made
+
+    def __init__(self, backlog=DEFAULT_BACKLOG):
+        # (sequence number, change), the newest last
+        self.changes = deque(maxlen=backlog)
+        self.sequence = 0
+        # numbering starts over when the process restarts, event ids carry the start time of this
+        # one so that an id from before a restart is not taken for a position in the new numbering
+        self.epoch = format(time.time_ns(), "x")
+        self.changed = threading.Condition()
+
+    def publish(self, change):
+        with self.changed:
+            self.sequence += 1
+            self.changes.append((self.sequence, change))
+            self.changed.notify_all()
+
+    def current(self):
+        with self.changed:
+            return self.sequence
+
+    def event_id(self, sequence):
+        return f"{self.epoch}-{sequence}"
+
+    def sequence_of(self, event_id):
+        # the sequence number of an event id of this feed, None if it is not one or from another run
+        epoch, _, sequence = event_id.partition("-")
+        if epoch != self.epoch or not sequence.isdigit():
+            return None
+        return int(sequence)
+
+    def after(self, sequence, timeout):
+        # the changes numbered above sequence, waiting up to timeout seconds for one
+        # returns None if some of them were already dropped from the backlog
+        with self.changed:
+            if self.sequence == sequence:
+                self.changed.wait(timeout)
+            count = self.sequence - sequence
+            if count > len(self.changes) or count < 0:
+                return None
+            # the wanted changes are the last count ones, read from the end of the deque
+            return [self.changes[i] for i in range(len(self.changes) - count, len(self.changes))]
+
+
+class EventStream(response.Stream):
+    # text/event-stream response that goes on until the client leaves, always chunked
+
+    __slots__ = ()
+
+    def __init__(self, produce):
+        super().__init__("200 OK", produce, EVENT_STREAM, (("Cache-Control", "no-cache"),))
+
+    def negotiate(self, request):
+        if request.version != "HTTP/1.1":
+            return response.html("505 HTTP Version Not Supported", "Event streams need HTTP/1.1.")
+        return self
+
+
+def event(name, data, event_id=None):
+    # one server-sent event, the id is what the client sends back as Last-Event-ID
+    head = b"id: %s\n" % event_id.encode() if event_id is not None else b""
+    return b"%sevent: %s\ndata: %s\n\n" % (head, name.encode(), json.dumps(data, separators=(",", ":")).encode())
+
+
+def last_event_id(request):
+    # the event id an EventSource sends back when it reconnects, None if there is none
+    return request.headers.get("last-event-id")
+
+
+def stream(feed, render, snapshot, since=None, heartbeat=HEARTBEAT):
+    # EventStream of the changes of feed after the event id since, render(change, event id) returns
+    # an event or None to skip it; without since, or when the changes after it are gone or it is
+    # from before a restart, the snapshot() events of the current state come first, then a "ready"
+    # event with the id they are as new as. Changes made while the snapshot is read are sent again
+    # after it, which is harmless as long as every event carries the whole new state of what changed.
+    def produce(as_json):
+        sequence = None
+        if since is not None:
+            sequence = feed.sequence_of(since)
+            if sequence is None or feed.after(sequence, 0) is None:
+                yield event("reset", {"since": since})
+                sequence = None
+        if sequence is None:
+            sequence = feed.current()
+            yield from snapshot()
+            yield ready(sequence)
+        else:
+            # nothing else may be sent for a while, and the head has to reach the client now
+            yield b": resumed\n\n"
+        quiet_since = time.monotonic()
+        while True:
+            changes = feed.after(sequence, heartbeat)
+            if changes is None:
+                # fell behind by more than the backlog, start over from the current state
+                yield event("reset", {"since": feed.event_id(sequence)})
+                sequence = feed.current()
+                yield from snapshot()
+                yield ready(sequence)
+                continue
+            events = []
+            for sequence, change in changes:
+                rendered = render(change, feed.event_id(sequence))
+                if rendered is not None:
+                    events.append(rendered)
+            if events:
+                yield b"".join(events)
+                quiet_since = time.monotonic()
+            elif time.monotonic() - quiet_since >= heartbeat:
+                yield b": heartbeat\n\n"
+                quiet_since = time.monotonic()
+
+    def ready(sequence):
+        event_id = feed.event_id(sequence)
+        return event("ready", {"id": event_id}, event_id)
+
+    return EventStream(produce)
@@ -0,0 +1,134 @@
+from urllib.parse import parse_qsl, unquote
+
+# largest request line plus headers, and largest body, a client may send
+DEFAULT_MAX_HEADER_SIZE = 8192
+DEFAULT_MAX_BODY_SIZE = 1024 * 1024
+
+
+class HTTPParseError(Exception):
+    # raised for requests that cannot be parsed, carries the status code to answer with
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+class Request:
+    __slots__ = ("method", "target", "path", "query", "version", "headers", "body", "keep_alive")
+
+    def __init__(self, method, target, version, headers, body):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        self.body = body
+        path, _, query = target.partition("?")
+        self.path = unquote(path)
+        # percent-decoded query parameters, the first '=' separates a key from its value
+        self.query = dict(parse_qsl(query, keep_blank_values=True))
+        # HTTP/1.1 connections are persistent unless the client asks otherwise, HTTP/1.0 ones are not
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.1":
+            self.keep_alive = connection != "close"
+        else:
+            self.keep_alive = connection == "keep-alive"
+
+    def __str__(self):
+        return f"{self.method} {self.target} {self.version}"
+
+
+def parse_head(head):
+    # parse the request line and headers, head is the header block without the blank line
+    lines = head.decode("latin-1").split("\n")
+    parts = lines[0].rstrip("\r").split(" ")
+    if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+        raise HTTPParseError("400 Bad Request", "Invalid request.")
+    method, target, version = parts
+    headers = {}
+    for line in lines[1:]:
+        key, separator, value = line.partition(":")
+        if not separator:
+            raise HTTPParseError("400 Bad Request", "Invalid header.")
+        headers[key.strip().lower()] = value.strip()
+    return method, target, version, headers
+
+
+class RequestParser:
+    # incremental HTTP/1.1 request parser for one connection
+    # feed() it bytes as they arrive and take complete requests with next_request()
+
+    def __init__(self, max_header_size=DEFAULT_MAX_HEADER_SIZE, max_body_size=DEFAULT_MAX_BODY_SIZE):
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self.buffer = bytearray()
+        # offset the search for the end of the headers resumes from, so no byte is scanned twice
+        self.scan_from = 0
+        # parsed head of a request whose body has not fully arrived yet
+        self.pending = None
+
+    def feed(self, data):
+        self.buffer += data
+
+    def partial(self):
+        # whether part of a request has arrived but not all of it
+        return self.pending is not None or bool(self.buffer.lstrip(b"\r\n"))
+
+    def find_head_end(self):
+        # return the offset just past the blank line ending the headers, or -1
+        # both CRLF and bare LF line endings are accepted
+        buffer = self.buffer
+        newline = buffer.find(b"\n", self.scan_from)
+        while newline != -1:
+            if newline > 0 and (buffer[newline - 1] == 10 or
+                                (newline > 1 and buffer[newline - 1] == 13 and buffer[newline - 2] == 10)):
+                return newline + 1
+            newline = buffer.find(b"\n", newline + 1)
+        self.scan_from = len(buffer)
+        return -1
+
+    def next_request(self):
+        # return the next complete Request, or None until more data has been fed
+        if self.pending is None:
+            # ignore empty lines between pipelined requests
+            skip = 0
+            while skip < len(self.buffer) and self.buffer[skip] in (10, 13):
+                skip += 1
+            if skip:
+                del self.buffer[:skip]
+                self.scan_from = 0
+            end = self.find_head_end()
+            if end == -1:
+                if len(self.buffer) > self.max_header_size:
+                    raise HTTPParseError("431 Request Header Fields Too Large", "Request headers too large.")
+                return None
+            if end > self.max_header_size:
+                raise HTTPParseError("431 Request Header Fields Too Large", "Request headers too large.")
+            method, target, version, headers = parse_head(self.buffer[:end].rstrip(b"\r\n"))
+            if "chunked" in headers.get("transfer-encoding", "").lower():
+                raise HTTPParseError("501 Not Implemented", "Chunked request bodies are not supported.")
+            length = headers.get("content-length", "0")
+            if not length.isdigit():
+                raise HTTPParseError("400 Bad Request", "Invalid Content-Length.")
+            length = int(length)
+            if length > self.max_body_size:
+                raise HTTPParseError("413 Payload Too Large", "Request body too large.")
+            del self.buffer[:end]
+            self.scan_from = 0
+            self.pending = (method, target, version, headers, length)
+        method, target, version, headers, length = self.pending
+        if len(self.buffer) < length:
+            return None
+        body = bytes(self.buffer[:length])
+        del self.buffer[:length]
+        self.pending = None
+        return Request(method, target, version, headers, body)
+
+
+def parse_request(data):
+    # parse a single complete request given as str or bytes
+    parser = RequestParser()
+    parser.feed(data.encode() if isinstance(data, str) else data)
+    request = parser.next_request()
+    if request is None:
+        raise HTTPParseError("400 Bad Request", "Incomplete request.")
+    return request
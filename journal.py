@@ -0,0 +1,186 @@
+import json
+import os
+import threading
+
+# number of logged records after which the log is compacted into a new snapshot
+DEFAULT_SNAPSHOT_EVERY = 10000
+DEFAULT_DATA_DIR = "."
+
+
+class JournalError(Exception):
+    pass
+
+
+def encode(record):
+    return (json.dumps(record, separators=(",", ":")) + "\n").encode()
+
+
+def replay_file(path, apply):
+    # apply every record of a journal file, a torn last line left by a crash is ignored
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            apply(json.loads(line))
+
+
+def fsync_directory(directory):
+    # make renames and deletions in a directory durable
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class Journal:
+    # append-only log of state changes, one JSON array per line, with periodic snapshots
+    #
+    # append() only queues a record, a background thread writes everything queued with one
+    # write and one fsync, and wait() blocks until a record is durable. Records must set state
+    # rather than change it (e.g. "day 3 of room A is now mask M") so that replaying a record
+    # that the snapshot already contains is harmless.
+
+    def __init__(self, name):
+        self.name = name
+        self.file = None
+        self.dump = None
+        self.snapshot_every = DEFAULT_SNAPSHOT_EVERY
+        self.pending = []
+        # sequence numbers of the last queued and the last durable record
+        self.appended = 0
+        self.flushed = 0
+        self.since_snapshot = 0
+        self.compacting = False
+        # OSError that stopped the writer thread, every later wait() raises it
+        self.error = None
+        self.condition = threading.Condition()
+        # held while the log file is written or swapped
+        self.write_lock = threading.Lock()
+
+    def open(self, directory, apply, dump, snapshot_every=DEFAULT_SNAPSHOT_EVERY):
+        # replay the snapshot and logs through apply(record), compact them, then start logging
+        # dump() must return the records that recreate the current state
+        self.directory = directory
+        self.log_path = os.path.join(directory, f"{self.name}.log")
+        # log being compacted into a snapshot, still present if a compaction was interrupted
+        self.old_log_path = self.log_path + ".old"
+        self.snapshot_path = os.path.join(directory, f"{self.name}.snapshot")
+        self.dump = dump
+        self.snapshot_every = snapshot_every
+        os.makedirs(directory, exist_ok=True)
+        for path in (self.snapshot_path, self.old_log_path, self.log_path):
+            replay_file(path, apply)
+        # start from a fresh snapshot so that the next startup replays as little as possible
+        self.write_snapshot()
+        for path in (self.old_log_path, self.log_path):
+            if os.path.exists(path):
+                os.remove(path)
+        fsync_directory(directory)
+        self.file = open(self.log_path, "ab")
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def append(self, record):
+        # queue a record and return its sequence number for wait()
+        # does nothing while the journal is not open
+        if self.file is None:
+            return 0
+        line = encode(record)
+        with self.condition:
+            self.pending.append(line)
+            self.appended += 1
+            self.condition.notify_all()
+            return self.appended
+
+    def wait(self, sequence):
+        # block until the record with this sequence number has been written and fsynced
+        # raises JournalError if it never will be, because writing the log failed
+        with self.condition:
+            while self.flushed < sequence:
+                if self.error is not None:
+                    raise JournalError(f"{self.name} journal cannot be written: {self.error}") from self.error
+                self.condition.wait()
+
+    def run(self):
+        try:
+            self.write_forever()
+        except OSError as error:
+            self.failed(error)
+
+    def failed(self, error):
+        # disk full or failing: records are no longer made durable, which waiting callers
+        # learn instead of blocking for ever
+        with self.condition:
+            self.error = error
+            self.condition.notify_all()
+
+    def write_forever(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+            with self.write_lock:
+                self.write_pending()
+            with self.condition:
+                if self.since_snapshot < self.snapshot_every or self.compacting:
+                    continue
+                self.compacting = True
+            threading.Thread(target=self.compact, daemon=True).start()
+
+    def write_pending(self):
+        # write out every queued record with one write and one fsync, needs write_lock
+        with self.condition:
+            lines, self.pending = self.pending, []
+            sequence = self.appended
+        if lines:
+            self.file.write(b"".join(lines))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        with self.condition:
+            self.flushed = sequence
+            self.since_snapshot += len(lines)
+            self.condition.notify_all()
+
+    def compact(self):
+        # move the log aside, snapshot the current state and drop the old log
+        # changes made while the snapshot is written go to the new log and are replayed after it
+        try:
+            with self.write_lock:
+                self.write_pending()
+                self.file.close()
+                os.replace(self.log_path, self.old_log_path)
+                self.file = open(self.log_path, "ab")
+                with self.condition:
+                    self.since_snapshot = 0
+            self.write_snapshot()
+            os.remove(self.old_log_path)
+            fsync_directory(self.directory)
+        except OSError as error:
+            self.failed(error)
+        finally:
+            with self.condition:
+                self.compacting = False
+
+    def write_snapshot(self):
+        temporary_path = self.snapshot_path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            for record in self.dump():
+                f.write(encode(record))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.snapshot_path)
+
+
+def add_arguments(parser):
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR, help="directory of the journals and snapshots")
+    parser.add_argument("--snapshot-every", type=int, default=DEFAULT_SNAPSHOT_EVERY,
+                        help="number of logged changes after which a new snapshot is written")
@@ -0,0 +1,256 @@
+import queue
+import random
+import sys
+import threading
+import time
+import traceback
+from bisect import bisect_left
+
+import response
+
+# upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+# fraction of requests written to the request log
+DEFAULT_LOG_SAMPLE = 1.0
+# log lines waiting to be written, further lines are dropped rather than slowing requests down
+DEFAULT_LOG_QUEUE = 10000
+PROMETHEUS = b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+
+
+class Histogram:
+    # counts of observed values per bucket, plus their number and sum
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # the last count is for values above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def render(self, name, labels):
+        # Prometheus text lines, bucket counts are cumulative
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class RequestLog:
+    # request log written by a background thread so that handlers never block on the terminal
+    # only a sample of the requests is logged, 0 turns the log off
+
+    def __init__(self, sample=DEFAULT_LOG_SAMPLE, queue_size=DEFAULT_LOG_QUEUE, output=None):
+        self.sample = sample
+        self.output = output or sys.stdout
+        self.lines = queue.Queue(queue_size)
+        self.dropped = 0
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def log(self, line):
+        if self.sample <= 0 or (self.sample < 1 and random.random() >= self.sample):
+            return
+        if self.thread is None:
+            self.start()
+        try:
+            self.lines.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            lines = [self.lines.get()]
+            # write whatever else is queued in the same call
+            while len(lines) < 1000:
+                try:
+                    lines.append(self.lines.get_nowait())
+                except queue.Empty:
+                    break
+            self.output.write("\n".join(lines) + "\n")
+            self.output.flush()
+
+
+# shared by every server of the process
+request_log = RequestLog()
+
+
+class Metrics:
+    # request, connection and upstream statistics of one server, rendered for Prometheus
+
+    def __init__(self, server, routes=(), buckets=DEFAULT_BUCKETS):
+        self.server = server
+        self.buckets = buckets
+        # requests to other paths are labelled "other" so that arbitrary paths
+        # cannot create an unbounded number of series
+        self.routes = set(routes)
+        # (route, method, status) -> count
+        self.requests = {}
+        # route -> Histogram
+        self.latencies = {}
+        # upstream "host:port" -> Histogram, (upstream, status) -> count
+        self.upstream_latencies = {}
+        self.upstream_requests = {}
+        self.in_flight = 0
+        self.connections = 0
+        self.connections_total = 0
+        # reason -> requests answered without calling the handler
+        self.rejections = {}
+        self.lock = threading.Lock()
+
+    def add_routes(self, routes):
+        self.routes.update(routes)
+
+    def route_of(self, path):
+        return path if path in self.routes else "other"
+
+    def instrument(self, handle_request):
+        # wrap a request handler so that it records its requests, answers /metrics, logs requests
+        # and answers 500 when it raises
+        def instrumented(request):
+            if request.method == "GET" and request.path == "/metrics":
+                return response.text("200 OK", self.render(), PROMETHEUS)
+            self.request_started()
+            start = time.perf_counter()
+            result = response.INTERNAL_ERROR
+            try:
+                result = handle_request(request)
+            except Exception:
+                # the client gets a 500 instead of a dropped connection, and the server keeps serving
+                log_failure(self.server, request)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.observe_request(request, result.status_code[:3], elapsed)
+            return result
+
+        return instrumented
+
+    def instrument_async(self, handle_request):
+        # instrument() for a handler that returns a coroutine
+        async def instrumented(request):
+            if request.method == "GET" and request.path == "/metrics":
+                return response.text("200 OK", self.render(), PROMETHEUS)
+            self.request_started()
+            start = time.perf_counter()
+            result = response.INTERNAL_ERROR
+            try:
+                result = await handle_request(request)
+            except Exception:
+                log_failure(self.server, request)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.observe_request(request, result.status_code[:3], elapsed)
+            return result
+
+        return instrumented
+
+    def request_started(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def observe_request(self, request, status, elapsed):
+        route = self.route_of(request.path)
+        key = (route, request.method, status)
+        with self.lock:
+            self.in_flight -= 1
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.latencies.get(route)
+            if histogram is None:
+                histogram = self.latencies[route] = Histogram(self.buckets)
+            histogram.observe(elapsed)
+        request_log.log(f"{self.server} {request} {status} {elapsed * 1000:.1f}ms")
+
+    def observe_upstream(self, address, status, elapsed):
+        # record one call to another server, status is None if it failed
+        key = (address, str(status) if status is not None else "error")
+        with self.lock:
+            self.upstream_requests[key] = self.upstream_requests.get(key, 0) + 1
+            histogram = self.upstream_latencies.get(address)
+            if histogram is None:
+                histogram = self.upstream_latencies[address] = Histogram(self.buckets)
+            histogram.observe(elapsed)
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections += 1
+            self.connections_total += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.connections -= 1
+
+    def rejected(self, reason):
+        # a request turned away, "overloaded" or "timeout"
+        with self.lock:
+            self.rejections[reason] = self.rejections.get(reason, 0) + 1
+
+    def render(self):
+        # every metric in the Prometheus text exposition format
+        server = f'server="{self.server}"'
+        lines = []
+        with self.lock:
+            lines.append("# HELP http_requests_total Requests handled, by route, method and status code.")
+            lines.append("# TYPE http_requests_total counter")
+            for (route, method, status), count in sorted(self.requests.items()):
+                lines.append(f'http_requests_total{{{server},route="{route}",method="{method}",'
+                             f'status="{status}"}} {count}')
+            lines.append("# HELP http_request_duration_seconds Time spent handling requests, by route.")
+            lines.append("# TYPE http_request_duration_seconds histogram")
+            for route, histogram in sorted(self.latencies.items()):
+                lines.extend(histogram.render("http_request_duration_seconds", f'{server},route="{route}"'))
+            lines.append("# HELP http_requests_in_flight Requests being handled.")
+            lines.append("# TYPE http_requests_in_flight gauge")
+            lines.append(f"http_requests_in_flight{{{server}}} {self.in_flight}")
+            lines.append("# HELP http_connections_open Client connections currently open.")
+            lines.append("# TYPE http_connections_open gauge")
+            lines.append(f"http_connections_open{{{server}}} {self.connections}")
+            lines.append("# HELP http_connections_total Client connections accepted.")
+            lines.append("# TYPE http_connections_total counter")
+            lines.append(f"http_connections_total{{{server}}} {self.connections_total}")
+            lines.append("# HELP http_requests_rejected_total Requests answered without being handled, by reason.")
+            lines.append("# TYPE http_requests_rejected_total counter")
+            for reason, count in sorted(self.rejections.items()):
+                lines.append(f'http_requests_rejected_total{{{server},reason="{reason}"}} {count}')
+            lines.append("# HELP upstream_requests_total Requests sent to other servers, by status code.")
+            lines.append("# TYPE upstream_requests_total counter")
+            for (address, status), count in sorted(self.upstream_requests.items()):
+                lines.append(f'upstream_requests_total{{{server},upstream="{address}",status="{status}"}} {count}')
+            lines.append("# HELP upstream_request_duration_seconds Time spent waiting for other servers.")
+            lines.append("# TYPE upstream_request_duration_seconds histogram")
+            for address, histogram in sorted(self.upstream_latencies.items()):
+                lines.extend(histogram.render("upstream_request_duration_seconds",
+                                              f'{server},upstream="{address}"'))
+        lines.append("# HELP request_log_dropped_total Log lines dropped because the log could not keep up.")
+        lines.append("# TYPE request_log_dropped_total counter")
+        lines.append(f"request_log_dropped_total {request_log.dropped}")
+        return "\n".join(lines) + "\n"
+
+
+def log_failure(server, request):
+    # traceback of a handler that raised, written whatever the request log's sample is
+    sys.stderr.write(f"{server} {request} failed\n{traceback.format_exc()}")
+    sys.stderr.flush()
+
+
+def add_arguments(parser):
+    parser.add_argument("--log-sample", type=float, default=DEFAULT_LOG_SAMPLE,
+                        help="fraction of requests to log, 0 turns the request log off")
+
+
+def configure_from_args(args):
+    request_log.sample = args.log_sample
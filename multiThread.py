@@ -1,125 +1,447 @@
-import socket
+import argparse
+import json
+import multiprocessing
+import os
 import threading
+import time
 
-# database
-rooms = {}
-activities = []
-reservations = {}
+import availability
+import bulk
+import cache
+import journal
+import feed
+import metrics
+import reservations
+import response
+import routing
+import schedule
+import serving
+import sharding
+import store
+import upstream
+import waitlist
 
-# HTTP response template
-response_template = """\
-HTTP/1.1 {status_code} {status_message}
-Content-Type: text/html
+# shape of every room schedule
+layout = schedule.Layout()
 
-<html>
-  <body>
-    {message}
-  </body>
-</html>
-"""
+# database, shared by the server threads
+rooms = store.RoomStore(layout)
+activities = store.ActivityRegistry()
+reservation_book = reservations.ReservationBook()
+
+# request statistics of each server, served on /metrics
+room_metrics = metrics.Metrics("room")
+activity_metrics = metrics.Metrics("activity")
+reservation_metrics = metrics.Metrics("reservation")
+
+# connection pools to the Room and Activity Servers used by the reservation server
+room_server = upstream.UpstreamPool(("localhost", 8081), metrics=reservation_metrics)
+activity_server = upstream.UpstreamPool(("localhost", 8082), metrics=reservation_metrics)
+# pools to the room shards when the Room Server runs as several processes (--room-shards),
+# the reservation server then sends requests about one room straight to the shard owning it
+room_shards = None
+# which activities exist, as seen by the reservation server
+activity_cache = cache.TTLCache()
+# answers to reserve requests by idempotency key, for clients and proxies that retry
+idempotency_cache = cache.IdempotencyCache()
+# reservation servers the Activity Server tells about added and removed activities
+activity_subscribers = [upstream.UpstreamPool(("localhost", 8080), timeout=1, metrics=activity_metrics)]
 
 
 def add_room(name):
     # add room to database if it doesn't already exist
-    if name not in rooms:
-        rooms[name] = [[False for _ in range(9, 18)] for _ in range(7)]
-        with open("room.txt", "a") as f:
-            f.write(name + "\n")
+    if rooms.add(name):
         return "200 OK", f"Room {name} added."
     return "400 Bad Request", f"Room {name} already exists."
 
 
 def remove_room(name):
     # remove room from database if it exists
-    if name in rooms:
-        del rooms[name]
-        with open("room.txt", "w") as f:
-            for room in rooms:
-                f.write(room + "\n")
+    if rooms.remove(name):
+        # nobody waiting for the room can get it any more
+        reservation_waitlist.fail_room(name)
         return "200 OK", f"Room {name} removed."
     return "404 Not Found", f"Room {name} does not exist."
 
 
-def reserve_room(name, day, hour, duration):
+# the room operations below return the status as a number, the request handlers add the message
+# and the reservation server calls them directly when it runs in the same process
+
+
+def book_room(name, day, hour, duration):
     # reserve room if it exists and is available
-    if name in rooms:
-        day = int(day) - 1
-        hour = int(hour) - 9
-        duration = int(duration) + 1
-        for i in range(hour, hour + duration):
-            if rooms[name][day][i]:
-                return "403 Forbidden", f"Room {name} is not available at this time."
-        for i in range(hour, hour + duration):
-            rooms[name][day][i] = True
-        return "200 OK", f"Room {name} reserved for day {day + 1} at {hour + 9}:00 for {duration - 1} hours."
-    return "404 Not Found", f"Room {name} does not exist."
+    if name not in rooms:
+        return 404
+    day_index = layout.day_index(day)
+    span = layout.span(hour, duration)
+    if day_index is None or span is None:
+        return 400
+    booked = rooms.book(name, day_index, *span)
+    if booked is False:
+        return 403
+    return 200 if booked else 404
+
+
+def unbook_room(name, day, hour, duration):
+    # free booked slots of a room
+    day_index = layout.day_index(day)
+    span = layout.span(hour, duration)
+    if day_index is None or span is None:
+        return 400
+    return 200 if rooms.release(name, day_index, *span) else 404
+
+
+def rebook_room(name, from_day, from_hour, from_duration, day, hour, duration):
+    # move a booking of a room to another time, keeping it where it was if the new time is taken
+    old_span = layout.span(from_hour, from_duration)
+    span = layout.span(hour, duration)
+    if old_span is None or span is None or layout.day_index(from_day) is None or layout.day_index(day) is None:
+        return 400
+    moved = rooms.move(name, layout.day_index(from_day), *old_span, layout.day_index(day), *span)
+    if moved is None:
+        return 404
+    return 200 if moved else 403
 
 
-def check_availability(name, day):
-    # check availability of room if it exists
-    if name in rooms:
-        day = int(day) - 1
-        hours = []
-        for i, is_available in enumerate(rooms[name][day]):
-            if not is_available:
-                hours.append(str(i + 9))
-        if hours:
-            return "200 OK", f"Available hours for room {name} on day {day + 1}: {', '.join(hours)}"
-        return "200 OK", f"No hours are available for room {name} on day {day + 1}."
+def free_rooms(day, hour, duration):
+    # {day: sorted names} of the rooms free at a time on one day, a range of days ("1-5") or every day,
+    # None if the input is invalid
+    days = layout.day_range(day)
+    span = layout.span(hour, duration)
+    if days is None or span is None:
+        return None
+    return {day_index + 1: sorted(rooms.search(day_index, *span)) for day_index in days}
+
+
+def room_failure(status, name):
+    # status code and message of a room operation that did not succeed
+    if status == 400:
+        return "400 Bad Request", "Invalid day, hour or duration."
+    if status == 403:
+        return "403 Forbidden", f"Room {name} is not available at this time."
     return "404 Not Found", f"Room {name} does not exist."
 
 
-def room_handle_request(request):
-    # parse request and call appropriate function
-    request_lines = request.split("\n")
-    request_line = request_lines[0]
-    parts = request_line.split(" ")
-    if len(parts) != 3:
-        return "HTTP/1.1 400 Bad Request\n\nInvalid request."
-    request_type, request_url, _ = parts
-    request_params = {}
-    if "?" in request_url:
-        for param in request_url.split("?")[1].split("&"):
-            key, value = param.split("=")
-            request_params[key] = value
-    if request_type == "GET":
-        if request_url.startswith("/add"):
-            status_code, message = add_room(request_params["name"])
-        elif request_url.startswith("/remove"):
-            status_code, message = remove_room(request_params["name"])
-        elif request_url.startswith("/reserve"):
-            status_code, message = reserve_room(request_params["name"], request_params["day"], request_params["hour"],
-                                                request_params["duration"])
-        elif request_url.startswith("/checkavailability"):
-            status_code, message = check_availability(request_params["name"], request_params["day"])
+def reserve_room(name, day, hour, duration):
+    status = book_room(name, day, hour, duration)
+    if status != 200:
+        return room_failure(status, name)
+    start = layout.clock_time(layout.slot(hour))
+    return "200 OK", f"Room {name} reserved for day {day} at {start} for {duration} hours."
+
+
+def check_availability(name, day=None):
+    # check availability of room if it exists, on one day or on every day
+    if name not in rooms:
+        return "404 Not Found", f"Room {name} does not exist."
+    days = layout.day_range(day)
+    if days is None or (day is not None and len(days) != 1):
+        return "400 Bad Request", "Invalid day."
+    lines = []
+    for day_index in days:
+        slots = rooms.free_slots(name, day_index)
+        if slots is None:
+            return "404 Not Found", f"Room {name} does not exist."
+        if slots:
+            lines.append(f"Available hours for room {name} on day {day_index + 1}: "
+                         f"{', '.join(map(layout.slot_time, slots))}")
+        else:
+            lines.append(f"No hours are available for room {name} on day {day_index + 1}.")
+    return "200 OK", "<br>".join(lines)
+
+
+def find_free_rooms(day, hour, duration):
+    found = free_rooms(day, hour, duration)
+    if found is None:
+        return "400 Bad Request", "Invalid day, hour or duration."
+    return free_rooms_response(found, layout.slot(hour), duration)
+
+
+def free_rooms_response(free_rooms, first, duration):
+    # list the free rooms of each day, as JSON {"rooms": {day: names}} for programs
+    lines = []
+    for day, names in free_rooms.items():
+        if names:
+            lines.append(f"Rooms available on day {day} at {layout.clock_time(first)} "
+                         f"for {duration} hours: {', '.join(names)}")
         else:
-            status_code = "404 Not Found"
-            message = "Invalid request."
+            lines.append(f"No rooms are available on day {day} at {layout.clock_time(first)} "
+                         f"for {duration} hours.")
+    return response.html("200 OK", "<br>".join(lines), {"rooms": free_rooms})
+
+
+def list_rooms():
+    return room_list_response(sorted(rooms.names()))
+
+
+def watch_rooms(request, room=None, since=None):
+    # server-sent events of the availability changes of some rooms (room=R1,R2) or of every room,
+    # resumed after since or the Last-Event-ID header, for dashboards that would otherwise poll
+    names = set(room.split(",")) if room else None
+    return availability.stream(rooms, names, since if since is not None else feed.last_event_id(request))
+
+
+def room_list_response(names):
+    if not names:
+        return response.html("200 OK", "There are no rooms.", {"rooms": names})
+    return response.html("200 OK", f"Rooms: {', '.join(names)}", {"rooms": names})
+
+
+def reserve_rooms(bookings, atomic=True):
+    # reserve a list of [room, day, hour, duration] bookings with one lock round per room
+    # returns (status code, whether the bookings were committed, status code of each booking)
+    spans = []
+    results = []
+    for name, day, hour, duration in bookings:
+        day_index = layout.day_index(day)
+        span = layout.span(hour, duration)
+        if day_index is None or span is None:
+            results.append("400 Bad Request")
+        else:
+            spans.append((name, day_index, *span))
+            results.append(None)
+    if atomic and len(spans) < len(bookings):
+        committed, booked = False, [True] * len(spans)
     else:
-        status_code = "405 Method Not Allowed"
-        message = "Method not allowed."
-    return response_template.format(status_code=status_code, status_message=status_code.split(" ")[1], message=message)
+        committed, booked = rooms.book_many(spans, atomic)
+    # bookings that could have been made in a batch that was not committed are reported as conflicts
+    outcomes = {True: "200 OK" if committed else "409 Conflict", False: "403 Forbidden", None: "404 Not Found"}
+    booked = iter(booked)
+    for i, result in enumerate(results):
+        if result is None:
+            results[i] = outcomes[next(booked)]
+    if not committed:
+        return "409 Conflict", False, results
+    return "200 OK", True, results
+
+
+def release_room(name, day, hour, duration):
+    status = unbook_room(name, day, hour, duration)
+    if status != 200:
+        return room_failure(status, name)
+    room_slots_freed(name, day, hour, duration)
+    start = layout.clock_time(layout.slot(hour))
+    return "200 OK", f"Room {name} released for day {day} at {start} for {duration} hours."
+
+
+def move_room(name, from_day, from_hour, from_duration, day, hour, duration):
+    status = rebook_room(name, from_day, from_hour, from_duration, day, hour, duration)
+    if status != 200:
+        return room_failure(status, name)
+    room_slots_freed(name, from_day, from_hour, from_duration)
+    start = layout.clock_time(layout.slot(hour))
+    return "200 OK", f"Room {name} moved to day {day} at {start} for {duration} hours."
+
+
+def release_rooms(bookings):
+    # free a list of [room, day, hour, duration] bookings, returns whether each room exists
+    results = []
+    for name, day, hour, duration in bookings:
+        day_index = layout.day_index(day)
+        span = layout.span(hour, duration)
+        results.append(day_index is not None and span is not None and rooms.release(name, day_index, *span))
+    return results
+
+
+# the converters of the day, hour and duration parameters of /reserve, for the same fields in JSON bodies
+booking_params = (routing.day(layout), routing.hour(layout), routing.duration(layout))
+
+
+def convert_booking(day, hour, duration):
+    # day, hour and duration as /reserve would get them, raises ValueError if one is invalid
+    return tuple(param.convert(str(value)) for param, value in zip(booking_params, (day, hour, duration)))
+
+
+def parse_bookings(body):
+    # JSON list of [room, day, hour, duration] with converted times
+    # returns (bookings, None), or (None, 400 answer) naming the first invalid booking
+    try:
+        items = json.loads(body)
+        if not isinstance(items, list):
+            raise ValueError
+    except ValueError:
+        return None, response.json_data("400 Bad Request", {"error": "Invalid list of bookings."})
+    bookings = []
+    for i, item in enumerate(items):
+        try:
+            name, day, hour, duration = item
+            if not isinstance(name, str):
+                raise ValueError(name)
+            bookings.append((name, *convert_booking(day, hour, duration)))
+        except (TypeError, ValueError):
+            return None, response.json_data("400 Bad Request", {"error": "Invalid booking.", "index": i})
+    return bookings, None
+
+
+def reserve_many(request, atomic):
+    bookings, invalid = parse_bookings(request.body)
+    if invalid is not None:
+        return invalid
+    status_code, committed, results = reserve_rooms(bookings, atomic)
+    return response.json_data(status_code, {"committed": committed, "results": results})
+
+
+def release_many(request):
+    bookings, invalid = parse_bookings(request.body)
+    if invalid is not None:
+        return invalid
+    released = release_rooms(bookings)
+    for booking, freed in zip(bookings, released):
+        if freed:
+            room_slots_freed(*booking)
+    return response.json_data("200 OK", {"released": released})
+
+
+def import_rooms(request, format):
+    # body: JSON lines of {"room"} objects or CSV with a room column
+    return bulk.load_rooms(rooms, request.body, format)
+
+
+def export_rooms(format):
+    return bulk.dump_rooms(rooms, format)
+
+
+# request dispatch of the Room Server
+room_handle_request = routing.Router()
+room_handle_request.add("GET", "/add", add_room, name=routing.text())
+room_handle_request.add("GET", "/remove", remove_room, name=routing.text())
+room_handle_request.add("GET", "/reserve", reserve_room, name=routing.text(), day=routing.day(layout),
+                        hour=routing.hour(layout), duration=routing.duration(layout))
+room_handle_request.add("GET", "/checkavailability", check_availability, name=routing.text(),
+                        day=routing.day(layout, required=False))
+room_handle_request.add("GET", "/search", find_free_rooms, day=routing.days(layout), hour=routing.hour(layout),
+                        duration=routing.duration(layout))
+room_handle_request.add("GET", "/release", release_room, name=routing.text(), day=routing.day(layout),
+                        hour=routing.hour(layout), duration=routing.duration(layout))
+room_handle_request.add("GET", "/move", move_room, name=routing.text(), from_day=routing.day(layout),
+                        from_hour=routing.hour(layout), from_duration=routing.duration(layout),
+                        day=routing.day(layout), hour=routing.hour(layout), duration=routing.duration(layout))
+room_handle_request.add("GET", "/rooms", list_rooms)
+room_handle_request.add("POST", "/reservemany", reserve_many, with_request=True, atomic=routing.flag(default=True))
+room_handle_request.add("POST", "/releasemany", release_many, with_request=True)
+room_handle_request.add("GET", "/watchavailability", watch_rooms, with_request=True, room=routing.text(required=False),
+                        since=routing.text(required=False))
+room_handle_request.add("POST", "/import", import_rooms, with_request=True,
+                        format=routing.choice(bulk.FORMATS, default="jsonl"))
+room_handle_request.add("GET", "/export", export_rooms, format=routing.choice(bulk.FORMATS, default="jsonl"))
+room_metrics.add_routes(room_handle_request.paths())
+
+
+def relay(request, name):
+    # pass a request about one room on to the shard owning it
+    headers = [("Accept", request.headers["accept"])] if "accept" in request.headers else []
+    try:
+        status, response_headers, body = room_shards.pool(name).exchange(request.method, request.target,
+                                                                         request.body.decode(), headers)
+    except upstream.UpstreamError:
+        return "502 Bad Gateway", "Could not reach the room shard."
+    return response.relayed(status, response_headers, body)
+
+
+def search_shards(day, hour, duration):
+    # ask every shard for its free rooms and merge the lists of each day
+    params = {"hour": hour, "duration": duration}
+    if day is not None:
+        params["day"] = day
+    try:
+        replies = room_shards.fan_out(lambda pool: pool.get_json("/search", **params))
+    except upstream.UpstreamError:
+        return "502 Bad Gateway", "Could not reach a room shard."
+    free_rooms = {}
+    for status, data in replies:
+        if status != 200:
+            return response.status_code_of(status), "Invalid day, hour or duration."
+        for free_day, names in data["rooms"].items():
+            free_rooms.setdefault(int(free_day), []).extend(names)
+    return free_rooms_response({free_day: sorted(names) for free_day, names in sorted(free_rooms.items())},
+                               layout.slot(hour), duration)
+
+
+def list_shard_rooms():
+    try:
+        replies = room_shards.fan_out(lambda pool: pool.get_json("/rooms"))
+    except upstream.UpstreamError:
+        return "502 Bad Gateway", "Could not reach a room shard."
+    return room_list_response(sorted(name for _, data in replies for name in data["rooms"]))
+
+
+def reserve_shards(request, atomic):
+    # split a batch by shard and book every part at the same time
+    # an atomic batch that fails on some shard is released again on the shards that booked their part
+    bookings, invalid = parse_bookings(request.body)
+    if invalid is not None:
+        return invalid
+    parts = {}
+    for i, booking in enumerate(bookings):
+        parts.setdefault(room_shards.index(booking[0]), []).append(i)
+    parts = list(parts.items())
+
+    def reserve_part(pool, indexes):
+        status, body = pool.post("/reservemany", json.dumps([bookings[i] for i in indexes]), atomic=int(atomic))
+        if status not in (200, 409):
+            raise upstream.UpstreamError(f"room shard answered {status}")
+        return json.loads(body)
+
+    try:
+        replies = room_shards.map(reserve_part, parts)
+    except (upstream.UpstreamError, ValueError):
+        return response.json_data("502 Bad Gateway", {"error": "Could not reach a room shard."})
+    committed = all(reply["committed"] for reply in replies)
+    if atomic and not committed:
+        undo = [(shard, indexes) for (shard, indexes), reply in zip(parts, replies) if reply["committed"]]
+        try:
+            room_shards.map(lambda pool, indexes: pool.post("/releasemany", json.dumps([bookings[i] for i in indexes])),
+                            undo)
+        except upstream.UpstreamError:
+            return response.json_data("502 Bad Gateway", {"error": "Could not undo the bookings of a room shard."})
+    results = [None] * len(bookings)
+    for (_, indexes), reply in zip(parts, replies):
+        for i, result in zip(indexes, reply["results"]):
+            results[i] = "409 Conflict" if atomic and not committed and result == "200 OK" else result
+    return response.json_data("200 OK" if committed else "409 Conflict", {"committed": committed, "results": results})
+
+
+# request dispatch of the Room Server's front process when it runs as shards
+room_dispatch = routing.Router()
+for path in ("/add", "/remove", "/reserve", "/release", "/move", "/checkavailability"):
+    room_dispatch.add("GET", path, relay, with_request=True, name=routing.text())
+room_dispatch.add("GET", "/search", search_shards, day=routing.days(layout), hour=routing.hour(layout),
+                  duration=routing.duration(layout))
+room_dispatch.add("GET", "/rooms", list_shard_rooms)
+room_dispatch.add("POST", "/reservemany", reserve_shards, with_request=True, atomic=routing.flag(default=True))
+room_metrics.add_routes(room_dispatch.paths())
+
+
+def room_pool(name):
+    # pool to the server holding a room
+    return room_shards.pool(name) if room_shards else room_server
 
 
 def add_activity(name):
     # add activity to database if it doesn't already exist
-    if name not in activities:
-        activities.append(name)
-        with open("activities.txt", "a") as f:
-            f.write(name + "\n")
-        return "200 OK", f"Activity {name} added."
-    return "400 Bad Request", f"Activity {name} already exists."
+    if not activities.add(name):
+        return "400 Bad Request", f"Activity {name} already exists."
+    notify_subscribers(name)
+    return "200 OK", f"Activity {name} added."
 
 
 def remove_activity(name):
     # remove activity from database if it exists
-    if name in activities:
-        activities.remove(name)
-        with open("activities.txt", "w") as f:
-            for activity in activities:
-                f.write(activity + "\n")
-        return "200 OK", f"Activity {name} removed."
-    return "404 Not Found", f"Activity {name} does not exist."
+    if not activities.remove(name):
+        return "404 Not Found", f"Activity {name} does not exist."
+    notify_subscribers(name)
+    return "200 OK", f"Activity {name} removed."
+
+
+def notify_subscribers(name=None):
+    # tell the reservation servers to drop the activity, or every activity, from their caches
+    # a subscriber that cannot be reached catches up when its cache entry expires
+    params = {"name": name} if name is not None else {}
+    for subscriber in activity_subscribers:
+        try:
+            subscriber.post("/activitychanged", "", **params)
+        except upstream.UpstreamError:
+            pass
 
 
 def check_activity(name):
@@ -129,174 +451,644 @@ def check_activity(name):
     return "404 Not Found", f"Activity {name} does not exist."
 
 
-def activity_handle_request(request):
-    # parse request and call appropriate function
-    request_lines = request.split("\n")
-    request_line = request_lines[0]
-    parts = request_line.split(" ")
-    if len(parts) != 3:
-        return "HTTP/1.1 400 Bad Request\n\nInvalid request."
-    request_type, request_url, _ = parts
-    request_params = {}
-    if "?" in request_url:
-        for param in request_url.split("?")[1].split("&"):
-            key, value = param.split("=")
-            request_params[key] = value
-    if request_type == "GET":
-        if request_url.startswith("/add"):
-            status_code, message = add_activity(request_params["name"])
-        elif request_url.startswith("/remove"):
-            status_code, message = remove_activity(request_params["name"])
-        elif request_url.startswith("/check"):
-            status_code, message = check_activity(request_params["name"])
-        else:
-            status_code = "404 Not Found"
-            message = "Invalid request."
-    else:
-        status_code = "405 Method Not Allowed"
-        message = "Method not allowed."
-    return response_template.format(status_code=status_code, status_message=status_code.split(" ")[1],
-                                    message=message)
+def check_activities(names):
+    # check a list of activities at once, returns whether each one exists
+    return [name in activities for name in names]
+
+
+def check_many(request):
+    # body: JSON list of activity names
+    try:
+        names = json.loads(request.body)
+        if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+            raise ValueError
+    except ValueError:
+        return response.json_data("400 Bad Request", {"error": "Invalid list of activities."})
+    return response.json_data("200 OK", {"exists": check_activities(names)})
+
+
+def search_activities(prefix="", contains="", limit=store.DEFAULT_SEARCH):
+    # activity names starting with prefix and containing contains, for autocompletion
+    names = activities.search(prefix, contains, limit)
+    if not names:
+        return response.html("200 OK", "No activities match.", {"activities": names})
+    return response.html("200 OK", f"Activities: {', '.join(names)}", {"activities": names})
+
+
+def import_activities(request, format):
+    # body: JSON lines of {"activity"} objects or CSV with an activity column
+    answer = bulk.load_activities(activities, request.body, format)
+    # one invalidation of the whole cache instead of one per activity
+    notify_subscribers()
+    return answer
+
+
+def export_activities(format):
+    return bulk.dump_activities(activities, format)
+
+
+# request dispatch of the Activity Server
+activity_handle_request = routing.Router()
+activity_handle_request.add("GET", "/add", add_activity, name=routing.text())
+activity_handle_request.add("GET", "/remove", remove_activity, name=routing.text())
+activity_handle_request.add("GET", "/check", check_activity, name=routing.text())
+activity_handle_request.add("POST", "/checkmany", check_many, with_request=True)
+activity_handle_request.add("GET", "/search", search_activities, prefix=routing.text(required=False, default=""),
+                            contains=routing.text(required=False, default=""),
+                            limit=routing.integer(1, store.MAX_SEARCH, required=False, default=store.DEFAULT_SEARCH))
+activity_handle_request.add("POST", "/import", import_activities, with_request=True,
+                            format=routing.choice(bulk.FORMATS, default="jsonl"))
+activity_handle_request.add("GET", "/export", export_activities, format=routing.choice(bulk.FORMATS, default="jsonl"))
+activity_metrics.add_routes(activity_handle_request.paths())
+
+
+class LocalRooms:
+    # the Room Server of this process called as functions, without the HTTP round trip
+
+    def reserve(self, name, day, hour, duration):
+        return book_room(name, day, hour, duration)
+
+    def release(self, name, day, hour, duration):
+        return unbook_room(name, day, hour, duration)
+
+    def move(self, name, from_day, from_hour, from_duration, day, hour, duration):
+        return rebook_room(name, from_day, from_hour, from_duration, day, hour, duration)
+
+    def availability(self, name, day=None):
+        status_code, message = check_availability(name, day)
+        return int(status_code[:3]), message
+
+    def search(self, day, hour, duration):
+        return free_rooms(day, hour, duration)
+
+    def reserve_many(self, bookings, atomic):
+        return reserve_rooms(bookings, atomic)[2]
+
+    def snapshot(self):
+        return {"in_process": True}
+
+
+class RemoteRooms:
+    # the same calls sent to the Room Server over HTTP, or to the shard holding the room
+    # they raise upstream.UpstreamError when the server cannot be reached or gives an unexpected answer
+
+    def reserve(self, name, day, hour, duration):
+        status, _ = room_pool(name).get("/reserve", name=name, day=day, hour=hour, duration=duration)
+        return status
+
+    def release(self, name, day, hour, duration):
+        status, _ = room_pool(name).get("/release", name=name, day=day, hour=hour, duration=duration)
+        return status
+
+    def move(self, name, from_day, from_hour, from_duration, day, hour, duration):
+        # the Room Server frees the old slots and books the new ones in one step
+        status, _ = room_pool(name).get("/move", name=name, from_day=from_day, from_hour=from_hour,
+                                        from_duration=from_duration, day=day, hour=hour, duration=duration)
+        return status
+
+    def availability(self, name, day=None):
+        params = {"name": name}
+        if day is not None:
+            params["day"] = day
+        return room_pool(name).get("/checkavailability", **params)
+
+    def search(self, day, hour, duration):
+        params = {"hour": hour, "duration": duration}
+        if day is not None:
+            params["day"] = day
+        status, data = room_server.get_json("/search", **params)
+        if status == 400:
+            return None
+        try:
+            return {int(free_day): names for free_day, names in data["rooms"].items()}
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise upstream.UpstreamError(f"room server answered {status}")
+
+    def reserve_many(self, bookings, atomic):
+        status, body = room_server.post("/reservemany", json.dumps(bookings), atomic=int(atomic))
+        if status not in (200, 409):
+            raise upstream.UpstreamError(f"room server answered {status}")
+        try:
+            return json.loads(body)["results"]
+        except (ValueError, KeyError, TypeError):
+            raise upstream.UpstreamError("room server sent an invalid reply")
+
+    def snapshot(self):
+        return room_server.snapshot()
+
+
+class LocalActivities:
+    # the activities of this process, looked up directly so they need no cache
+
+    def exists(self, name):
+        return name in activities
+
+    def exists_many(self, names):
+        return dict(zip(names, check_activities(names)))
+
+    def snapshot(self):
+        return {"in_process": True}
+
+
+class RemoteActivities:
+    # asks the Activity Server over HTTP, remembering the answers in activity_cache
+
+    def exists(self, name):
+        exists = activity_cache.get(name)
+        if exists is None:
+            generation = activity_cache.current_generation()
+            status, _ = activity_server.get("/check", name=name)
+            # a shed or failed check says nothing about the activity
+            if status not in (200, 404):
+                raise upstream.UpstreamError(f"activity server answered {status}")
+            exists = status == 200
+            activity_cache.put(name, exists, generation)
+        return exists
+
+    def exists_many(self, names):
+        # {name: whether it exists}, contacting the Activity Server once for every name that is not cached
+        exists = {name: activity_cache.get(name) for name in names}
+        unknown = sorted(name for name, known in exists.items() if known is None)
+        if unknown:
+            generation = activity_cache.current_generation()
+            status, body = activity_server.post("/checkmany", json.dumps(unknown))
+            if status != 200:
+                raise upstream.UpstreamError(f"activity server answered {status}")
+            try:
+                known = json.loads(body)["exists"]
+            except (ValueError, KeyError, TypeError):
+                raise upstream.UpstreamError("activity server sent an invalid reply")
+            for name, found in zip(unknown, known):
+                exists[name] = found
+                activity_cache.put(name, found, generation)
+        return exists
+
+    def snapshot(self):
+        return activity_server.snapshot()
+
+
+# how the reservation server reaches the Room and Activity Servers, set with --services
+room_service = RemoteRooms()
+activity_service = RemoteActivities()
 
 
 def reservation_room(room_name, activity_name, day, hour, duration):
-    # contact the Activity Server to check if the activity exists
-    activity_server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    activity_server_sock.connect(("localhost", 8082))
-    activity_server_request = f"GET /check?name={activity_name}\n"
-    activity_server_sock.send(activity_server_request.encode())
-    activity_server_response = activity_server_sock.recv(1024).decode()
-    if "404 Not Found" in activity_server_response:
-        return "404 Not Found", "Activity does not exist."
-
-    # contact the Room Server to reserve the room
-    room_server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    room_server_sock.connect(("localhost", 8081))
-    room_server_request = f"GET /reserve?name={room_name}&day={day}&hour={hour}&duration={duration}\n"
-    room_server_sock.send(room_server_request.encode())
-    room_server_response = room_server_sock.recv(1024).decode()
-    if "403 Forbidden" in room_server_response:
+    try:
+        # check if the activity exists
+        if not activity_service.exists(activity_name):
+            return "404 Not Found", "Activity does not exist."
+
+        # ask the Room Server to reserve the room
+        status = room_service.reserve(room_name, day, hour, duration)
+    except upstream.UpstreamError:
+        return "502 Bad Gateway", "Could not reach the room or activity server."
+    # only a 200 means the room was booked, anything else must not become a reservation
+    if status == 403:
         return "403 Forbidden", "Room is not available."
+    if status == 404:
+        return "404 Not Found", "Room does not exist."
+    if status == 400:
+        return "400 Bad Request", "Invalid day, hour or duration."
+    if status != 200:
+        return "502 Bad Gateway", "The room server could not reserve the room."
 
     # if the room was successfully reserved, generate a reservation ID and store the reservation
-    reservation_id = len(reservations) + 1
-    reservations[reservation_id] = (room_name, activity_name, day, hour, duration)
-    return "200 OK", f"Room reserved. Reservation ID: {reservation_id}"
+    reservation = reservation_book.add(room_name, activity_name, day, hour, duration)
+    return "200 OK", f"Room reserved. Reservation ID: {reservation.id}"
+
+
+def reservation_batch(items, atomic=True):
+    # reserve many {room, activity, day, hour, duration} items with one call to each upstream server
+    # with atomic set either every item is reserved or none is
+    # returns (status code, whether the batch was committed, result of each item)
+    # the times are converted like /reserve's parameters, so they are stored with the same types
+    results = [None] * len(items)
+    items = list(items)
+    for i, item in enumerate(items):
+        try:
+            day, hour, duration = convert_booking(item["day"], item["hour"], item["duration"])
+        except (TypeError, ValueError):
+            results[i] = {"status": "400 Bad Request", "message": "Invalid day, hour or duration."}
+            continue
+        items[i] = {"room": str(item["room"]), "activity": str(item["activity"]), "day": day, "hour": hour,
+                    "duration": duration}
+    valid = [i for i, result in enumerate(results) if result is None]
+    try:
+        exists = activity_service.exists_many(sorted({items[i]["activity"] for i in valid}))
+        pending = []
+        for i in valid:
+            if exists[items[i]["activity"]]:
+                pending.append(i)
+            else:
+                results[i] = {"status": "404 Not Found", "message": "Activity does not exist."}
+        if pending and not (atomic and len(pending) < len(items)):
+            # one call to the Room Server for the whole batch
+            bookings = [[items[i]["room"], items[i]["day"], items[i]["hour"], items[i]["duration"]]
+                        for i in pending]
+            room_results = room_service.reserve_many(bookings, atomic)
+        else:
+            room_results = []
+    except upstream.UpstreamError:
+        return "502 Bad Gateway", False, results
+
+    booked = [i for i, result in zip(pending, room_results) if result == "200 OK"]
+    committed = not atomic or len(booked) == len(items)
+    for i, result in zip(pending, room_results):
+        if result == "403 Forbidden":
+            results[i] = {"status": result, "message": "Room is not available."}
+        elif result == "404 Not Found":
+            results[i] = {"status": result, "message": "Room does not exist."}
+        elif result == "400 Bad Request":
+            results[i] = {"status": result, "message": "Invalid day, hour or duration."}
+    if not committed:
+        for i, result in enumerate(results):
+            if result is None:
+                results[i] = {"status": "409 Conflict", "message": "Batch was not committed."}
+        return "409 Conflict", False, results
+
+    # store every booked item and wait once for the journal
+    added = reservation_book.add_many([(items[i]["room"], items[i]["activity"], items[i]["day"],
+                                        items[i]["hour"], items[i]["duration"]) for i in booked])
+    for i, reservation in zip(booked, added):
+        results[i] = {"status": "200 OK", "id": reservation.id}
+    return "200 OK", True, results
 
 
 def list_availability(room_name, day=None):
-    # contact the Room Server to get the availability of the room
-    room_server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    room_server_sock.connect(("localhost", 8081))
-    if day is not None:
-        room_server_request = f"GET /checkavailability?name={room_name}&day={day}\n"
-    else:
-        room_server_request = f"GET /checkavailability?name={room_name}\n"
-    room_server_sock.send(room_server_request.encode())
-    room_server_response = room_server_sock.recv(1024).decode()
-    if "404 Not Found" in room_server_response:
+    # ask the Room Server for the availability of the room
+    try:
+        status, body = room_service.availability(room_name, day)
+    except upstream.UpstreamError:
+        return "502 Bad Gateway", "Could not reach the room server."
+    if status == 404:
         return "404 Not Found", "Room does not exist."
-    if "400 Bad Request" in room_server_response:
+    if status == 400:
         return "400 Bad Request", "Invalid input."
-    return "200 OK", room_server_response
+    return "200 OK", body
+
+
+def search_rooms(hour, duration, day=None):
+    # ask the Room Server for the rooms that are free at a time
+    try:
+        found = room_service.search(day, hour, duration)
+    except upstream.UpstreamError:
+        return "502 Bad Gateway", "Could not reach the room server."
+    if found is None:
+        return "400 Bad Request", "Invalid input."
+    return free_rooms_response(found, layout.slot(hour), duration)
+
+
+def cancel_reservation(reservation_id):
+    # free the reservation's slots on the Room Server, then forget it
+    with reservation_book.lock_for(reservation_id):
+        reservation = reservation_book.get(reservation_id)
+        if reservation is None:
+            return "404 Not Found", "Reservation does not exist."
+        try:
+            status = room_service.release(reservation.room, reservation.day, reservation.hour, reservation.duration)
+        except upstream.UpstreamError:
+            return "502 Bad Gateway", "Could not reach the room server."
+        # a room that was removed has no slots left to free
+        if status not in (200, 404):
+            return "502 Bad Gateway", "The room server could not release the room."
+        reservation_book.remove(reservation_id)
+    slots_freed(reservation.room, reservation.day, reservation.hour, reservation.duration)
+    return "200 OK", f"Reservation {reservation_id} cancelled."
+
+
+def modify_reservation(reservation_id, day=None, hour=None, duration=None):
+    # move the reservation to another time in the same room, the parts that are not given stay the same
+    with reservation_book.lock_for(reservation_id):
+        reservation = reservation_book.get(reservation_id)
+        if reservation is None:
+            return "404 Not Found", "Reservation does not exist."
+        day = reservation.day if day is None else day
+        hour = reservation.hour if hour is None else hour
+        duration = reservation.duration if duration is None else duration
+        try:
+            status = room_service.move(reservation.room, reservation.day, reservation.hour, reservation.duration,
+                                       day, hour, duration)
+        except upstream.UpstreamError:
+            return "502 Bad Gateway", "Could not reach the room server."
+        if status == 403:
+            return "403 Forbidden", "Room is not available at this time."
+        if status == 404:
+            return "404 Not Found", "Room does not exist."
+        if status == 400:
+            return "400 Bad Request", "Invalid day, hour or duration."
+        if status != 200:
+            return "502 Bad Gateway", "The room server could not move the reservation."
+        freed = (reservation.room, reservation.day, reservation.hour, reservation.duration)
+        reservation_book.move(reservation, day, hour, duration)
+    slots_freed(*freed)
+    return "200 OK", f"Reservation {reservation_id} moved to day {day} at {hour} for {duration} hours."
+
+
+def book_waiter(waiter):
+    # reserve the slots a waiter wants, called by the waitlist after slots of the room were freed
+    try:
+        status = room_service.reserve(waiter.room, waiter.day, waiter.hour, waiter.duration)
+    except upstream.UpstreamError:
+        return 502, None
+    return record_waiter(waiter, status)
+
+
+def book_waiter_in_process(waiter):
+    # book_waiter for promotions started by the Room Server's own handlers: with --services http,
+    # going through room_service would be a request to the Room Server from inside one of its own
+    return record_waiter(waiter, book_room(waiter.room, waiter.day, waiter.hour, waiter.duration))
+
+
+def record_waiter(waiter, status):
+    if status != 200:
+        return status, None
+    reservation = reservation_book.add(waiter.room, waiter.activity, waiter.day, waiter.hour, waiter.duration)
+    return 200, reservation.id
+
+
+# reservations waiting for booked slots, booked when a cancellation, a change or a release on the
+# Room Server frees them
+reservation_waitlist = waitlist.Waitlist(layout, book_waiter)
+
+
+def slots_freed(room_name, day, hour, duration, book=None):
+    # give slots that were just freed to the waitlist
+    span = layout.span(hour, duration)
+    if span is not None:
+        reservation_waitlist.promote(room_name, layout.day_index(day), *span, book=book)
+
+
+def room_slots_freed(room_name, day, hour, duration):
+    # slots freed by a request to the Room Server, booked for waiters in this process's rooms
+    slots_freed(room_name, day, hour, duration, book_waiter_in_process)
+
+
+def join_waitlist(room_name, activity_name, day, hour, duration, priority=0):
+    # wait for a room that is taken, the reservation is made as soon as its slots are free
+    if layout.span(hour, duration) is None:
+        return "400 Bad Request", "Invalid day, hour or duration."
+    try:
+        if not activity_service.exists(activity_name):
+            return "404 Not Found", "Activity does not exist."
+    except upstream.UpstreamError:
+        return "502 Bad Gateway", "Could not reach the activity server."
+    waiter = reservation_waitlist.add(room_name, activity_name, day, hour, duration, priority)
+    if waiter is None:
+        return "503 Service Unavailable", "The waitlist is full."
+    return waiter_response(waiter)
+
+
+def waitlist_status(waiter_id, wait=0):
+    # the outcome of a waitlist entry, waiting up to wait seconds for it instead of polling
+    waiter = reservation_waitlist.wait(waiter_id, wait)
+    if waiter is None:
+        return "404 Not Found", "Waitlist entry does not exist."
+    return waiter_response(waiter)
+
+
+def leave_waitlist(waiter_id):
+    waiter = reservation_waitlist.cancel(waiter_id)
+    if waiter is None:
+        return "404 Not Found", "Waitlist entry does not exist."
+    if waiter.state != waitlist.CANCELLED:
+        return waiter_response(waiter, "409 Conflict")
+    return waiter_response(waiter)
+
+
+def waiter_response(waiter, status_code=None):
+    # 202 while the entry waits, the reservation id once it was booked
+    if waiter.state == waitlist.BOOKED:
+        message = f"Room reserved. Reservation ID: {waiter.reservation_id}"
+    elif waiter.state in (waitlist.WAITING, waitlist.BOOKING):
+        message = f"Waitlist entry {waiter.id} is waiting for room {waiter.room}."
+    elif waiter.state == waitlist.FAILED:
+        message = f"Waitlist entry {waiter.id} could not be booked, the room or time does not exist."
+    else:
+        message = f"Waitlist entry {waiter.id} is {waiter.state}."
+    if status_code is None:
+        status_code = "202 Accepted" if waiter.state in (waitlist.WAITING, waitlist.BOOKING) else "200 OK"
+    return response.html(status_code, message, waiter.snapshot())
+
+
+def watch_availability(request, room=None, since=None):
+    # the Room Server's availability changes, read straight from the rooms of this process
+    if room_shards:
+        return "501 Not Implemented", "Watch /watchavailability of each room shard when the rooms are sharded."
+    if room_server.address not in (("localhost", 8081), ("127.0.0.1", 8081)):
+        # --room-server points at another process, nothing changes the rooms of this one
+        return "501 Not Implemented", (f"Watch /watchavailability of the room server at "
+                                       f"{room_server.address[0]}:{room_server.address[1]}.")
+    return watch_rooms(request, room, since)
 
 
 def display(reservation_id):
-    if reservation_id not in reservations:
+    reservation = reservation_book.get(reservation_id)
+    if reservation is None:
         return "404 Not Found", "Reservation does not exist."
-    room_name, activity_name, day, hour, duration = reservations[reservation_id]
-    return "200 OK", f"Reservation details:<br>Room name: {room_name}<br>Activity name: {activity_name}<br>Day: {day}<br>Hour: {hour}<br>Duration: {duration}"
-
-
-def reservation_handle_request(request):
-    request_lines = request.split("\n")
-    request_line = request_lines[0]
-    parts = request_line.split(" ")
-    if len(parts) != 3:
-        return "HTTP/1.1 400 Bad Request\n\nInvalid request."
-    request_type, request_url, _ = parts
-    request_params = {}
-    if "?" in request_url:
-        for param in request_url.split("?")[1].split("&"):
-            key, value = param.split("=")
-            request_params[key] = value
-    if request_type == "GET":
-        if request_url.startswith("/reserve"):
-            status_code, message = reservation_room(request_params["room"], request_params["activity"],
-                                                    request_params["day"], request_params["hour"],
-                                                    request_params["duration"])
-            return response_template.format(status_code=status_code, status_message=status_code.split(" ")[1],
-                                            message=message)
-        elif request_url.startswith("/listavailability"):
-            if "room" not in request_params:
-                return "HTTP/1.1 400 Bad Request\n\nInvalid request. Missing 'room' parameter."
-            day = request_params.get("day")
-            status_code, message = list_availability(request_params["room"], day)
-            return response_template.format(status_code=status_code, status_message=status_code.split(" ")[1],
-                                            message=message)
-        elif request_url.startswith("/display"):
-            if "id" not in request_params:
-                return "HTTP/1.1 400 Bad Request\n\nInvalid request. Missing 'id' parameter."
-            reservation_id = int(request_params["id"])
-            status_code, message = display(reservation_id)
-            return response_template.format(status_code=status_code, status_message=status_code.split(" ")[1],
-                                            message=message)
-    return "HTTP/1.1 400 Bad Request\n\nInvalid request."
-
-
-def room_main():
-    port = 8081
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.bind(("localhost", port))
-    sock.listen()
-    print(f"Listening on port {port}...\n")
-    while True:
-        # accept incoming connection and receive request
-        connection, _ = sock.accept()
-        request = connection.recv(1024).decode()
-        print(request)
-        # handle request and send response
-        response = room_handle_request(request)
-        connection.sendall(response.encode())
-        # close connection
-        connection.close()
-
-
-def activity_main():
-    port = 8082
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.bind(("localhost", port))
-    sock.listen()
-    print(f"Listening on port {port}...\n")
-    while True:
-        conn, addr = sock.accept()
-        request = conn.recv(1024).decode()
-        print(request)
-        response = activity_handle_request(request)
-        conn.sendall(response.encode())
-        conn.close()
-
-
-def reservation_main():
-    port = 8080
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.bind(("localhost", port))
-    sock.listen()
-    print(f"Listening on port {port}...\n")
-    while True:
-        connect, address = sock.accept()
-        request = connect.recv(1024).decode()
-        print(f"Received request:\n{request}")
-        response = reservation_handle_request(request)
-        connect.sendall(response.encode())
-        connect.close()
+    return "200 OK", (f"Reservation details:<br>Room name: {reservation.room}<br>Activity name: {reservation.activity}"
+                      f"<br>Day: {reservation.day}<br>Hour: {reservation.hour}<br>Duration: {reservation.duration}")
+
+
+def list_reservations(room=None, activity=None, day=None, after=0, limit=reservations.DEFAULT_PAGE):
+    # a page of the reservations of a room, an activity and/or a day, or of every reservation
+    return reservations.listing(reservation_book, room, activity, day, after, limit)
+
+
+def stats():
+    return response.json_data("200 OK", {"activity_cache": activity_cache.snapshot(),
+                                    "idempotency": idempotency_cache.snapshot(),
+                                    "waitlist": reservation_waitlist.snapshot(),
+                                    "room_server": room_service.snapshot(),
+                                    "activity_server": activity_service.snapshot()})
+
+
+def activity_changed(name):
+    # sent by the Activity Server when an activity is added or removed
+    activity_cache.invalidate(name)
+    return response.json_data("200 OK", {"invalidated": name})
+
+
+def reserve_batch(request, atomic):
+    # body: JSON list of {"room", "activity", "day", "hour", "duration"} objects
+    fields = ("room", "activity", "day", "hour", "duration")
+    try:
+        items = json.loads(request.body)
+        if not isinstance(items, list) or not all(isinstance(item, dict) and all(field in item for field in fields)
+                                                  for item in items):
+            raise ValueError
+    except ValueError:
+        return response.json_data("400 Bad Request", {"error": "Invalid list of reservations."})
+    if atomic:
+        # a bad item is the client's mistake, not a clash, and nothing is reserved for it
+        for i, item in enumerate(items):
+            try:
+                convert_booking(item["day"], item["hour"], item["duration"])
+            except (TypeError, ValueError):
+                return response.json_data("400 Bad Request", {"error": "Invalid day, hour or duration.", "index": i})
+    status_code, committed, results = reservation_batch(items, atomic)
+    return response.json_data(status_code, {"committed": committed, "results": results})
+
+
+def import_reservations(request, format):
+    # body: JSON lines or CSV of room, activity, day, hour and duration, as exported;
+    # the reservations get new ids, and each batch is booked like a non-atomic /reservebatch, which
+    # converts the times like /reserve does whether they came as JSON numbers or CSV text
+    fields = ("room", "activity", "day", "hour", "duration")
+
+    def store_batch(batch):
+        items = [dict(zip(fields, values)) for values in batch]
+        status_code, committed, results = reservation_batch(items, atomic=False)
+        if status_code != "200 OK":
+            return ["Room or Activity Server is not answering."] * len(batch)
+        return [None if result["status"] == "200 OK" else result["message"] for result in results]
+
+    return bulk.load(request.body, format, fields, store_batch)
+
+
+def export_reservations(format):
+    return bulk.dump_reservations(reservation_book, format)
+
+
+# request dispatch of the Reservation Server
+reservation_handle_request = routing.Router()
+# reserving again with the same Idempotency-Key header gives the first answer instead of booking twice
+for method in ("GET", "POST"):
+    reservation_handle_request.add(method, "/reserve", reservation_room, idempotent=idempotency_cache,
+                                   room_name=routing.text(query="room"), activity_name=routing.text(query="activity"),
+                                   day=routing.day(layout), hour=routing.hour(layout), duration=routing.duration(layout))
+    # a reservation that finds the room taken can wait for it instead of polling
+    reservation_handle_request.add(method, "/waitlist", join_waitlist, idempotent=idempotency_cache,
+                                   room_name=routing.text(query="room"), activity_name=routing.text(query="activity"),
+                                   day=routing.day(layout), hour=routing.hour(layout), duration=routing.duration(layout),
+                                   priority=routing.integer(required=False, default=0))
+reservation_handle_request.add("GET", "/waitstatus", waitlist_status, waiter_id=routing.integer(1, query="id"),
+                               wait=routing.integer(0, waitlist.MAX_WAIT, required=False, default=0))
+reservation_handle_request.add("GET", "/waitcancel", leave_waitlist, waiter_id=routing.integer(1, query="id"))
+reservation_handle_request.add("GET", "/listavailability", list_availability, room_name=routing.text(query="room"),
+                               day=routing.day(layout, required=False))
+reservation_handle_request.add("GET", "/watchavailability", watch_availability, with_request=True,
+                               room=routing.text(required=False), since=routing.text(required=False))
+reservation_handle_request.add("GET", "/search", search_rooms, hour=routing.hour(layout),
+                               duration=routing.duration(layout), day=routing.days(layout))
+reservation_handle_request.add("GET", "/display", display, reservation_id=routing.integer(1, query="id"))
+reservation_handle_request.add("GET", "/cancel", cancel_reservation, reservation_id=routing.integer(1, query="id"))
+reservation_handle_request.add("GET", "/modify", modify_reservation, reservation_id=routing.integer(1, query="id"),
+                               day=routing.day(layout, required=False), hour=routing.hour(layout, required=False),
+                               duration=routing.duration(layout, required=False))
+reservation_handle_request.add("GET", "/reservations", list_reservations, room=routing.text(required=False),
+                               activity=routing.text(required=False), day=routing.day(layout, required=False),
+                               after=routing.integer(0, required=False, default=0),
+                               limit=routing.integer(1, reservations.MAX_PAGE, required=False,
+                                                     default=reservations.DEFAULT_PAGE))
+reservation_handle_request.add("GET", "/stats", stats)
+reservation_handle_request.add("POST", "/activitychanged", activity_changed, name=routing.text(required=False))
+reservation_handle_request.add("POST", "/reservebatch", reserve_batch, with_request=True,
+                               idempotent=idempotency_cache, atomic=routing.flag(default=True))
+reservation_handle_request.add("POST", "/import", import_reservations, with_request=True,
+                               format=routing.choice(bulk.FORMATS, default="jsonl"))
+reservation_handle_request.add("GET", "/export", export_reservations,
+                               format=routing.choice(bulk.FORMATS, default="jsonl"))
+reservation_metrics.add_routes(reservation_handle_request.paths())
+
+
+def room_main(**options):
+    serving.serve(8081, room_dispatch if room_shards else room_handle_request, metrics=room_metrics, **options)
+
+
+def room_shard_main(port, directory, args):
+    # one process of a sharded Room Server, owning the rooms the hash ring gives its shard
+    threading.Thread(target=exit_with_parent, args=(os.getppid(),), daemon=True).start()
+    schedule.configure_from_args(layout, args)
+    metrics.configure_from_args(args)
+    rooms.open_journal(directory, args.snapshot_every)
+    serving.serve(port, room_handle_request, metrics=room_metrics, **serving.options_from_args(args, "room"))
+
+
+def exit_with_parent(parent):
+    # shards stop when the main process is gone, however it stopped
+    while os.getppid() == parent:
+        time.sleep(1)
+    os._exit(0)
+
+
+def activity_main(**options):
+    serving.serve(8082, activity_handle_request, metrics=activity_metrics, **options)
+
+
+def reservation_main(**options):
+    serving.serve(8080, reservation_handle_request, metrics=reservation_metrics, **options)
+
+
+def start_room_shards(args):
+    # run the rooms in shard processes, each with its own journal, behind this process's Room Server
+    global room_shards
+    sharding.check_shard_count(args.data_dir, args.room_shards)
+    ports = [args.shard_port + shard for shard in range(args.room_shards)]
+    for shard, port in enumerate(ports):
+        directory = os.path.join(args.data_dir, f"shard-{shard}")
+        multiprocessing.Process(target=room_shard_main, args=(port, directory, args), daemon=True).start()
+    addresses = [("localhost", port) for port in ports]
+    sharding.wait_until_listening(addresses)
+    room_shards = sharding.Shards(addresses, metrics=reservation_metrics, **upstream.options_from_args(args))
+
+
+def configure_services(in_process, sharded=False):
+    # sharded rooms live in other processes, so they are always reached over HTTP
+    global room_service, activity_service
+    room_service = LocalRooms() if in_process and not sharded else RemoteRooms()
+    activity_service = LocalActivities() if in_process else RemoteActivities()
 
 
 def main():
+    # every server can be tuned separately, e.g. --room-mode asyncio --reservation-workers 64
+    parser = argparse.ArgumentParser()
+    serving.add_arguments(parser)
+    for name in ("reservation", "room", "activity"):
+        serving.add_arguments(parser, prefix=name)
+    schedule.add_arguments(parser)
+    journal.add_arguments(parser)
+    metrics.add_arguments(parser)
+    sharding.add_arguments(parser)
+    upstream.add_arguments(parser)
+    parser.add_argument("--services", choices=("in-process", "http"),
+                        help="how the Reservation Server calls the Room and Activity Servers: as functions of this "
+                             "process, or over HTTP like separate servers; in-process unless --room-server or "
+                             "--activity-server is given")
+    parser.add_argument("--room-server", type=upstream.parse_address, help="host:port of the Room Server")
+    parser.add_argument("--activity-server", type=upstream.parse_address, help="host:port of the Activity Server")
+    parser.add_argument("--activity-subscribers", type=upstream.parse_addresses,
+                        help="comma separated host:port of the reservation servers to notify of activity changes, "
+                             "localhost:8080 when the services talk over HTTP")
+    args = parser.parse_args()
+    schedule.configure_from_args(layout, args)
+    room_server.address = args.room_server or room_server.address
+    activity_server.address = args.activity_server or activity_server.address
+    for pool in (room_server, activity_server):
+        pool.configure(**upstream.options_from_args(args))
+    services = args.services or ("http" if args.room_server or args.activity_server else "in-process")
+    in_process = services == "in-process"
+    configure_services(in_process, sharded=bool(args.room_shards))
+    if args.activity_subscribers is None:
+        # a reservation server calling the activities in process has no cache to invalidate
+        args.activity_subscribers = [] if in_process else [("localhost", 8080)]
+    activity_subscribers[:] = [upstream.UpstreamPool(address, timeout=1, metrics=activity_metrics)
+                               for address in args.activity_subscribers]
+    metrics.configure_from_args(args)
+    # long polls of /waitstatus may take a quarter of the reservation server's workers
+    reservation_waitlist.max_pollers = max(1, serving.options_from_args(args, "reservation")["workers"] // 4)
+
+    # reload the saved state before serving
+    if args.room_shards:
+        start_room_shards(args)
+    else:
+        rooms.open_journal(args.data_dir, args.snapshot_every)
+    activities.open_journal(args.data_dir, args.snapshot_every)
+    reservation_book.open_journal(args.data_dir, args.snapshot_every)
+
     # Create three threads
-    thread1 = threading.Thread(target=reservation_main)
-    thread2 = threading.Thread(target=room_main)
-    thread3 = threading.Thread(target=activity_main)
+    thread1 = threading.Thread(target=reservation_main, kwargs=serving.options_from_args(args, "reservation"))
+    thread2 = threading.Thread(target=room_main, kwargs=serving.options_from_args(args, "room"))
+    thread3 = threading.Thread(target=activity_main, kwargs=serving.options_from_args(args, "activity"))
 
     # Start the threads
     thread1.start()
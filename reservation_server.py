@@ -1,100 +1,379 @@
-import socket
+import argparse
+import asyncio
 import sys
 
-# HTTP response template
-response_template = """\
-HTTP/1.1 {status_code} {status_message}
-Content-Type: text/html
+import bulk
+import cache
+import journal
+import metrics
+import reservations
+import response
+import routing
+import schedule
+import serving
+import store
+import upstream
 
-<html>
-  <body>
-    {message}
-  </body>
-</html>
-"""
+# shape of the room schedules, used to validate requests before they reach the Room Server
+layout = schedule.Layout()
 
-# dictionary to store reservations
-reservations = {}
+# reservations by id, room and activity, with their durable log
+reservation_book = reservations.ReservationBook()
+
+# request statistics, served on /metrics
+server_metrics = metrics.Metrics("reservation")
+
+# connection pools to the Room and Activity Servers used by the reservation server
+room_server = upstream.UpstreamPool(("localhost", 8081), metrics=server_metrics)
+activity_server = upstream.UpstreamPool(("localhost", 8082), metrics=server_metrics)
+# the same for --mode asyncio, where the handlers run on the event loop
+async_room_server = upstream.AsyncUpstreamPool(room_server.address, metrics=server_metrics)
+async_activity_server = upstream.AsyncUpstreamPool(activity_server.address, metrics=server_metrics)
+# which activities exist, kept fresh by the Activity Server's change notifications
+activity_cache = cache.TTLCache()
+# answers to reserve requests by idempotency key, for clients and proxies that retry
+idempotency_cache = cache.IdempotencyCache()
+# activity name -> check of the Activity Server in progress, in asyncio mode
+activity_checks = {}
+# serialize changes of one reservation in asyncio mode, where a thread lock would block the loop
+async_reservation_locks = [asyncio.Lock() for _ in range(store.DEFAULT_STRIPES)]
+
+
+def activity_exists(activity_name):
+    # check if the activity exists, contacting the Activity Server only on a cache miss
+    exists = activity_cache.get(activity_name)
+    if exists is None:
+        generation = activity_cache.current_generation()
+        status, _ = activity_server.get("/check", name=activity_name)
+        # a shed or failed check says nothing about the activity
+        if status not in (200, 404):
+            raise upstream.UpstreamError(f"activity server answered {status}")
+        exists = status == 200
+        activity_cache.put(activity_name, exists, generation)
+    return exists
 
 
 def reserve_room(room_name, activity_name, day, hour, duration):
-    # contact the Activity Server to check if the activity exists
-    activity_server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    activity_server_sock.connect(("localhost", 8082))
-    activity_server_request = f"GET /check?name={activity_name}\n"
-    activity_server_sock.send(activity_server_request.encode())
-    activity_server_response = activity_server_sock.recv(1024).decode()
-    if "404 Not Found" in activity_server_response:
-        return "404 Not Found", "Activity does not exist."
+    try:
+        # check if the activity exists
+        if not activity_exists(activity_name):
+            return "404 Not Found", "Activity does not exist."
 
-    # contact the Room Server to reserve the room
-    room_server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    room_server_sock.connect(("localhost", 8081))
-    room_server_request = f"GET /reserve?name={room_name}&day={day}&hour={hour}&duration={duration}\n"
-    room_server_sock.send(room_server_request.encode())
-    room_server_response = room_server_sock.recv(1024).decode()
-    if "403 Forbidden" in room_server_response:
+        # contact the Room Server to reserve the room
+        status, _ = room_server.get("/reserve", name=room_name, day=day, hour=hour, duration=duration)
+    except upstream.UpstreamError:
+        return "502 Bad Gateway", "Could not reach the room or activity server."
+    # only a 200 means the room was booked, anything else must not become a reservation
+    if status == 403:
         return "403 Forbidden", "Room is not available."
+    if status == 404:
+        return "404 Not Found", "Room does not exist."
+    if status == 400:
+        return "400 Bad Request", "Invalid day, hour or duration."
+    if status != 200:
+        return "502 Bad Gateway", "The room server could not reserve the room."
 
-    # if the room was successfully reserved, generate a reservation ID and store the reservation
-    reservation_id = len(reservations) + 1
-    reservations[reservation_id] = (room_name, activity_name, day, hour, duration)
-    return "200 OK", f"Room reserved. Reservation ID: {reservation_id}"
+    # if the room was successfully reserved, store the reservation under a new ID
+    reservation = reservation_book.add(room_name, activity_name, day, hour, duration)
+    return "200 OK", f"Room reserved. Reservation ID: {reservation.id}"
 
 
 def list_availability(room_name, day=None):
     # contact the Room Server to get the availability of the room
-    room_server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    room_server_sock.connect(("localhost", 8081))
+    params = {"name": room_name}
     if day is not None:
-        room_server_request = f"GET /checkavailability?name={room_name}&day={day}\n"
-    else:
-        room_server_request = f"GET /checkavailability?name={room_name}\n"
-    room_server_sock.send(room_server_request.encode())
-    room_server_response = room_server_sock.recv(1024).decode()
-    if "404 Not Found" in room_server_response:
+        params["day"] = day
+    try:
+        status, body = room_server.get("/checkavailability", **params)
+    except upstream.UpstreamError:
+        return "502 Bad Gateway", "Could not reach the room server."
+    if status == 404:
         return "404 Not Found", "Room does not exist."
-    if "400 Bad Request" in room_server_response:
+    if status == 400:
         return "400 Bad Request", "Invalid input."
-    return "200 OK", room_server_response
+    return "200 OK", body
+
+
+def search_rooms(hour, duration, day=None):
+    # contact the Room Server to find the rooms that are free at a time
+    params = {"hour": hour, "duration": duration}
+    if day is not None:
+        params["day"] = day
+    try:
+        status, body = room_server.get("/search", **params)
+    except upstream.UpstreamError:
+        return "502 Bad Gateway", "Could not reach the room server."
+    if status == 400:
+        return "400 Bad Request", "Invalid input."
+    return "200 OK", body
+
+
+def cancel_reservation(reservation_id):
+    # free the reservation's slots on the Room Server, then forget it
+    with reservation_book.lock_for(reservation_id):
+        reservation = reservation_book.get(reservation_id)
+        if reservation is None:
+            return "404 Not Found", "Reservation does not exist."
+        try:
+            status, _ = room_server.get("/release", name=reservation.room, day=reservation.day,
+                                        hour=reservation.hour, duration=reservation.duration)
+        except upstream.UpstreamError:
+            return "502 Bad Gateway", "Could not reach the room server."
+        # a room that was removed has no slots left to free
+        if status not in (200, 404):
+            return "502 Bad Gateway", "The room server could not release the room."
+        reservation_book.remove(reservation_id)
+    return "200 OK", f"Reservation {reservation_id} cancelled."
+
+
+def modify_reservation(reservation_id, day=None, hour=None, duration=None):
+    # move the reservation to another time in the same room, the parts that are not given stay the same
+    with reservation_book.lock_for(reservation_id):
+        reservation = reservation_book.get(reservation_id)
+        if reservation is None:
+            return "404 Not Found", "Reservation does not exist."
+        day = reservation.day if day is None else day
+        hour = reservation.hour if hour is None else hour
+        duration = reservation.duration if duration is None else duration
+        try:
+            # the Room Server frees the old slots and books the new ones in one step
+            status, _ = room_server.get("/move", name=reservation.room, from_day=reservation.day,
+                                        from_hour=reservation.hour, from_duration=reservation.duration,
+                                        day=day, hour=hour, duration=duration)
+        except upstream.UpstreamError:
+            return "502 Bad Gateway", "Could not reach the room server."
+        if status == 403:
+            return "403 Forbidden", "Room is not available at this time."
+        if status == 404:
+            return "404 Not Found", "Room does not exist."
+        if status == 400:
+            return "400 Bad Request", "Invalid day, hour or duration."
+        if status != 200:
+            return "502 Bad Gateway", "The room server could not move the reservation."
+        reservation_book.move(reservation, day, hour, duration)
+    return "200 OK", f"Reservation {reservation_id} moved to day {day} at {hour} for {duration} hours."
 
 
 def display(reservation_id):
-    if reservation_id not in reservations:
+    reservation = reservation_book.get(reservation_id)
+    if reservation is None:
         return "404 Not Found", "Reservation does not exist."
-    room_name, activity_name, day, hour, duration = reservations[reservation_id]
-    return "200 OK", f"Reservation details:<br>Room name: {room_name}<br>Activity name: {activity_name}<br>Day: {day}<br>Hour: {hour}<br>Duration: {duration}"
-
-
-def handle_request(request):
-    request_lines = request.split("\n")
-    request_line = request_lines[0]
-    parts = request_line.split(" ")
-    if len(parts) != 3:
-        return "HTTP/1.1 400 Bad Request\n\nInvalid request."
-    request_type, request_url, _ = parts
-    request_params = {}
-    if "?" in request_url:
-        for param in request_url.split("?")[1].split("&"):
-            key, value = param.split("=")
-            request_params[key] = value
-    if request_type == "GET":
-        if request_url.startswith("/reserve"):
-            status_code, message = reserve_room(request_params["room"], request_params["activity"],
-                                                request_params["day"], request_params["hour"],
-                                                request_params["duration"])
-            return response_template.format(status_code=status_code, status_message=status_code.split(" ")[1],message=message)
-        elif request_url.startswith("/listavailability"):
-            if "day" in request_params:
-                status_code, message = list_availability(request_params["room"], request_params["day"])
-            else:
-                status_code, message = list_availability(request_params["room"])
-            return response_template.format(status_code=status_code, status_message=status_code.split(" ")[1],message=message)
-        elif request_url.startswith("/display"):
-            status_code, message = display(int(request_params["id"]))
-            return response_template.format(status_code=status_code, status_message=status_code.split(" ")[1],message=message)
-
-    return "HTTP/1.1 400 Bad Request\n\nInvalid request."
+    return "200 OK", (f"Reservation details:<br>Room name: {reservation.room}<br>Activity name: {reservation.activity}"
+                      f"<br>Day: {reservation.day}<br>Hour: {reservation.hour}<br>Duration: {reservation.duration}")
+
+
+def list_reservations(room=None, activity=None, day=None, after=0, limit=reservations.DEFAULT_PAGE):
+    # a page of the reservations of a room, an activity and/or a day, or of every reservation
+    return reservations.listing(reservation_book, room, activity, day, after, limit)
+
+
+def stats(room_pool=room_server, activity_pool=activity_server):
+    stats = {"activity_cache": activity_cache.snapshot(), "idempotency": idempotency_cache.snapshot(),
+             "room_server": room_pool.snapshot(), "activity_server": activity_pool.snapshot()}
+    return response.json_data("200 OK", stats)
+
+
+def activity_changed(name):
+    # sent by the Activity Server when an activity is added or removed
+    activity_cache.invalidate(name)
+    return response.text("200 OK", "Invalidated.")
+
+
+def export_reservations(format):
+    return bulk.dump_reservations(reservation_book, format)
+
+
+handle_request = routing.Router()
+# reserving again with the same Idempotency-Key header gives the first answer instead of booking twice
+for method in ("GET", "POST"):
+    handle_request.add(method, "/reserve", reserve_room, idempotent=idempotency_cache,
+                       room_name=routing.text(query="room"), activity_name=routing.text(query="activity"),
+                       day=routing.day(layout), hour=routing.hour(layout), duration=routing.duration(layout))
+handle_request.add("GET", "/listavailability", list_availability, room_name=routing.text(query="room"),
+                   day=routing.day(layout, required=False))
+handle_request.add("GET", "/search", search_rooms, hour=routing.hour(layout), duration=routing.duration(layout),
+                   day=routing.days(layout))
+handle_request.add("GET", "/display", display, reservation_id=routing.integer(1, query="id"))
+handle_request.add("GET", "/cancel", cancel_reservation, reservation_id=routing.integer(1, query="id"))
+handle_request.add("GET", "/modify", modify_reservation, reservation_id=routing.integer(1, query="id"),
+                   day=routing.day(layout, required=False), hour=routing.hour(layout, required=False),
+                   duration=routing.duration(layout, required=False))
+handle_request.add("GET", "/reservations", list_reservations, room=routing.text(required=False),
+                   activity=routing.text(required=False), day=routing.day(layout, required=False),
+                   after=routing.integer(0, required=False, default=0),
+                   limit=routing.integer(1, reservations.MAX_PAGE, required=False,
+                                         default=reservations.DEFAULT_PAGE))
+handle_request.add("GET", "/stats", stats)
+handle_request.add("POST", "/activitychanged", activity_changed, name=routing.text(required=False))
+handle_request.add("GET", "/export", export_reservations, format=routing.choice(bulk.FORMATS, default="jsonl"))
+server_metrics.add_routes(handle_request.paths())
+
+
+# asyncio mode: the handlers that call other servers are coroutines and wait on non-blocking
+# connections, so one thread serves any number of clients; the others only read memory and are
+# shared with the thread modes. Writes to the reservation journal wait on a worker thread.
+
+async def activity_exists_async(activity_name):
+    exists = activity_cache.get(activity_name)
+    if exists is not None:
+        return exists
+    # requests that miss the cache for the same activity at the same time share one check
+    check = activity_checks.get(activity_name)
+    if check is None:
+        check = activity_checks[activity_name] = asyncio.ensure_future(check_activity(activity_name))
+        check.add_done_callback(lambda _: activity_checks.pop(activity_name, None))
+    return await asyncio.shield(check)
+
+
+async def check_activity(activity_name):
+    generation = activity_cache.current_generation()
+    status, _ = await async_activity_server.get("/check", name=activity_name)
+    # a shed or failed check says nothing about the activity
+    if status not in (200, 404):
+        raise upstream.UpstreamError(f"activity server answered {status}")
+    exists = status == 200
+    activity_cache.put(activity_name, exists, generation)
+    return exists
+
+
+async def reserve_room_async(room_name, activity_name, day, hour, duration):
+    # unless the activity is cached, book the room while the Activity Server is asked instead of
+    # after it; the booking is provisional and released again if the activity does not exist
+    exists = activity_cache.get(activity_name)
+    if exists is False:
+        return "404 Not Found", "Activity does not exist."
+    booking = dict(name=room_name, day=day, hour=hour, duration=duration)
+    calls = [async_room_server.get("/reserve", **booking)]
+    if exists is None:
+        calls.append(activity_exists_async(activity_name))
+    held, *checked = await asyncio.gather(*calls, return_exceptions=True)
+    if checked:
+        exists = checked[0]
+    status = None if isinstance(held, BaseException) else held[0]
+    # the slots are held until the reservation is stored, whatever goes wrong before that
+    holding = status == 200
+    try:
+        for result in (held, exists):
+            if isinstance(result, BaseException) and not isinstance(result, upstream.UpstreamError):
+                raise result
+        if exists is not True:
+            if holding:
+                holding = False
+                try:
+                    await async_room_server.get("/release", **booking)
+                except upstream.UpstreamError:
+                    return "502 Bad Gateway", "Could not release the room after a failed reservation."
+            if exists is False:
+                return "404 Not Found", "Activity does not exist."
+            return "502 Bad Gateway", "Could not reach the activity server."
+        if status is None:
+            return "502 Bad Gateway", "Could not reach the room server."
+        if status == 403:
+            return "403 Forbidden", "Room is not available."
+        if status == 404:
+            return "404 Not Found", "Room does not exist."
+        if status == 400:
+            return "400 Bad Request", "Invalid day, hour or duration."
+        if status != 200:
+            return "502 Bad Gateway", "The room server could not reserve the room."
+        reservation = await asyncio.to_thread(reservation_book.add, room_name, activity_name, day, hour, duration)
+        holding = False
+        return "200 OK", f"Room reserved. Reservation ID: {reservation.id}"
+    finally:
+        if holding:
+            try:
+                await async_room_server.get("/release", **booking)
+            except upstream.UpstreamError:
+                pass
+
+
+async def list_availability_async(room_name, day=None):
+    params = {"name": room_name}
+    if day is not None:
+        params["day"] = day
+    try:
+        status, body = await async_room_server.get("/checkavailability", **params)
+    except upstream.UpstreamError:
+        return "502 Bad Gateway", "Could not reach the room server."
+    if status == 404:
+        return "404 Not Found", "Room does not exist."
+    if status == 400:
+        return "400 Bad Request", "Invalid input."
+    return "200 OK", body
+
+
+async def search_rooms_async(hour, duration, day=None):
+    params = {"hour": hour, "duration": duration}
+    if day is not None:
+        params["day"] = day
+    try:
+        status, body = await async_room_server.get("/search", **params)
+    except upstream.UpstreamError:
+        return "502 Bad Gateway", "Could not reach the room server."
+    if status == 400:
+        return "400 Bad Request", "Invalid input."
+    return "200 OK", body
+
+
+async def cancel_reservation_async(reservation_id):
+    async with async_reservation_locks[reservation_id % len(async_reservation_locks)]:
+        reservation = reservation_book.get(reservation_id)
+        if reservation is None:
+            return "404 Not Found", "Reservation does not exist."
+        try:
+            status, _ = await async_room_server.get("/release", name=reservation.room, day=reservation.day,
+                                                    hour=reservation.hour, duration=reservation.duration)
+        except upstream.UpstreamError:
+            return "502 Bad Gateway", "Could not reach the room server."
+        # a room that was removed has no slots left to free
+        if status not in (200, 404):
+            return "502 Bad Gateway", "The room server could not release the room."
+        await asyncio.to_thread(reservation_book.remove, reservation_id)
+    return "200 OK", f"Reservation {reservation_id} cancelled."
+
+
+async def modify_reservation_async(reservation_id, day=None, hour=None, duration=None):
+    async with async_reservation_locks[reservation_id % len(async_reservation_locks)]:
+        reservation = reservation_book.get(reservation_id)
+        if reservation is None:
+            return "404 Not Found", "Reservation does not exist."
+        day = reservation.day if day is None else day
+        hour = reservation.hour if hour is None else hour
+        duration = reservation.duration if duration is None else duration
+        try:
+            status, _ = await async_room_server.get("/move", name=reservation.room, from_day=reservation.day,
+                                                    from_hour=reservation.hour, from_duration=reservation.duration,
+                                                    day=day, hour=hour, duration=duration)
+        except upstream.UpstreamError:
+            return "502 Bad Gateway", "Could not reach the room server."
+        if status == 403:
+            return "403 Forbidden", "Room is not available at this time."
+        if status == 404:
+            return "404 Not Found", "Room does not exist."
+        if status == 400:
+            return "400 Bad Request", "Invalid day, hour or duration."
+        if status != 200:
+            return "502 Bad Gateway", "The room server could not move the reservation."
+        await asyncio.to_thread(reservation_book.move, reservation, day, hour, duration)
+    return "200 OK", f"Reservation {reservation_id} moved to day {day} at {hour} for {duration} hours."
+
+
+async_handle_request = routing.AsyncRouter()
+for method, path, handler in (("GET", "/reserve", reserve_room_async),
+                              ("POST", "/reserve", reserve_room_async),
+                              ("GET", "/listavailability", list_availability_async),
+                              ("GET", "/search", search_rooms_async),
+                              ("GET", "/display", display),
+                              ("GET", "/cancel", cancel_reservation_async),
+                              ("GET", "/modify", modify_reservation_async),
+                              ("GET", "/reservations", list_reservations),
+                              ("GET", "/stats", lambda: stats(async_room_server, async_activity_server)),
+                              ("POST", "/activitychanged", activity_changed),
+                              ("GET", "/export", export_reservations)):
+    # same parameters as the thread modes' routes
+    route = handle_request.routes[path][method]
+    async_handle_request.add(method, path, handler, route.with_request, route.idempotent,
+                             **{argument: param for argument, param in route.params.values()})
 
 
 def main():
@@ -102,17 +381,27 @@ def main():
         print("Please specify a port number as an argument.")
         return
     port = int(sys.argv[1])
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.bind(("localhost", port))
-    sock.listen()
-    print(f"Listening on port {port}...")
-    while True:
-        connection, _ = sock.accept()
-        request = connection.recv(1024).decode()
-        print(f"Received request:\n{request}")
-        response = handle_request(request)
-        connection.send(response.encode())
-        connection.close()
+    parser = argparse.ArgumentParser()
+    serving.add_arguments(parser)
+    schedule.add_arguments(parser)
+    journal.add_arguments(parser)
+    metrics.add_arguments(parser)
+    upstream.add_arguments(parser)
+    parser.add_argument("--room-server", type=upstream.parse_address, default=room_server.address,
+                        help="host:port of the Room Server")
+    parser.add_argument("--activity-server", type=upstream.parse_address, default=activity_server.address,
+                        help="host:port of the Activity Server")
+    args = parser.parse_args(sys.argv[2:])
+    schedule.configure_from_args(layout, args)
+    room_server.address = async_room_server.address = args.room_server
+    activity_server.address = async_activity_server.address = args.activity_server
+    for pool in (room_server, activity_server, async_room_server, async_activity_server):
+        pool.configure(**upstream.options_from_args(args))
+    metrics.configure_from_args(args)
+    reservation_book.open_journal(args.data_dir, args.snapshot_every)
+    options = serving.options_from_args(args)
+    handler = async_handle_request if options["mode"] == "asyncio" else handle_request
+    serving.serve(port, handler, metrics=server_metrics, **options)
 
 
 if __name__ == "__main__":
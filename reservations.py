@@ -0,0 +1,214 @@
+import threading
+from bisect import bisect_left, bisect_right, insort
+from urllib.parse import urlencode
+
+import journal
+import response
+import store
+
+# reservation fields with an index of the ids that have each value
+INDEXED = ("room", "activity", "day")
+# reservations read from the book at a time while a listing is sent
+CHUNK = 100
+# reservations in a listing page when the request does not say
+DEFAULT_PAGE = 1000
+MAX_PAGE = 100000
+# the HTML page around a streamed listing
+HTML_START, HTML_END = (part.encode() for part in response.HTML_TEMPLATE.split("{message}"))
+
+
+class Reservation:
+    # one booking of a room for an activity, day is the 1-based day number
+
+    __slots__ = ("id", "room", "activity", "day", "hour", "duration")
+
+    def __init__(self, reservation_id, room, activity, day, hour, duration):
+        self.id = reservation_id
+        self.room = room
+        self.activity = activity
+        self.day = day
+        self.hour = hour
+        self.duration = duration
+
+    def record(self):
+        # journal record that recreates the reservation
+        return ["reserve", self.id, self.room, self.activity, self.day, self.hour, self.duration]
+
+
+class ReservationBook:
+    # reservations by id, with indexes of the ids of every room, activity and day
+    #
+    # the indexes map a value to a sorted list of ids, so a page of the reservations of a room
+    # starting after some id is found with a binary search and costs O(log n + page) however many
+    # reservations there are. Ids are handed out in increasing order, so adding a reservation
+    # appends to the lists. Changes of one reservation are serialized with lock_for(id), which
+    # callers hold while they also change the room server, so that two cancellations cannot both
+    # release the slots.
+
+    def __init__(self):
+        self.by_id = {}
+        # every id, sorted
+        self.order = []
+        # field -> value -> sorted ids
+        self.indexes = {field: {} for field in INDEXED}
+        self.ids = store.IdAllocator()
+        self.stripes = store.LockStripes()
+        # guards the dicts and lists, held only for the in-memory updates and reads
+        self.lock = threading.Lock()
+        self.journal = journal.Journal("reservations")
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def lock_for(self, reservation_id):
+        return self.stripes.lock(reservation_id)
+
+    def get(self, reservation_id):
+        return self.by_id.get(reservation_id)
+
+    def page(self, after=0, limit=CHUNK, room=None, activity=None, day=None):
+        # up to limit reservations with an id above after, in id order, that have the given room,
+        # activity and day; only the shortest of the matching indexes is walked
+        filters = [(field, value) for field, value in zip(INDEXED, (room, activity, day)) if value is not None]
+        found = []
+        with self.lock:
+            ids = min((self.indexes[field].get(value, ()) for field, value in filters), key=len,
+                      default=self.order)
+            for position in range(bisect_right(ids, after), len(ids)):
+                reservation = self.by_id[ids[position]]
+                if all(getattr(reservation, field) == value for field, value in filters):
+                    found.append(reservation)
+                    if len(found) == limit:
+                        break
+        return found
+
+    def add(self, room, activity, day, hour, duration):
+        # store a new reservation and wait until it is durable
+        return self.add_many([(room, activity, day, hour, duration)])[0]
+
+    def add_many(self, bookings):
+        # store a list of (room, activity, day, hour, duration) with one journal wait
+        added = []
+        sequence = 0
+        for booking in bookings:
+            reservation = Reservation(self.ids.allocate(), *booking)
+            # queued under the lock, so that a cancel of the same id cannot reach the journal first
+            with self.lock:
+                self.insert(reservation)
+                sequence = self.journal.append(reservation.record())
+            added.append(reservation)
+        self.journal.wait(sequence)
+        return added
+
+    def remove(self, reservation_id):
+        # drop a reservation, returns it or None if there is none with this id
+        with self.lock:
+            reservation = self.by_id.get(reservation_id)
+            if reservation is None:
+                return None
+            self.delete(reservation)
+            sequence = self.journal.append(["cancel", reservation_id])
+        self.journal.wait(sequence)
+        return reservation
+
+    def move(self, reservation, day, hour, duration):
+        # change the time of a reservation, the caller holds lock_for(reservation.id)
+        with self.lock:
+            self.unindex(reservation)
+            reservation.day = day
+            reservation.hour = hour
+            reservation.duration = duration
+            self.index(reservation)
+            sequence = self.journal.append(reservation.record())
+        self.journal.wait(sequence)
+
+    def insert(self, reservation):
+        # needs self.lock, replaces a reservation with the same id
+        previous = self.by_id.get(reservation.id)
+        if previous is None:
+            insort(self.order, reservation.id)
+        else:
+            self.unindex(previous)
+        self.by_id[reservation.id] = reservation
+        self.index(reservation)
+
+    def delete(self, reservation):
+        # needs self.lock
+        del self.by_id[reservation.id]
+        del self.order[bisect_left(self.order, reservation.id)]
+        self.unindex(reservation)
+
+    def index(self, reservation):
+        for field, index in self.indexes.items():
+            insort(index.setdefault(getattr(reservation, field), []), reservation.id)
+
+    def unindex(self, reservation):
+        for field, index in self.indexes.items():
+            value = getattr(reservation, field)
+            ids = index[value]
+            del ids[bisect_left(ids, reservation.id)]
+            if not ids:
+                del index[value]
+
+    def open_journal(self, directory, snapshot_every=journal.DEFAULT_SNAPSHOT_EVERY):
+        self.journal.open(directory, self.apply, self.dump, snapshot_every)
+
+    def apply(self, record):
+        # replay one journal record
+        if record[0] == "reserve":
+            # older journals kept the day as it was typed in the request
+            reservation_id, room, activity, day, hour, duration = record[1:]
+            reservation = Reservation(reservation_id, room, activity, int(day), hour, duration)
+            self.insert(reservation)
+            self.ids.advance(reservation.id)
+        elif record[0] == "cancel":
+            reservation = self.by_id.get(record[1])
+            if reservation is not None:
+                self.delete(reservation)
+            self.ids.advance(record[1])
+
+    def dump(self):
+        # journal records that recreate every reservation
+        with self.lock:
+            return [reservation.record() for reservation in self.by_id.values()]
+
+
+def listing(book, room=None, activity=None, day=None, after=0, limit=DEFAULT_PAGE):
+    # a page of the reservations matching the filters, streamed CHUNK reservations at a time so that
+    # neither the book nor the response holds the page as a whole; it ends with the id to pass
+    # as after for the next page, if there is one
+    def produce(as_json):
+        yield b'{"reservations":[' if as_json else HTML_START
+        separator = b"," if as_json else b"<br>"
+        last = after
+        count = 0
+        while count < limit:
+            wanted = min(CHUNK, limit - count)
+            found = book.page(last, wanted, room, activity, day)
+            if found:
+                if as_json:
+                    chunk = separator.join(response.encode_json(reservation.record()[1:]) for reservation in found)
+                else:
+                    chunk = "<br>".join(f"Reservation {reservation.id}: room {reservation.room}, activity "
+                                        f"{reservation.activity}, day {reservation.day} at {reservation.hour} for "
+                                        f"{reservation.duration} hours" for reservation in found).encode()
+                yield separator + chunk if count else chunk
+                count += len(found)
+                last = found[-1].id
+            if len(found) < wanted:
+                break
+        more = count == limit and book.page(last, 1, room, activity, day)
+        if as_json:
+            yield b'],"next":%s}' % (str(last).encode() if more else b"null")
+            return
+        if not count:
+            yield b"There are no reservations."
+        if more:
+            filters = {name: value for name, value in (("room", room), ("activity", activity), ("day", day))
+                       if value is not None}
+            query = urlencode(dict(filters, after=last, limit=limit))
+            yield f'<br><a href="/reservations?{query}">Next page</a>'.encode()
+        yield HTML_END
+
+    return response.Stream("200 OK", produce)
+
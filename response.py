@@ -0,0 +1,156 @@
+import json
+from http import HTTPStatus
+
+# page every HTML response is wrapped in
+HTML_TEMPLATE = """\
+<html>
+  <body>
+    {message}
+  </body>
+</html>
+"""
+
+HTML = b"Content-Type: text/html; charset=utf-8\r\n"
+JSON = b"Content-Type: application/json\r\n"
+TEXT = b"Content-Type: text/plain; charset=utf-8\r\n"
+KEEP_ALIVE = b"Connection: keep-alive\r\n"
+CLOSE = b"Connection: close\r\n"
+CHUNKED = b"Transfer-Encoding: chunked\r\n"
+
+# encoded status lines, filled in as status codes are used
+status_lines = {}
+
+
+def status_line(status_code):
+    # b"HTTP/1.1 200 OK\r\n" for "200 OK"
+    line = status_lines.get(status_code)
+    if line is None:
+        line = status_lines[status_code] = f"HTTP/1.1 {status_code}\r\n".encode()
+    return line
+
+
+class Response:
+    # response whose body is encoded once, when it is created
+    #
+    # status_code is a "200 OK" string like everywhere else in the servers, content_type an
+    # encoded header line and headers further (name, value) pairs. A response made from a
+    # message keeps it, so that a client asking for JSON can get it as {"status", "message"},
+    # or as data when the response has a machine-readable form of the message.
+
+    __slots__ = ("status_code", "body", "content_type", "headers", "message", "data")
+
+    def __init__(self, status_code, body, content_type, headers=(), message=None, data=None):
+        self.status_code = status_code
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers
+        self.message = message
+        self.data = data
+
+    @property
+    def status(self):
+        return int(self.status_code[:3])
+
+    def with_header(self, name, value):
+        # copy of the response with one more header, responses can be shared so they are not changed
+        return Response(self.status_code, self.body, self.content_type, (*self.headers, (name, value)),
+                        self.message, self.data)
+
+    def negotiate(self, request):
+        # the response in the format the request accepts
+        if self.message is not None and wants_json(request):
+            data = self.data if self.data is not None else {"status": self.status, "message": self.message}
+            return Response(self.status_code, encode_json(data), JSON, self.headers)
+        return self
+
+    def encode(self, keep_alive):
+        # (head, body) byte strings, so the body is sent as it is instead of being copied into the head
+        return self.head(b"Content-Length: %d\r\n" % len(self.body), keep_alive), self.body
+
+    def head(self, framing, keep_alive):
+        # status line and headers, framing is the header line that says where the body ends
+        head = [status_line(self.status_code), self.content_type]
+        for name, value in self.headers:
+            head.append(f"{name}: {value}\r\n".encode())
+        head.append(framing)
+        head.append(KEEP_ALIVE if keep_alive else CLOSE)
+        head.append(b"\r\n")
+        return b"".join(head)
+
+
+class Stream(Response):
+    # response whose body is produced while it is sent, in HTTP/1.1 chunks, so that a long listing
+    # is never held in memory as a whole
+    #
+    # produce(as_json) returns an iterator of byte strings, the body as HTML or as JSON. encode()
+    # returns the head and a generator of the framed chunks, which the server sends as they come.
+
+    __slots__ = ("produce", "as_json")
+
+    def __init__(self, status_code, produce, content_type=HTML, headers=(), as_json=False):
+        super().__init__(status_code, None, content_type, headers)
+        self.produce = produce
+        self.as_json = as_json
+
+    def negotiate(self, request):
+        as_json = wants_json(request)
+        content_type = JSON if as_json else self.content_type
+        if request.version != "HTTP/1.1":
+            # HTTP/1.0 has no chunked encoding, the body is sent in one piece
+            return Response(self.status_code, b"".join(self.produce(as_json)), content_type, self.headers)
+        return Stream(self.status_code, self.produce, content_type, self.headers, as_json)
+
+    def encode(self, keep_alive):
+        return self.head(CHUNKED, keep_alive), self.chunks()
+
+    def chunks(self):
+        for chunk in self.produce(self.as_json):
+            if chunk:
+                yield b"%x\r\n%s\r\n" % (len(chunk), chunk)
+        yield b"0\r\n\r\n"
+
+
+def wants_json(request):
+    # whether the Accept header prefers JSON over HTML
+    accept = request.headers.get("accept")
+    if not accept or "application/json" not in accept:
+        return False
+    html = accept.find("text/html")
+    return html < 0 or accept.find("application/json") < html
+
+
+def encode_json(data):
+    return json.dumps(data, separators=(",", ":")).encode()
+
+
+def html(status_code, message, data=None):
+    # HTML page with a message, also available as JSON
+    return Response(status_code, HTML_TEMPLATE.format(message=message).encode(), HTML, message=message, data=data)
+
+
+def json_data(status_code, data):
+    # JSON body, used by the endpoints that are called by programs
+    return Response(status_code, encode_json(data), JSON)
+
+
+def text(status_code, message, content_type=TEXT):
+    return Response(status_code, message.encode(), content_type)
+
+
+def status_code_of(status):
+    # "200 OK" for 200
+    try:
+        return f"{status} {HTTPStatus(status).phrase}"
+    except ValueError:
+        return str(status)
+
+
+def relayed(status, headers, body):
+    # response received from another server, passed on as it is
+    content_type = headers.get("content-type")
+    content_type = f"Content-Type: {content_type}\r\n".encode() if content_type else TEXT
+    return Response(status_code_of(status), body.encode(), content_type)
+
+
+# answer to a request whose handler raised, encoded once
+INTERNAL_ERROR = text("500 Internal Server Error", "Internal server error.")
@@ -1,110 +1,169 @@
-import socket
-
-# database of rooms and their availability
+import argparse
 import sys
 
-rooms = {}
+import availability
+import bulk
+import feed
+import journal
+import metrics
+import routing
+import schedule
+import serving
+import store
 
-# HTTP response template
-response_template = """\
-HTTP/1.1 200 OK
-Content-Type: text/html
+# shape of every room schedule
+layout = schedule.Layout()
 
-<html>
-  <body>
-    {message}
-  </body>
-</html>
-"""
+# database of rooms and their availability
+rooms = store.RoomStore(layout)
+# request statistics, served on /metrics
+server_metrics = metrics.Metrics("room")
 
 
 def add_room(name):
     # add room to database if it doesn't already exist
-    if name not in rooms:
-        rooms[name] = [[False for _ in range(9, 18)] for _ in range(7)]
-        return True
-    return False
+    return rooms.add(name)
 
 
 def remove_room(name):
     # remove room from database if it exists
-    if name in rooms:
-        del rooms[name]
-        return True
-    return False
+    return rooms.remove(name)
 
 
 def reserve_room(name, day, hour, duration):
-    # reserve room if it exists and is available
-    if name in rooms:
-        day = int(day) - 1
-        hour = int(hour) - 9
-        duration = int(duration)
-        for i in range(hour, hour + duration):
-            if rooms[name][day][i]:
-                return False
-        for i in range(hour, hour + duration):
-            rooms[name][day][i] = True
-        return True
-    return False
-
-
-def check_availability(name, day):
-    # check availability of room if it exists
-    if name in rooms:
-        day = int(day) - 1
-        hours = []
-        for i, is_available in enumerate(rooms[name][day]):
-            if not is_available:
-                hours.append(str(i + 9))
-        return hours
-    return None
-
-
-def handle_request(request):
-    # parse request and call appropriate function
-    request_lines = request.split("\n")
-    request_line = request_lines[0]
-    parts = request_line.split(" ")
-    if len(parts) != 3:
-        return "HTTP/1.1 400 Bad Request\n\nInvalid request."
-    request_type, request_url, _ = parts
-    request_params = {}
-    if "?" in request_url:
-        for param in request_url.split("?")[1].split("&"):
-            key, value = param.split("=")
-            request_params[key] = value
-    if request_type == "GET":
-        if request_url.startswith("/add"):
-            success = add_room(request_params["name"])
-            if success:
-                message = f"Room {request_params['name']} added."
-            else:
-                message = f"Room {request_params['name']} already exists."
-            return response_template.format(message=message)
-        elif request_url.startswith("/remove"):
-            success = remove_room(request_params["name"])
-            if success:
-                message = f"Room {request_params['name']} removed."
-            else:
-                message = f"Room {request_params['name']} does not exist."
-            return response_template.format(message=message)
-        elif request_url.startswith("/reserve"):
-            success = reserve_room(request_params["name"], request_params["day"], request_params["hour"],
-                                   request_params["duration"])
-            if success:
-                message = f"Room {request_params['name']} reserved for day {request_params['day']} at {request_params['hour']}:00 for {request_params['duration']} hours."
-            else:
-                message = f"Could not reserve room {request_params['name']}."
-            return response_template.format(message=message)
-        elif request_url.startswith("/checkavailability"):
-            availability = check_availability(request_params["name"], request_params["day"])
-            if availability is not None:
-                message = f"Available hours for room {request_params['name']} on day {request_params['day']}: {', '.join(availability)}"
-            else:
-                message = f"Room {request_params['name']} does not exist."
-            return response_template.format(message=message)
-    return "HTTP/1.1 400 Bad Request\n\nInvalid request."
+    # reserve room if it exists and is available, returns None if it does not exist, otherwise
+    # whether it was available
+    day = layout.day_index(day)
+    span = layout.span(hour, duration)
+    if day is None or span is None:
+        return False
+    return rooms.book(name, day, *span)
+
+
+def check_availability(name, day=None):
+    # check availability of room if it exists, returns the available hours of each day
+    days = layout.day_range(day)
+    if days is None:
+        return None
+    availability = {}
+    for day in days:
+        slots = rooms.free_slots(name, day)
+        if slots is None:
+            return None
+        availability[day + 1] = [layout.slot_time(slot) for slot in slots]
+    return availability
+
+
+def find_free_rooms(day, hour, duration):
+    # find the rooms that are free at a time, returns the room names of each day
+    days = layout.day_range(day)
+    span = layout.span(hour, duration)
+    if days is None or span is None:
+        return None
+    return {day + 1: sorted(rooms.search(day, *span)) for day in days}
+
+
+def add_room_request(name):
+    if add_room(name):
+        return "200 OK", f"Room {name} added."
+    return "200 OK", f"Room {name} already exists."
+
+
+def remove_room_request(name):
+    if remove_room(name):
+        return "200 OK", f"Room {name} removed."
+    return "200 OK", f"Room {name} does not exist."
+
+
+def reserve_room_request(name, day, hour, duration):
+    # the Reservation Server records a reservation, or releases a provisional booking, by the status
+    booked = reserve_room(name, day, hour, duration)
+    if booked is None:
+        return "404 Not Found", f"Room {name} does not exist."
+    if not booked:
+        return "403 Forbidden", f"Could not reserve room {name}."
+    start = layout.clock_time(layout.slot(hour))
+    return "200 OK", f"Room {name} reserved for day {day} at {start} for {duration} hours."
+
+
+def release_room_request(name, day, hour, duration):
+    # free booked slots of a room, called by the Reservation Server so the status tells what happened
+    span = layout.span(hour, duration)
+    if span is None:
+        return "400 Bad Request", "Invalid day, hour or duration."
+    if not rooms.release(name, layout.day_index(day), *span):
+        return "404 Not Found", f"Room {name} does not exist."
+    start = layout.clock_time(layout.slot(hour))
+    return "200 OK", f"Room {name} released for day {day} at {start} for {duration} hours."
+
+
+def move_room_request(name, from_day, from_hour, from_duration, day, hour, duration):
+    # move booked slots of a room to another time, they stay where they were if the new time is taken
+    old_span = layout.span(from_hour, from_duration)
+    span = layout.span(hour, duration)
+    if old_span is None or span is None:
+        return "400 Bad Request", "Invalid day, hour or duration."
+    moved = rooms.move(name, layout.day_index(from_day), *old_span, layout.day_index(day), *span)
+    if moved is None:
+        return "404 Not Found", f"Room {name} does not exist."
+    if not moved:
+        return "403 Forbidden", f"Room {name} is not available at this time."
+    start = layout.clock_time(layout.slot(hour))
+    return "200 OK", f"Room {name} moved to day {day} at {start} for {duration} hours."
+
+
+def check_availability_request(name, day):
+    availability = check_availability(name, day)
+    if availability is None:
+        return "200 OK", f"Room {name} does not exist."
+    return "200 OK", "<br>".join(f"Available hours for room {name} on day {day}: {', '.join(hours)}"
+                                 for day, hours in availability.items())
+
+
+def find_free_rooms_request(day, hour, duration):
+    free_rooms = find_free_rooms(day, hour, duration)
+    if free_rooms is None:
+        return "200 OK", "Invalid day, hour or duration."
+    start = layout.clock_time(layout.slot(hour))
+    return "200 OK", "<br>".join(f"Rooms available on day {day} at {start} for {duration} hours: {', '.join(names)}"
+                                 for day, names in free_rooms.items())
+
+
+def watch_availability(request, room=None, since=None):
+    # server-sent events of the availability changes of some rooms (room=R1,R2) or of every room
+    names = set(room.split(",")) if room else None
+    return availability.stream(rooms, names, since if since is not None else feed.last_event_id(request))
+
+
+def import_rooms(request, format):
+    # body: JSON lines of {"room"} objects or CSV with a room column
+    return bulk.load_rooms(rooms, request.body, format)
+
+
+def export_rooms(format):
+    return bulk.dump_rooms(rooms, format)
+
+
+handle_request = routing.Router()
+handle_request.add("GET", "/add", add_room_request, name=routing.text())
+handle_request.add("GET", "/remove", remove_room_request, name=routing.text())
+handle_request.add("GET", "/reserve", reserve_room_request, name=routing.text(), day=routing.day(layout),
+                   hour=routing.hour(layout), duration=routing.duration(layout))
+handle_request.add("GET", "/release", release_room_request, name=routing.text(), day=routing.day(layout),
+                   hour=routing.hour(layout), duration=routing.duration(layout))
+handle_request.add("GET", "/move", move_room_request, name=routing.text(), from_day=routing.day(layout),
+                   from_hour=routing.hour(layout), from_duration=routing.duration(layout), day=routing.day(layout),
+                   hour=routing.hour(layout), duration=routing.duration(layout))
+handle_request.add("GET", "/checkavailability", check_availability_request, name=routing.text(),
+                   day=routing.days(layout))
+handle_request.add("GET", "/search", find_free_rooms_request, day=routing.days(layout), hour=routing.hour(layout),
+                   duration=routing.duration(layout))
+handle_request.add("GET", "/watchavailability", watch_availability, with_request=True,
+                   room=routing.text(required=False), since=routing.text(required=False))
+handle_request.add("POST", "/import", import_rooms, with_request=True,
+                   format=routing.choice(bulk.FORMATS, default="jsonl"))
+handle_request.add("GET", "/export", export_rooms, format=routing.choice(bulk.FORMATS, default="jsonl"))
+server_metrics.add_routes(handle_request.paths())
 
 
 def main():
@@ -113,21 +172,16 @@ def main():
         return
 
     port = int(sys.argv[1])
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.bind(("localhost", port))
-    sock.listen()
-    print(f"Listening on port {port}...")
-    while True:
-        # accept incoming connection and receive request
-        connection, _ = sock.accept()
-        request = connection.recv(1024).decode()
-        print(request)
-        # handle request and send response
-        response = handle_request(request)
-        connection.sendall(response.encode())
-
-        # close connection
-        connection.close()
+    parser = argparse.ArgumentParser()
+    serving.add_arguments(parser)
+    schedule.add_arguments(parser)
+    journal.add_arguments(parser)
+    metrics.add_arguments(parser)
+    args = parser.parse_args(sys.argv[2:])
+    schedule.configure_from_args(layout, args)
+    metrics.configure_from_args(args)
+    rooms.open_journal(args.data_dir, args.snapshot_every)
+    serving.serve(port, handle_request, metrics=server_metrics, **serving.options_from_args(args))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,244 @@
+import inspect
+from urllib.parse import parse_qsl
+
+import cache
+import response
+
+FORM = "application/x-www-form-urlencoded"
+
+
+class Param:
+    # query parameter of a route: convert() turns the raw string into a value or raises ValueError,
+    # expected describes a valid value for the error message
+    # query is the name in the query string when it differs from the handler's argument name
+
+    def __init__(self, convert, expected, required=True, default=None, query=None):
+        self.convert = convert
+        self.expected = expected
+        self.required = required
+        self.default = default
+        self.query = query
+
+
+def text(required=True, default=None, query=None):
+    # any non-empty string
+    return Param(str, "a name", required, default, query)
+
+
+def integer(low=None, high=None, required=True, default=None, query=None):
+    # whole number between low and high, both included when given
+    def convert(value):
+        number = int(value)
+        if (low is not None and number < low) or (high is not None and number > high):
+            raise ValueError(value)
+        return number
+
+    if high is None:
+        expected = f"a whole number of at least {low}" if low is not None else "a whole number"
+    else:
+        expected = f"a whole number from {low} to {high}"
+    return Param(convert, expected, required, default, query)
+
+
+def flag(default=False):
+    # "1" or "0"
+    def convert(value):
+        if value not in ("0", "1"):
+            raise ValueError(value)
+        return value == "1"
+
+    return Param(convert, "0 or 1", False, default)
+
+
+def choice(values, required=False, default=None, query=None):
+    # one of a fixed set of strings
+    def convert(value):
+        if value not in values:
+            raise ValueError(value)
+        return value
+
+    return Param(convert, f"one of {', '.join(values)}", required, default, query)
+
+
+# parameters checked against a schedule.Layout, read when a request comes in
+# so that a layout configured after the routes were added is respected
+
+def day(layout, required=True):
+    # 1-based day number of the schedule
+    def convert(value):
+        if layout.day_index(value) is None:
+            raise ValueError(value)
+        return int(value)
+
+    return Param(convert, "a day from 1 to the number of days", required)
+
+
+def days(layout, required=False):
+    # one day ("3") or a range of days ("1-5"), every day when it is missing
+    def convert(value):
+        if layout.day_range(value) is None:
+            raise ValueError(value)
+        return value
+
+    return Param(convert, "a day or a range of days like 1-5", required)
+
+
+def hour(layout, required=True):
+    # start of a slot during opening hours, "9" or "9:15"
+    def convert(value):
+        if layout.slot(value) is None:
+            raise ValueError(value)
+        return value
+
+    return Param(convert, "the start of a slot during opening hours", required)
+
+
+def duration(layout, required=True):
+    # number of hours that is a positive whole number of slots and fits in a day
+    def convert(value):
+        hours = float(value)
+        if layout.span(layout.open_hour, hours) is None:
+            raise ValueError(value)
+        return int(hours) if hours.is_integer() else hours
+
+    return Param(convert, "a number of hours that fits in the opening hours", required)
+
+
+class Route:
+    __slots__ = ("handler", "params", "with_request", "idempotent")
+
+    def __init__(self, handler, params, with_request, idempotent=None):
+        self.handler = handler
+        self.params = params
+        self.with_request = with_request
+        # cache.IdempotencyCache of the answers to requests with an Idempotency-Key header
+        self.idempotent = idempotent
+
+    def call(self, request, arguments):
+        if self.with_request:
+            return self.handler(request, **arguments)
+        return self.handler(**arguments)
+
+
+class Router:
+    # dispatches requests to handlers by exact path with one dict lookup
+    #
+    # a handler is called with its converted query parameters as keyword arguments, and with the
+    # request first if it was added with with_request=True (e.g. to read a POST body). It returns
+    # either a (status code, message) pair, which render(status_code, message) turns into a
+    # response.Response, or a Response. Unknown paths get 404, other methods of a known path
+    # get 405 and missing or invalid parameters get 400 without calling the handler. A POST can
+    # also send the parameters as a form body.
+    #
+    # a route added with an idempotent cache answers a request carrying an Idempotency-Key
+    # header that was already answered with the first answer, without calling the handler again.
+
+    def __init__(self, render=response.html):
+        self.render = render
+        # path -> {method: Route}, a route's params map query names to (argument, Param)
+        self.routes = {}
+        self.not_found = render("404 Not Found", "Invalid request.")
+        # path -> 405 response listing the methods of the path
+        self.not_allowed = {}
+
+    def add(self, method, path, handler, with_request=False, idempotent=None, **params):
+        # params maps the handler's argument names to Param objects
+        params = {param.query or argument: (argument, param) for argument, param in params.items()}
+        methods = self.routes.setdefault(path, {})
+        methods[method] = Route(handler, params, with_request, idempotent)
+        self.not_allowed[path] = self.render("405 Method Not Allowed", "Method not allowed.").with_header(
+            "Allow", ", ".join(methods))
+
+    def paths(self):
+        return list(self.routes)
+
+    def __call__(self, request):
+        matched = self.match(request)
+        if isinstance(matched, response.Response):
+            return matched
+        route, arguments = matched
+        key, fingerprint, replay = self.replay(route, request, arguments)
+        if replay is not None:
+            return replay
+        if key is None:
+            return self.finish(route.call(request, arguments))
+        result = None
+        try:
+            result = self.finish(route.call(request, arguments))
+        finally:
+            route.idempotent.finish(key, fingerprint, result)
+        return result
+
+    def replay(self, route, request, arguments):
+        # (key, fingerprint, None) for a request that is to be handled, key None when it has
+        # no idempotency key, or (key, fingerprint, response) for a request answered before
+        key = route.idempotent and request.headers.get("idempotency-key")
+        if not key:
+            return None, None, None
+        fingerprint = (request.path, tuple(sorted(arguments.items())), request.body if route.with_request else None)
+        replay = route.idempotent.start(key, fingerprint)
+        if replay is cache.RUN:
+            return key, fingerprint, None
+        if replay is cache.RUNNING:
+            replay = self.render("409 Conflict", "A request with this idempotency key is in progress.").with_header(
+                "Retry-After", "1")
+        elif replay is cache.REUSED:
+            replay = self.render("422 Unprocessable Entity", "The idempotency key was used for another request.")
+        else:
+            replay = replay.with_header("Idempotent-Replayed", "true")
+        return key, fingerprint, replay
+
+    def match(self, request):
+        # (route, handler arguments) for a request, or the error response if there is none
+        methods = self.routes.get(request.path)
+        if methods is None:
+            return self.not_found
+        route = methods.get(request.method)
+        if route is None:
+            return self.not_allowed[request.path]
+        query = request.query
+        if request.method == "POST" and request.headers.get("content-type", "").startswith(FORM):
+            query = {**query, **dict(parse_qsl(request.body.decode(errors="replace"), keep_blank_values=True))}
+        arguments = {}
+        for name, (argument, param) in route.params.items():
+            value = query.get(name)
+            if not value:
+                if param.required:
+                    return self.render("400 Bad Request", f"Invalid request. Missing '{name}' parameter.")
+                arguments[argument] = param.default
+                continue
+            try:
+                arguments[argument] = param.convert(value)
+            except ValueError:
+                return self.render("400 Bad Request", f"Invalid '{name}' parameter, expected {param.expected}.")
+        return route, arguments
+
+    def finish(self, result):
+        if isinstance(result, tuple):
+            return self.render(*result)
+        return result
+
+
+class AsyncRouter(Router):
+    # Router for handlers running on an event loop: calling it returns a coroutine, and handlers
+    # that are coroutine functions are awaited. Plain handlers run on the loop as they are, so
+    # they must not block.
+
+    async def __call__(self, request):
+        matched = self.match(request)
+        if isinstance(matched, response.Response):
+            return matched
+        route, arguments = matched
+        key, fingerprint, replay = self.replay(route, request, arguments)
+        if replay is not None:
+            return replay
+        answer = None
+        try:
+            result = route.call(request, arguments)
+            if inspect.isawaitable(result):
+                result = await result
+            answer = self.finish(result)
+        finally:
+            if key is not None:
+                route.idempotent.finish(key, fingerprint, answer)
+        return answer
@@ -0,0 +1,189 @@
+import array
+import sys
+import tracemalloc
+
+# default layout: 7 days from 9:00 to 18:00 in one hour slots
+DEFAULT_DAYS = 7
+DEFAULT_OPEN_HOUR = 9
+DEFAULT_CLOSE_HOUR = 18
+DEFAULT_SLOT_MINUTES = 60
+
+
+class Layout:
+    # shape of every room schedule: number of days, opening hours and slot size
+    # a room schedule holds one bitmask per day, a set bit is a booked slot, so checking
+    # and booking any interval of a day is a single mask operation
+
+    def __init__(self, days=DEFAULT_DAYS, open_hour=DEFAULT_OPEN_HOUR, close_hour=DEFAULT_CLOSE_HOUR,
+                 slot_minutes=DEFAULT_SLOT_MINUTES):
+        self.configure(days, open_hour, close_hour, slot_minutes)
+
+    def configure(self, days, open_hour, close_hour, slot_minutes):
+        if (close_hour - open_hour) * 60 % slot_minutes or close_hour <= open_hour:
+            raise ValueError("Opening hours must be a whole number of slots.")
+        self.days = days
+        self.open_hour = open_hour
+        self.close_hour = close_hour
+        self.slot_minutes = slot_minutes
+        self.slots_per_day = (close_hour - open_hour) * 60 // slot_minutes
+        # days that fit in 64 bits are stored unboxed in an array instead of a list of ints
+        self.compact = self.slots_per_day <= 64
+
+    def new_schedule(self):
+        if self.compact:
+            return array.array("Q", bytes(8 * self.days))
+        return [0] * self.days
+
+    def day_index(self, day):
+        # convert a 1-based day to an index, None if it is outside the schedule
+        try:
+            day = int(day)
+        except (TypeError, ValueError):
+            return None
+        if 1 <= day <= self.days:
+            return day - 1
+        return None
+
+    def day_range(self, days):
+        # convert "3", "1-5" or None (every day) to a list of day indexes, None if it is invalid
+        if days is None or days == "":
+            return list(range(self.days))
+        first, _, last = str(days).partition("-")
+        first = self.day_index(first)
+        last = self.day_index(last) if last else first
+        if first is None or last is None or last < first:
+            return None
+        return list(range(first, last + 1))
+
+    def slot(self, hour):
+        # convert a start time ("9" or "9:15") to a slot index, None if no slot starts then
+        hour, _, minute = str(hour).partition(":")
+        try:
+            start = (int(hour) - self.open_hour) * 60 + int(minute or 0)
+        except ValueError:
+            return None
+        if start % self.slot_minutes or not 0 <= start // self.slot_minutes < self.slots_per_day:
+            return None
+        return start // self.slot_minutes
+
+    def span(self, hour, duration):
+        # convert a start time ("9" or "9:15") and a duration in hours ("2" or "0.25")
+        # to a (first slot, number of slots) pair, None if it does not fit the schedule
+        first = self.slot(hour)
+        try:
+            length = float(duration) * 60
+        except (TypeError, ValueError):
+            return None
+        if first is None or length % self.slot_minutes or length <= 0:
+            return None
+        count = int(length) // self.slot_minutes
+        if first + count > self.slots_per_day:
+            return None
+        return first, count
+
+    def slot_time(self, slot):
+        # format a slot index as "9" on the hour or "9:15" otherwise
+        hour, minute = divmod(self.open_hour * 60 + slot * self.slot_minutes, 60)
+        return f"{hour}:{minute:02}" if minute else str(hour)
+
+    def clock_time(self, slot):
+        # format a slot index as "9:00"
+        hour, minute = divmod(self.open_hour * 60 + slot * self.slot_minutes, 60)
+        return f"{hour}:{minute:02}"
+
+
+def mask(first, count):
+    return ((1 << count) - 1) << first
+
+
+def is_free(schedule, day, first, count):
+    return not schedule[day] & mask(first, count)
+
+
+def book(schedule, day, first, count):
+    # book the slots if none of them is taken, returns whether the booking was made
+    bits = mask(first, count)
+    if schedule[day] & bits:
+        return False
+    schedule[day] |= bits
+    return True
+
+
+def release(schedule, day, first, count):
+    schedule[day] &= ~mask(first, count)
+
+
+def free_slots(layout, schedule, day):
+    # indexes of the free slots of a day
+    return open_slots(layout, schedule[day])
+
+
+def open_slots(layout, booked):
+    # indexes of the slots a day's booked mask leaves free
+    return [slot for slot in range(layout.slots_per_day) if not booked >> slot & 1]
+
+
+def free_runs(layout, booked):
+    # maximal runs of free slots of a day as (first slot, slot after the run) pairs
+    runs = []
+    start = None
+    for slot in range(layout.slots_per_day):
+        if booked >> slot & 1:
+            if start is not None:
+                runs.append((start, slot))
+                start = None
+        elif start is None:
+            start = slot
+    if start is not None:
+        runs.append((start, layout.slots_per_day))
+    return runs
+
+
+def add_arguments(parser):
+    parser.add_argument("--days", type=int, default=DEFAULT_DAYS, help="number of days in a schedule")
+    parser.add_argument("--open-hour", type=int, default=DEFAULT_OPEN_HOUR, help="first bookable hour")
+    parser.add_argument("--close-hour", type=int, default=DEFAULT_CLOSE_HOUR, help="hour bookings end")
+    parser.add_argument("--slot-minutes", type=int, default=DEFAULT_SLOT_MINUTES,
+                        help="length of the smallest bookable slot")
+
+
+def configure_from_args(layout, args):
+    layout.configure(args.days, args.open_hour, args.close_hour, args.slot_minutes)
+
+
+def measure(build):
+    # bytes allocated while building a structure
+    tracemalloc.start()
+    data = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del data
+    return size
+
+
+def benchmark(room_count):
+    # compare the memory used by the old nested list layout and the bitmask layout
+    layout = Layout()
+
+    def nested_lists():
+        rooms = {}
+        for i in range(room_count):
+            rooms[f"room{i}"] = [[False for _ in range(9, 18)] for _ in range(7)]
+        return rooms
+
+    def bitmasks():
+        rooms = {}
+        for i in range(room_count):
+            schedule = layout.new_schedule()
+            book(schedule, i % layout.days, 0, 3)
+            rooms[f"room{i}"] = schedule
+        return rooms
+
+    old, new = measure(nested_lists), measure(bitmasks)
+    print(f"{room_count} rooms: nested lists {old / room_count:.0f} B/room, "
+          f"bitmasks {new / room_count:.0f} B/room ({old / new:.1f}x smaller)")
+
+
+if __name__ == "__main__":
+    # python schedule.py [number of rooms]
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
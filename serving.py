@@ -0,0 +1,384 @@
+import asyncio
+import inspect
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import response
+from http_parser import HTTPParseError, RequestParser
+
+# concurrency modes a server can run in:
+#   single  - one blocking accept/recv/handle/close loop (the original behaviour)
+#   thread  - the accept loop hands every connection to a bounded worker pool
+#   asyncio - an event loop accepts and reads, handlers run on a bounded worker pool, or on the
+#             loop itself when they return coroutines (e.g. a routing.AsyncRouter)
+MODES = ("single", "thread", "asyncio")
+
+DEFAULT_MODE = "thread"
+DEFAULT_WORKERS = 16
+DEFAULT_BACKLOG = 128
+# seconds an idle persistent connection is kept open
+DEFAULT_KEEPALIVE_TIMEOUT = 5
+# seconds a client has to send a whole request once it started, and to take each part of a response
+DEFAULT_REQUEST_TIMEOUT = 10
+# requests in progress (connections in thread mode) above which new ones are answered with 503
+DEFAULT_MAX_IN_FLIGHT = 1024
+RECV_SIZE = 4096
+# buffers handed to one sendmsg() call, well below the usual IOV_MAX of 1024
+MAX_BUFFERS = 512
+
+
+def create_listener(host, port, backlog):
+    # create a listening socket that can be rebound right after a restart
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+# responses for requests the parser rejected, by (status code, message)
+error_responses = {}
+
+
+def error_response(error):
+    # response for a request the parser rejected
+    key = (error.status_code, error.message)
+    if key not in error_responses:
+        error_responses[key] = response.text(error.status_code, error.message)
+    return error_responses[key]
+
+
+# answers that do not depend on the request, encoded once; the connection is closed after them
+REQUEST_TIMEOUT = response.text("408 Request Timeout", "Request timeout.").encode(False)
+OVERLOADED = response.text("503 Service Unavailable", "Server is overloaded, try again later.").with_header(
+    "Retry-After", "1").encode(False)
+
+
+class Admission:
+    # counts the work a server has taken on and turns away what is over the limit, so that an
+    # overloaded server answers at once instead of queueing clients until they time out
+
+    def __init__(self, limit, metrics=None):
+        self.limit = limit
+        self.count = 0
+        self.metrics = metrics
+        self.lock = threading.Lock()
+
+    def enter(self):
+        # whether there is room for one more, which must then leave()
+        with self.lock:
+            if not self.limit or self.count < self.limit:
+                self.count += 1
+                return True
+        if self.metrics:
+            self.metrics.rejected("overloaded")
+        return False
+
+    def leave(self):
+        with self.lock:
+            self.count -= 1
+
+
+def respond(parser, handle_request):
+    # handle every complete request fed to parser, in order, so that pipelined requests get one write
+    # returns (list to send, whether the connection stays open), the list holds byte strings and the
+    # chunk generators of streamed bodies
+    output = []
+    while True:
+        try:
+            request = parser.next_request()
+        except HTTPParseError as error:
+            output.extend(error_response(error).encode(False))
+            return output, False
+        if request is None:
+            return output, True
+        output.extend(handle_request(request).negotiate(request).encode(request.keep_alive))
+        if not request.keep_alive:
+            return output, False
+
+
+def send_buffers(connection, buffers):
+    # send byte strings with as few system calls as possible and without joining them
+    if not hasattr(connection, "sendmsg"):
+        connection.sendall(b"".join(buffers))
+        return
+    buffers = [memoryview(buffer) for buffer in buffers if buffer]
+    while buffers:
+        sent = connection.sendmsg(buffers[:MAX_BUFFERS])
+        # drop what was sent, a partly sent buffer continues where it stopped
+        while sent and sent >= len(buffers[0]):
+            sent -= len(buffers.pop(0))
+        if sent:
+            buffers[0] = buffers[0][sent:]
+
+
+async def respond_async(parser, handle_request):
+    # respond() for a handler that returns coroutines, run on the event loop
+    output = []
+    while True:
+        try:
+            request = parser.next_request()
+        except HTTPParseError as error:
+            output.extend(error_response(error).encode(False))
+            return output, False
+        if request is None:
+            return output, True
+        result = await handle_request(request)
+        output.extend(result.negotiate(request).encode(request.keep_alive))
+        if not request.keep_alive:
+            return output, False
+
+
+def is_async(handle_request):
+    # whether calling the handler returns a coroutine
+    return inspect.iscoroutinefunction(handle_request) or inspect.iscoroutinefunction(
+        getattr(type(handle_request), "__call__", None))
+
+
+def send_output(connection, output):
+    # send what respond() returned, the chunks of a streamed body are sent as they are produced
+    buffers = []
+    for item in output:
+        if isinstance(item, bytes):
+            buffers.append(item)
+            continue
+        for chunk in item:
+            buffers.append(chunk)
+            send_buffers(connection, buffers)
+            buffers = []
+    send_buffers(connection, buffers)
+
+
+class Deadline:
+    # time left to read from a connection: a client gets keepalive_timeout to start a request and,
+    # once it started, request_timeout to finish it, however slowly the bytes trickle in
+
+    def __init__(self, keepalive_timeout, request_timeout):
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout = request_timeout
+        self.request_end = None
+
+    def next_read(self, parser):
+        # seconds the next read may take, None once a started request took too long
+        if not parser.partial():
+            self.request_end = None
+            return self.keepalive_timeout
+        if self.request_end is None:
+            self.request_end = time.monotonic() + self.request_timeout
+        left = self.request_end - time.monotonic()
+        return left if left > 0 else None
+
+    def answered(self):
+        # the next request, even one already partly read, gets the whole request_timeout
+        self.request_end = None
+
+
+def handle_connection(connection, handle_request, keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+                      request_timeout=DEFAULT_REQUEST_TIMEOUT, metrics=None):
+    # serve requests on a connection until the client closes it, asks for close, goes idle or is too slow
+    parser = RequestParser()
+    deadline = Deadline(keepalive_timeout, request_timeout)
+    if metrics:
+        metrics.connection_opened()
+    try:
+        while True:
+            timeout = deadline.next_read(parser)
+            if timeout is None:
+                timed_out(connection, metrics)
+                break
+            connection.settimeout(timeout)
+            try:
+                data = connection.recv(RECV_SIZE)
+            except socket.timeout:
+                if parser.partial():
+                    timed_out(connection, metrics)
+                break
+            if not data:
+                break
+            parser.feed(data)
+            output, keep_alive = respond(parser, handle_request)
+            if output:
+                # a client that stops reading the response is dropped after request_timeout
+                connection.settimeout(request_timeout)
+                send_output(connection, output)
+                deadline.answered()
+            if not keep_alive:
+                break
+    except OSError:
+        # the client went away or stopped reading
+        pass
+    finally:
+        connection.close()
+        if metrics:
+            metrics.connection_closed()
+
+
+def timed_out(connection, metrics):
+    # answer a request that did not arrive in time, the connection is closed after it
+    if metrics:
+        metrics.rejected("timeout")
+    send_buffers(connection, REQUEST_TIMEOUT)
+
+
+def reject(connection):
+    # answer a connection the server has no room for, from the accept loop, without reading it
+    try:
+        connection.settimeout(0)
+        send_buffers(connection, OVERLOADED)
+        connection.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+    finally:
+        connection.close()
+
+
+def serve_single(sock, handle_request, request_timeout=DEFAULT_REQUEST_TIMEOUT, metrics=None):
+    while True:
+        connection, _ = sock.accept()
+        handle_connection(connection, handle_request, request_timeout=request_timeout, metrics=metrics)
+
+
+def serve_threaded(sock, handle_request, workers, request_timeout=DEFAULT_REQUEST_TIMEOUT,
+                   max_in_flight=DEFAULT_MAX_IN_FLIGHT, metrics=None):
+    # connections waiting for a worker count as in flight, so the queue in front of the pool is bounded
+    admission = Admission(max_in_flight, metrics)
+
+    def handle_admitted(connection):
+        try:
+            handle_connection(connection, handle_request, request_timeout=request_timeout, metrics=metrics)
+        finally:
+            admission.leave()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            connection, _ = sock.accept()
+            if admission.enter():
+                pool.submit(handle_admitted, connection)
+            else:
+                reject(connection)
+
+
+async def serve_asyncio(sock, handle_request, workers, keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+                        request_timeout=DEFAULT_REQUEST_TIMEOUT, max_in_flight=DEFAULT_MAX_IN_FLIGHT, metrics=None,
+                        backlog=DEFAULT_BACKLOG):
+    loop = asyncio.get_running_loop()
+    pool = ThreadPoolExecutor(max_workers=workers)
+    native = is_async(handle_request)
+    admission = Admission(max_in_flight, metrics)
+
+    async def on_connection(reader, writer):
+        parser = RequestParser()
+        deadline = Deadline(keepalive_timeout, request_timeout)
+        if metrics:
+            metrics.connection_opened()
+        try:
+            while True:
+                timeout = deadline.next_read(parser)
+                try:
+                    if timeout is None:
+                        raise asyncio.TimeoutError
+                    data = await asyncio.wait_for(reader.read(RECV_SIZE), timeout)
+                except asyncio.TimeoutError:
+                    if parser.partial():
+                        if metrics:
+                            metrics.rejected("timeout")
+                        writer.writelines(REQUEST_TIMEOUT)
+                    break
+                if not data:
+                    break
+                parser.feed(data)
+                if not admission.enter():
+                    writer.writelines(OVERLOADED)
+                    break
+                try:
+                    if native:
+                        output, keep_alive = await respond_async(parser, handle_request)
+                    else:
+                        # handlers may block on upstream servers, so keep them off the event loop
+                        output, keep_alive = await loop.run_in_executor(pool, respond, parser, handle_request)
+                    # a client that stops reading the response is dropped after request_timeout
+                    buffers = []
+                    for item in output:
+                        if isinstance(item, bytes):
+                            buffers.append(item)
+                            continue
+                        writer.writelines(buffers)
+                        buffers = []
+                        # streamed bodies are produced on the workers too, a chunk at a time
+                        while True:
+                            chunk = await loop.run_in_executor(pool, next, item, None)
+                            if chunk is None:
+                                break
+                            writer.write(chunk)
+                            await asyncio.wait_for(writer.drain(), request_timeout)
+                    writer.writelines(buffers)
+                    await asyncio.wait_for(writer.drain(), request_timeout)
+                finally:
+                    admission.leave()
+                if output:
+                    deadline.answered()
+                if not keep_alive:
+                    break
+        except (OSError, asyncio.TimeoutError):
+            # the client went away or stopped reading
+            pass
+        finally:
+            writer.close()
+            if metrics:
+                metrics.connection_closed()
+
+    # start_server listens on the socket again, with its own backlog unless it is given
+    server = await asyncio.start_server(on_connection, sock=sock, backlog=backlog)
+    async with server:
+        await server.serve_forever()
+
+
+def serve(port, handle_request, mode=DEFAULT_MODE, workers=DEFAULT_WORKERS, backlog=DEFAULT_BACKLOG,
+          request_timeout=DEFAULT_REQUEST_TIMEOUT, max_in_flight=DEFAULT_MAX_IN_FLIGHT, host="localhost",
+          metrics=None):
+    # serve handle_request on host:port until the process is stopped
+    # with metrics, handle_request is instrumented and /metrics is answered
+    if mode not in MODES:
+        raise ValueError(f"Unknown server mode {mode}, expected one of: {', '.join(MODES)}")
+    native = is_async(handle_request)
+    if native and mode != "asyncio":
+        raise ValueError(f"A handler returning coroutines needs asyncio mode, not {mode}")
+    if metrics:
+        handle_request = metrics.instrument_async(handle_request) if native else metrics.instrument(handle_request)
+    sock = create_listener(host, port, backlog)
+    print(f"Listening on port {port} ({mode} mode, {workers} workers)...")
+    if mode == "single":
+        serve_single(sock, handle_request, request_timeout, metrics)
+    elif mode == "thread":
+        serve_threaded(sock, handle_request, workers, request_timeout, max_in_flight, metrics)
+    else:
+        asyncio.run(serve_asyncio(sock, handle_request, workers, request_timeout=request_timeout,
+                                  max_in_flight=max_in_flight, metrics=metrics, backlog=backlog))
+
+
+def add_arguments(parser, prefix=""):
+    # add --[prefix-]mode, --[prefix-]workers, --[prefix-]backlog and the limits to parser
+    # prefixed options default to None so that they fall back to the unprefixed ones
+    name = f"--{prefix}-" if prefix else "--"
+    parser.add_argument(f"{name}mode", choices=MODES, default=None if prefix else DEFAULT_MODE,
+                        help="concurrency mode")
+    parser.add_argument(f"{name}workers", type=int, default=None if prefix else DEFAULT_WORKERS,
+                        help="number of worker threads")
+    parser.add_argument(f"{name}backlog", type=int, default=None if prefix else DEFAULT_BACKLOG,
+                        help="accept backlog of the listening socket")
+    parser.add_argument(f"{name}request-timeout", type=float, default=None if prefix else DEFAULT_REQUEST_TIMEOUT,
+                        help="seconds a client has to send a request once it started, and to read a response")
+    parser.add_argument(f"{name}max-in-flight", type=int, default=None if prefix else DEFAULT_MAX_IN_FLIGHT,
+                        help="requests (connections in thread mode) in progress before new ones get 503, 0 is no limit")
+
+
+def options_from_args(args, prefix=""):
+    # collect the serve() keyword arguments for one server from parsed arguments
+    options = {}
+    for option in ("mode", "workers", "backlog", "request_timeout", "max_in_flight"):
+        value = getattr(args, f"{prefix}_{option}", None) if prefix else None
+        options[option] = value if value is not None else getattr(args, option)
+    return options
+
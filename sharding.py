@@ -0,0 +1,97 @@
+import os
+import socket
+import time
+import zlib
+from bisect import bisect
+from concurrent.futures import ThreadPoolExecutor
+
+import upstream
+
+# points every shard gets on the hash ring, more points spread the keys more evenly
+DEFAULT_REPLICAS = 128
+
+
+def key_hash(key):
+    # stable across processes and restarts, unlike hash()
+    return zlib.crc32(key.encode())
+
+
+class HashRing:
+    # consistent hashing of keys onto shards 0..count-1
+    # adding a shard only moves the keys that land on its points, about 1/count of them
+
+    def __init__(self, count, replicas=DEFAULT_REPLICAS):
+        points = sorted((key_hash(f"shard-{shard}-{replica}"), shard)
+                        for shard in range(count) for replica in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    def shard(self, key):
+        # the shard owning a key: the first point at or after the key's hash, wrapping around
+        index = bisect(self.hashes, key_hash(key)) % len(self.hashes)
+        return self.shards[index]
+
+
+class Shards:
+    # connection pools to the shards of a server, with the ring saying which one owns a key
+
+    def __init__(self, addresses, **pool_options):
+        self.ring = HashRing(len(addresses))
+        self.pools = [upstream.UpstreamPool(address, **pool_options) for address in addresses]
+        self.executor = ThreadPoolExecutor(max_workers=4 * len(addresses))
+
+    def __len__(self):
+        return len(self.pools)
+
+    def index(self, key):
+        return self.ring.shard(key)
+
+    def pool(self, key):
+        return self.pools[self.ring.shard(key)]
+
+    def map(self, call, arguments):
+        # call(pool, argument) for every (shard index, argument) pair at the same time,
+        # returns the results in order, an UpstreamError of any call is raised
+        futures = [self.executor.submit(call, self.pools[index], argument) for index, argument in arguments]
+        return [future.result() for future in futures]
+
+    def fan_out(self, call):
+        # call(pool) on every shard at the same time, returns the results by shard
+        return self.map(lambda pool, _: call(pool), [(index, None) for index in range(len(self.pools))])
+
+
+def wait_until_listening(addresses, timeout=30):
+    # block until every address accepts connections, e.g. shard processes that are still starting
+    deadline = time.monotonic() + timeout
+    for address in addresses:
+        while True:
+            try:
+                socket.create_connection(address, timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise SystemExit(f"room shard {address[0]}:{address[1]} did not start")
+                time.sleep(0.05)
+
+
+def check_shard_count(directory, count):
+    # the ring depends on the number of shards, so a data directory sharded one way cannot be
+    # served with another count without moving the rooms; remember the count and refuse others
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "shards")
+    try:
+        with open(path) as f:
+            saved = int(f.read())
+    except FileNotFoundError:
+        with open(path, "w") as f:
+            f.write(f"{count}\n")
+        return
+    if saved != count:
+        raise SystemExit(f"{directory} holds {saved} room shards, start with --room-shards {saved}")
+
+
+def add_arguments(parser):
+    parser.add_argument("--room-shards", type=int, default=0,
+                        help="run the Room Server as this many processes, each owning part of the rooms")
+    parser.add_argument("--shard-port", type=int, default=8090,
+                        help="port of the first room shard, the others use the following ports")
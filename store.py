@@ -0,0 +1,456 @@
+import random
+import sys
+import threading
+from bisect import bisect_left, insort
+from contextlib import ExitStack
+
+import feed
+import journal
+import schedule
+
+DEFAULT_STRIPES = 64
+# activity names returned by a search when the request does not say
+DEFAULT_SEARCH = 20
+MAX_SEARCH = 1000
+
+
+class LockStripes:
+    # fixed set of locks shared by many keys, a key always maps to the same lock
+    # so that updates of one key are serialized while other keys proceed in parallel
+
+    def __init__(self, count=DEFAULT_STRIPES):
+        self.locks = [threading.Lock() for _ in range(count)]
+
+    def lock(self, key):
+        return self.locks[hash(key) % len(self.locks)]
+
+    def locks_for(self, keys):
+        # the locks of several keys in a fixed order, so that threads taking them cannot deadlock
+        return [self.locks[index] for index in sorted({hash(key) % len(self.locks) for key in keys})]
+
+
+class IdAllocator:
+    # hands out increasing ids, never the same one twice
+
+    def __init__(self, start=1):
+        self.next_id = start
+        self.lock = threading.Lock()
+
+    def allocate(self):
+        with self.lock:
+            allocated = self.next_id
+            self.next_id += 1
+            return allocated
+
+    def advance(self, used):
+        # make sure an id that is already in use (e.g. replayed from a journal) is not handed out
+        with self.lock:
+            self.next_id = max(self.next_id, used + 1)
+
+
+class FreeSlotIndex:
+    # rooms grouped by their maximal runs of free slots, per day
+    # a room that is free from slot a up to slot b on a day is in runs[day][(a, b)], so finding
+    # the rooms free for an interval only looks at the few distinct runs a day can have,
+    # however many rooms there are
+
+    def __init__(self, layout):
+        self.layout = layout
+        self.runs = [{} for _ in range(layout.days)]
+        # free runs of every room, per day
+        self.room_runs = {}
+        self.locks = [threading.Lock() for _ in range(layout.days)]
+
+    def add(self, name, room):
+        room_runs = self.room_runs[name] = [[] for _ in range(self.layout.days)]
+        # the days of a new room are all empty, their runs are worked out once
+        runs_of = {}
+        for day, booked in enumerate(room):
+            runs = runs_of.get(booked)
+            if runs is None:
+                runs = runs_of[booked] = schedule.free_runs(self.layout, booked)
+            with self.locks[day]:
+                for run in runs:
+                    self.runs[day].setdefault(run, set()).add(name)
+                room_runs[day] = runs
+
+    def remove(self, name):
+        room_runs = self.room_runs.pop(name, None)
+        if room_runs is None:
+            return
+        for day, runs in enumerate(room_runs):
+            with self.locks[day]:
+                self.discard(name, day, runs)
+
+    def update(self, name, day, booked):
+        # move a room to the runs of its new bitmask for a day
+        room_runs = self.room_runs.get(name)
+        if room_runs is None:
+            return
+        runs = schedule.free_runs(self.layout, booked)
+        with self.locks[day]:
+            self.discard(name, day, room_runs[day])
+            for run in runs:
+                self.runs[day].setdefault(run, set()).add(name)
+            room_runs[day] = runs
+
+    def discard(self, name, day, runs):
+        # needs the lock of the day
+        for run in runs:
+            names = self.runs[day][run]
+            names.discard(name)
+            if not names:
+                del self.runs[day][run]
+
+    def search(self, day, first, count):
+        # names of the rooms that are free for count slots from slot first on a day
+        end = first + count
+        found = []
+        with self.locks[day]:
+            for (start, stop), names in self.runs[day].items():
+                if start <= first and end <= stop:
+                    found.extend(names)
+        return found
+
+
+class RoomStore:
+    # room schedules that can be shared between threads
+    # every check-then-update of a room holds that room's lock stripe, and the change is
+    # queued on the journal and applied to the free slot index under the same lock
+
+    def __init__(self, layout, stripes=DEFAULT_STRIPES):
+        self.layout = layout
+        self.rooms = {}
+        self.stripes = LockStripes(stripes)
+        self.index = FreeSlotIndex(layout)
+        self.journal = journal.Journal("rooms")
+        # the same changes for readers that follow them as they happen
+        self.feed = feed.ChangeFeed()
+
+    def __contains__(self, name):
+        return name in self.rooms
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def names(self):
+        return list(self.rooms)
+
+    def add(self, name):
+        # add an empty schedule, returns False if the room already exists
+        return self.add_many([name])[0]
+
+    def add_many(self, names):
+        # add a list of rooms with one journal wait, returns whether each one was added
+        added = []
+        sequence = 0
+        for name in names:
+            with self.stripes.lock(name):
+                if name in self.rooms:
+                    added.append(False)
+                    continue
+                room = self.rooms[name] = self.layout.new_schedule()
+                self.index.add(name, room)
+                sequence = self.log(["add", name])
+            added.append(True)
+        self.journal.wait(sequence)
+        return added
+
+    def remove(self, name):
+        # drop the room and its schedule, returns False if it does not exist
+        with self.stripes.lock(name):
+            if self.rooms.pop(name, None) is None:
+                return False
+            self.index.remove(name)
+            sequence = self.log(["remove", name])
+        self.journal.wait(sequence)
+        return True
+
+    def book(self, name, day, first, count):
+        # book slots of a room, returns None if the room does not exist,
+        # otherwise whether the slots were free and are now booked
+        with self.stripes.lock(name):
+            room = self.rooms.get(name)
+            if room is None:
+                return None
+            if not schedule.book(room, day, first, count):
+                return False
+            self.index.update(name, day, room[day])
+            sequence = self.log(["day", name, day, room[day]])
+        self.journal.wait(sequence)
+        return True
+
+    def book_many(self, bookings, atomic=True):
+        # book a list of (name, day, first slot, number of slots) while holding the locks of all
+        # the rooms involved, returns (committed, one result per booking like book())
+        # with atomic set nothing is booked unless every booking can be made
+        results = []
+        # slots each (room, day) gets from this batch, bookings in the batch may not overlap either
+        batch = {}
+        sequence = 0
+        with ExitStack() as stack:
+            for lock in self.stripes.locks_for({booking[0] for booking in bookings}):
+                stack.enter_context(lock)
+            for name, day, first, count in bookings:
+                room = self.rooms.get(name)
+                if room is None:
+                    results.append(None)
+                    continue
+                bits = schedule.mask(first, count)
+                taken = batch.get((name, day), 0)
+                if (room[day] | taken) & bits:
+                    results.append(False)
+                    continue
+                batch[(name, day)] = taken | bits
+                results.append(True)
+            if atomic and not all(results):
+                return False, results
+            for (name, day), bits in batch.items():
+                room = self.rooms[name]
+                room[day] |= bits
+                self.index.update(name, day, room[day])
+                sequence = self.log(["day", name, day, room[day]])
+        self.journal.wait(sequence)
+        return True, results
+
+    def release(self, name, day, first, count):
+        # free booked slots, returns False if the room does not exist
+        with self.stripes.lock(name):
+            room = self.rooms.get(name)
+            if room is None:
+                return False
+            schedule.release(room, day, first, count)
+            self.index.update(name, day, room[day])
+            sequence = self.log(["day", name, day, room[day]])
+        self.journal.wait(sequence)
+        return True
+
+    def move(self, name, day, first, count, new_day, new_first, new_count):
+        # move booked slots of a room to other slots in one step, returns None if the room does not
+        # exist, otherwise whether the new slots were free; the old slots stay booked if they were not
+        with self.stripes.lock(name):
+            room = self.rooms.get(name)
+            if room is None:
+                return None
+            old = schedule.mask(first, count)
+            room[day] &= ~old
+            if not schedule.book(room, new_day, new_first, new_count):
+                room[day] |= old
+                return False
+            sequence = 0
+            for changed in sorted({day, new_day}):
+                self.index.update(name, changed, room[changed])
+                sequence = self.log(["day", name, changed, room[changed]])
+        self.journal.wait(sequence)
+        return True
+
+    def log(self, record):
+        # needs the lock of the room the record is about, queues it on the journal and tells the feed
+        self.feed.publish(record)
+        return self.journal.append(record)
+
+    def state(self, name):
+        # the booked slot masks of every day of a room, None if it does not exist
+        with self.stripes.lock(name):
+            room = self.rooms.get(name)
+            return None if room is None else list(room)
+
+    def free_slots(self, name, day):
+        # free slot indexes of a room on a day, None if the room does not exist
+        with self.stripes.lock(name):
+            room = self.rooms.get(name)
+            if room is None:
+                return None
+            return schedule.free_slots(self.layout, room, day)
+
+    def search(self, day, first, count):
+        # names of the rooms free for count slots from slot first on a day
+        return self.index.search(day, first, count)
+
+    def open_journal(self, directory, snapshot_every=journal.DEFAULT_SNAPSHOT_EVERY):
+        # load the rooms saved in directory and log every later change there
+        self.journal.open(directory, self.apply, self.dump, snapshot_every)
+
+    def apply(self, record):
+        # replay one journal record
+        action, name = record[0], record[1]
+        if action == "add":
+            if name not in self.rooms:
+                room = self.rooms[name] = self.layout.new_schedule()
+                self.index.add(name, room)
+        elif action == "remove":
+            if self.rooms.pop(name, None) is not None:
+                self.index.remove(name)
+        elif action == "day":
+            room = self.rooms.get(name)
+            day, booked = record[2], record[3]
+            if room is not None and day < len(room):
+                room[day] = booked
+                self.index.update(name, day, booked)
+
+    def dump(self):
+        # journal records that recreate every room
+        for name in self.names():
+            with self.stripes.lock(name):
+                room = self.rooms.get(name)
+                if room is None:
+                    continue
+                days = list(room)
+            yield ["add", name]
+            for day, booked in enumerate(days):
+                if booked:
+                    yield ["day", name, day, booked]
+
+
+class ActivityRegistry:
+    # activity names as a hashed set that keeps the order they were added in, with a sorted index
+    # of the case-folded names for search
+    #
+    # checking a name is a dict lookup however many activities there are, and a prefix search is a
+    # binary search into the index followed by the matches only. Changes hold the lock while they
+    # update both and queue the journal record, readers of the dict do not need it.
+
+    def __init__(self):
+        # name -> None, a dict rather than a set so that the names stay in insertion order
+        self.names = {}
+        # sorted (folded name, name) pairs
+        self.index = []
+        self.lock = threading.Lock()
+        self.journal = journal.Journal("activities")
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name):
+        # returns False if the activity already exists
+        return self.add_many([name])[0]
+
+    def add_many(self, names):
+        # add a list of activities with one journal wait, returns whether each one was added
+        added = []
+        sequence = 0
+        with self.lock:
+            for name in names:
+                if name in self.names:
+                    added.append(False)
+                    continue
+                self.insert(name)
+                sequence = self.journal.append(["add", name])
+                added.append(True)
+        self.journal.wait(sequence)
+        return added
+
+    def ordered(self):
+        # the names in the order they were added
+        with self.lock:
+            return list(self.names)
+
+    def remove(self, name):
+        # returns False if the activity does not exist
+        with self.lock:
+            if name not in self.names:
+                return False
+            self.delete(name)
+            sequence = self.journal.append(["remove", name])
+        self.journal.wait(sequence)
+        return True
+
+    def search(self, prefix="", contains="", limit=None):
+        # names starting with prefix and containing contains, ignoring case, in alphabetical order
+        prefix, contains = prefix.casefold(), contains.casefold()
+        found = []
+        with self.lock:
+            for position in range(bisect_left(self.index, (prefix,)), len(self.index)):
+                folded, name = self.index[position]
+                if not folded.startswith(prefix):
+                    break
+                # a substring anywhere in the name cannot use the index, the names after the
+                # prefix are scanned until limit of them match
+                if contains in folded:
+                    found.append(name)
+                    if len(found) == limit:
+                        break
+        return found
+
+    def insert(self, name):
+        # needs self.lock
+        self.names[name] = None
+        insort(self.index, (name.casefold(), name))
+
+    def delete(self, name):
+        # needs self.lock
+        del self.names[name]
+        del self.index[bisect_left(self.index, (name.casefold(), name))]
+
+    def open_journal(self, directory, snapshot_every=journal.DEFAULT_SNAPSHOT_EVERY):
+        # load the activities saved in directory and log every later change there
+        self.journal.open(directory, self.apply, self.dump, snapshot_every)
+
+    def apply(self, record):
+        # replay one journal record
+        action, name = record
+        if action == "add" and name not in self.names:
+            self.insert(name)
+        elif action == "remove" and name in self.names:
+            self.delete(name)
+
+    def dump(self):
+        # journal records that recreate the activities, in the order they were added
+        return [["add", name] for name in self.ordered()]
+
+
+def stress(thread_count, attempts):
+    # hammer one room from many threads that book and release random intervals
+    # and check that no two threads ever hold the same slot or get the same id
+    # switch threads as often as possible to provoke races
+    sys.setswitchinterval(1e-6)
+    layout = schedule.Layout()
+    rooms = RoomStore(layout)
+    rooms.add("room")
+    ids = IdAllocator()
+    allocated = []
+    # slots currently held according to the threads themselves
+    held = [0] * layout.days
+    held_lock = threading.Lock()
+    double_bookings = []
+    start = threading.Barrier(thread_count)
+
+    def worker():
+        start.wait()
+        for _ in range(attempts):
+            day = random.randrange(layout.days)
+            first = random.randrange(layout.slots_per_day)
+            count = random.randint(1, min(3, layout.slots_per_day - first))
+            if not rooms.book("room", day, first, count):
+                continue
+            allocated.append(ids.allocate())
+            bits = schedule.mask(first, count)
+            with held_lock:
+                if held[day] & bits:
+                    double_bookings.append((day, first, count))
+                held[day] |= bits
+            with held_lock:
+                held[day] &= ~bits
+            rooms.release("room", day, first, count)
+
+    threads = [threading.Thread(target=worker) for _ in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not double_bookings, f"{len(double_bookings)} double bookings"
+    assert not any(rooms.rooms["room"]), "released slots are still booked"
+    assert all(rooms.search(day, 0, layout.slots_per_day) == ["room"] for day in range(layout.days)), \
+        "free slot index does not match the schedule"
+    assert len(set(allocated)) == len(allocated), "reservation id handed out twice"
+    print(f"{thread_count} threads, {thread_count * attempts} attempts: "
+          f"{len(allocated)} bookings, no double bookings or duplicate ids")
+
+
+if __name__ == "__main__":
+    # python store.py [threads] [attempts per thread]
+    stress(int(sys.argv[1]) if len(sys.argv) > 1 else 32, int(sys.argv[2]) if len(sys.argv) > 2 else 2000)
@@ -0,0 +1,74 @@
+import json
+
+import pytest
+
+import multiThread
+import schedule
+
+
+class Request:
+    def __init__(self, body):
+        self.body = json.dumps(body).encode()
+
+
+@pytest.fixture(autouse=True)
+def in_process():
+    multiThread.configure_services(True, sharded=False)
+    multiThread.rooms.add("B1")
+    multiThread.activities.add("Chess")
+    yield
+    for reservation in multiThread.reservation_book.page(0, 1000):
+        multiThread.reservation_book.remove(reservation.id)
+    multiThread.rooms.remove("B1")
+
+
+def answer(result):
+    return result.status_code, json.loads(result.body)
+
+
+@pytest.mark.parametrize("day, hour, duration", [(None, 9, 1), ([1], 9, 1), (1, 9, None), (1, {}, 1), (9, 9, 1)])
+def test_layout_rejects_other_types(day, hour, duration):
+    layout = schedule.Layout()
+    assert layout.day_index(day) is None or layout.span(hour, duration) is None
+
+
+@pytest.mark.parametrize("handler", [multiThread.reserve_many, multiThread.release_many])
+@pytest.mark.parametrize("booking", [["B1", None, 9, 1], ["B1", [1], 9, 1], ["B1", 1, 9, None], ["B1", 1, 9], [1, 1, 9, 1]])
+def test_invalid_booking_is_400_with_its_index(handler, booking):
+    request = Request([["B1", 1, 9, 1], booking])
+    if handler is multiThread.reserve_many:
+        status, body = answer(handler(request, atomic=True))
+    else:
+        status, body = answer(handler(request))
+    assert status == "400 Bad Request"
+    assert body["index"] == 1
+    # nothing was booked for the valid first booking
+    assert multiThread.rooms.free_slots("B1", 0)[0] == 0
+
+
+def test_atomic_batch_with_invalid_item_is_400_and_reserves_nothing():
+    items = [{"room": "B1", "activity": "Chess", "day": 1, "hour": 9, "duration": 1},
+             {"room": "B1", "activity": "Chess", "day": 8, "hour": 9, "duration": 1}]
+    status, body = answer(multiThread.reserve_batch(Request(items), atomic=True))
+    assert status == "400 Bad Request"
+    assert body["index"] == 1
+    assert len(multiThread.reservation_book) == 0
+
+
+def test_non_atomic_batch_fails_only_the_invalid_item():
+    items = [{"room": "B1", "activity": "Chess", "day": 1, "hour": 9, "duration": 1},
+             {"room": "B1", "activity": "Chess", "day": None, "hour": 9, "duration": 1}]
+    status, body = answer(multiThread.reserve_batch(Request(items), atomic=False))
+    assert status == "200 OK"
+    assert [result["status"] for result in body["results"]] == ["200 OK", "400 Bad Request"]
+
+
+def test_batch_stores_the_types_reserve_stores():
+    items = [{"room": "B1", "activity": "Chess", "day": "2", "hour": 10, "duration": "1"}]
+    status, _ = answer(multiThread.reserve_batch(Request(items), atomic=True))
+    assert status == "200 OK"
+    multiThread.reservation_room("B1", "Chess", 3, "10", 1)
+    batch, single = multiThread.reservation_book.page(0, 10)
+    assert (batch.day, batch.hour, batch.duration) == (2, "10", 1)
+    assert [type(value) for value in (batch.day, batch.hour, batch.duration)] == \
+        [type(value) for value in (single.day, single.hour, single.duration)]
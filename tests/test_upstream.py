@@ -0,0 +1,92 @@
+import asyncio
+import socket
+import threading
+
+import pytest
+
+import upstream
+
+OK = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"
+
+
+class Backend:
+    # answers the first request of each connection; then, for "stale", closes the connection
+    # like a server whose keep-alive timeout ran out, and for "partial", answers the second
+    # request with half a status line before closing
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.paths = []
+        self.listener = socket.create_server(("localhost", 0))
+        self.address = self.listener.getsockname()[:2]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                connection, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+    def handle(self, connection):
+        with connection:
+            self.receive(connection)
+            connection.sendall(OK)
+            if self.mode == "partial" and self.receive(connection):
+                connection.sendall(b"HTTP/1.1 200 OK\r\nContent-Len")
+
+    def receive(self, connection):
+        # read one request without a body and record its path
+        data = b""
+        while b"\r\n\r\n" not in data:
+            chunk = connection.recv(4096)
+            if not chunk:
+                return False
+            data += chunk
+        self.paths.append(data.split(b" ")[1].decode())
+        return True
+
+    def close(self):
+        self.listener.close()
+
+
+@pytest.fixture
+def backend(request):
+    server = Backend(request.param)
+    yield server
+    server.close()
+
+
+def sync_gets(address, *paths):
+    pool = upstream.UpstreamPool(address, timeout=2)
+    try:
+        return [pool.get(path) for path in paths]
+    finally:
+        pool.close()
+
+
+def async_gets(address, *paths):
+    async def gets():
+        pool = upstream.AsyncUpstreamPool(address, timeout=2)
+        try:
+            return [await pool.get(path) for path in paths]
+        finally:
+            pool.close()
+
+    return asyncio.run(gets())
+
+
+@pytest.mark.parametrize("gets", [sync_gets, async_gets])
+@pytest.mark.parametrize("backend", ["stale"], indirect=True)
+def test_reused_connection_closed_before_the_answer_is_retried(backend, gets):
+    assert gets(backend.address, "/a", "/b") == [(200, "ok"), (200, "ok")]
+    assert backend.paths == ["/a", "/b"]
+
+
+@pytest.mark.parametrize("gets", [sync_gets, async_gets])
+@pytest.mark.parametrize("backend", ["partial"], indirect=True)
+def test_request_answered_in_part_is_not_sent_again(backend, gets):
+    with pytest.raises(upstream.UpstreamError):
+        gets(backend.address, "/a", "/b")
+    assert backend.paths == ["/a", "/b"]
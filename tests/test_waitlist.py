@@ -0,0 +1,145 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+import pytest
+
+import schedule
+import waitlist
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAYOUT = schedule.Layout()
+
+
+def make_waitlist(answers, **options):
+    # book(waiter) answers with answers[activity], 503 by default, or raises for "raise"
+    def book(waiter):
+        answer = answers.get(waiter.activity, 503)
+        if answer == "raise":
+            raise RuntimeError("book failed")
+        return answer, 1 if answer == 200 else None
+
+    return waitlist.Waitlist(LAYOUT, book, **options)
+
+
+def promote(waitlist_):
+    waitlist_.promote("R", 0, *LAYOUT.span("9", 1))
+
+
+def test_waiters_not_tried_after_a_5xx_keep_waiting():
+    waiters = make_waitlist({})
+    first = waiters.add("R", "a", 1, "9", 1, priority=2)
+    second = waiters.add("R", "b", 1, "9", 1, priority=1)
+    promote(waiters)
+    assert (first.state, second.state) == (waitlist.WAITING, waitlist.WAITING)
+    assert waiters.cancel(second.id).state == waitlist.CANCELLED
+
+
+def test_waiter_keeps_waiting_when_book_raises():
+    answers = {}
+    waiters = make_waitlist(answers)
+    waiter = waiters.add("R", "a", 1, "9", 1)
+    answers["a"] = "raise"
+    with pytest.raises(RuntimeError):
+        promote(waiters)
+    assert waiter.state == waitlist.WAITING
+
+
+def test_promotion_books_the_best_waiter_and_keeps_blocked_ones():
+    answers = {}
+    waiters = make_waitlist(answers)
+    low = waiters.add("R", "a", 1, "9", 1, priority=1)
+    high = waiters.add("R", "b", 1, "9", 1, priority=5)
+    answers.update(a=403, b=200)
+    promote(waiters)
+    assert high.state == waitlist.BOOKED
+    assert low.state == waitlist.WAITING
+
+
+def test_expiry_skips_a_waiter_being_booked():
+    waiters = make_waitlist({}, ttl=0.05, max_waiters=2)
+    stuck = waiters.add("R", "a", 1, "10", 1)
+    stuck.state = waitlist.BOOKING
+    behind = waiters.add("R", "b", 1, "10", 1)
+    time.sleep(0.1)
+    assert waiters.add("R", "c", 1, "10", 1) is not None
+    assert behind.state == waitlist.EXPIRED
+
+
+def test_long_polls_beyond_the_cap_answer_at_once():
+    waiters = make_waitlist({}, max_pollers=1)
+    waiter = waiters.add("R", "a", 1, "9", 1)
+    polling = threading.Thread(target=waiters.wait, args=(waiter.id, 1))
+    polling.start()
+    time.sleep(0.1)
+    start = time.monotonic()
+    assert waiters.wait(waiter.id, 1) is waiter
+    assert time.monotonic() - start < 0.5
+    polling.join()
+
+
+def ports_free(*ports):
+    for port in ports:
+        with socket.socket() as sock:
+            if sock.connect_ex(("localhost", port)) == 0:
+                return False
+    return True
+
+
+@pytest.fixture
+def servers_over_http(tmp_path):
+    # multiThread.py with the reservation server calling the others over HTTP, the room server
+    # serving one connection at a time so that a call back into it from one of its own requests
+    # would time out and leave the waiter waiting
+    if not ports_free(8080, 8081, 8082):
+        pytest.skip("ports 8080-8082 are in use")
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, "multiThread.py"), "--services", "http",
+                                "--room-mode", "single", "--data-dir", str(tmp_path), "--log-sample", "0"],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 10
+        while ports_free(8080) or ports_free(8081) or ports_free(8082):
+            if time.monotonic() > deadline:
+                pytest.fail("multiThread.py did not start")
+            time.sleep(0.05)
+        yield
+    finally:
+        process.kill()
+        process.wait()
+
+
+def call(port, path):
+    request = urllib.request.Request(f"http://localhost:{port}{path}", headers={"Accept": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=10) as reply:
+            return reply.status, reply.read()
+    except urllib.error.HTTPError as error:
+        return error.code, error.read()
+
+
+def waiter_state(waiter_id):
+    _, body = call(8080, f"/waitstatus?id={waiter_id}")
+    return json.loads(body)
+
+
+@pytest.mark.parametrize("free", ["/cancel?id=1", "release"])
+def test_freed_slots_go_to_the_waiter_over_http(servers_over_http, free):
+    call(8081, "/add?name=R1")
+    call(8082, "/add?name=Chess")
+    booking = "room=R1&activity=Chess&day=1&hour=9&duration=1"
+    assert call(8080, f"/reserve?{booking}")[0] == 200
+    assert waiter_state(json.loads(call(8080, f"/waitlist?{booking}")[1])["id"])["state"] == waitlist.WAITING
+    if free == "release":
+        status, _ = call(8081, "/release?name=R1&day=1&hour=9&duration=1")
+    else:
+        status, _ = call(8080, free)
+    assert status == 200
+    waiter = waiter_state(1)
+    assert waiter["state"] == waitlist.BOOKED
+    _, body = call(8080, f"/display?id={waiter['reservation']}")
+    assert json.loads(body)["status"] == 200
@@ -0,0 +1,472 @@
+import asyncio
+import json
+import random
+import socket
+import threading
+import time
+from urllib.parse import urlencode
+
+# idle connections kept per backend
+DEFAULT_POOL_SIZE = 8
+# seconds to wait for connect and for each read from a backend
+DEFAULT_TIMEOUT = 5
+# seconds an idle connection is reused for, kept below the servers' keep-alive timeout
+DEFAULT_IDLE_TIMEOUT = 4
+# further connection attempts when a backend cannot be reached, seconds before the first one
+DEFAULT_RETRIES = 2
+RETRY_BACKOFF = 0.05
+# consecutive failures after which a backend is not called for a while, 0 never stops calling
+DEFAULT_BREAKER_FAILURES = 5
+DEFAULT_BREAKER_COOLDOWN = 5
+# answers that count as failures of the backend itself, a 502 or 504 is about a server behind it
+BREAKER_STATUSES = (500, 503)
+RECV_SIZE = 4096
+JSON_HEADERS = (("Accept", "application/json"),)
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # stops calls to a backend that keeps failing, so that callers fail at once instead of each
+    # waiting for a timeout and piling more load on it
+    #
+    # after `failures` failures in a row the circuit opens for `cooldown` seconds; then one trial
+    # call is let through, which closes the circuit if it succeeds and opens it again if not
+
+    def __init__(self, failures=DEFAULT_BREAKER_FAILURES, cooldown=DEFAULT_BREAKER_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.consecutive = 0
+        self.opened = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        # whether a call may be made now
+        with self.lock:
+            if self.opened is None:
+                return True
+            if self.trial or time.monotonic() - self.opened < self.cooldown:
+                return False
+            self.trial = True
+            return True
+
+    def record(self, succeeded):
+        with self.lock:
+            self.trial = False
+            if succeeded:
+                self.consecutive = 0
+                self.opened = None
+                return
+            self.consecutive += 1
+            if self.failures and self.consecutive >= self.failures:
+                self.opened = time.monotonic()
+
+    def state(self):
+        with self.lock:
+            if self.opened is None:
+                return "closed"
+            return "half-open" if self.trial else "open"
+
+
+def retry_delay(attempt):
+    # exponential backoff with jitter, so that callers do not retry in step
+    return RETRY_BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1)
+
+
+def parse_address(address):
+    # parse "host:port" into a (host, port) tuple
+    host, _, port = address.rpartition(":")
+    return host or "localhost", int(port)
+
+
+def parse_addresses(addresses):
+    # parse "host:port,host:port" into a list of (host, port) tuples, "" is an empty list
+    return [parse_address(address) for address in addresses.split(",") if address]
+
+
+def read_response(connection, buffer=b""):
+    # read one framed HTTP response whose first bytes are in buffer, returns (status, headers, body, keep_alive)
+    while b"\r\n\r\n" not in buffer:
+        data = connection.recv(RECV_SIZE)
+        if not data:
+            raise UpstreamError("connection closed before the response headers")
+        buffer += data
+    head, _, body = buffer.partition(b"\r\n\r\n")
+    status, headers, keep_alive = parse_head(head)
+    if "content-length" in headers:
+        length = int(headers["content-length"])
+        while len(body) < length:
+            body += receive(connection)
+        body = body[:length]
+    elif chunked(headers):
+        body = read_chunks(connection, body)
+    else:
+        # without a length the body runs until the server closes the connection
+        while True:
+            data = connection.recv(RECV_SIZE)
+            if not data:
+                break
+            body += data
+        keep_alive = False
+    return status, headers, body.decode(), keep_alive
+
+
+def parse_head(head):
+    # status line and headers of a response, returns (status, headers, keep_alive)
+    lines = head.decode().split("\r\n")
+    parts = lines[0].split(" ", 2)
+    if len(parts) < 2 or not parts[1].isdigit():
+        raise UpstreamError(f"invalid status line {lines[0]!r}")
+    headers = {}
+    for line in lines[1:]:
+        key, _, value = line.partition(":")
+        headers[key.strip().lower()] = value.strip()
+    return int(parts[1]), headers, headers.get("connection", "").lower() != "close"
+
+
+def chunked(headers):
+    return headers.get("transfer-encoding", "").lower() == "chunked"
+
+
+def read_chunks(connection, buffer):
+    # read a chunked body whose start is already in buffer, returns it joined
+    chunks = []
+    while True:
+        while b"\r\n" not in buffer:
+            buffer += receive(connection)
+        size, _, buffer = buffer.partition(b"\r\n")
+        size = int(size.split(b";")[0], 16)
+        # the chunk and the line break after it, the last chunk is empty
+        while len(buffer) < size + 2:
+            buffer += receive(connection)
+        if not size:
+            return b"".join(chunks)
+        chunks.append(buffer[:size])
+        buffer = buffer[size + 2:]
+
+
+def receive(connection):
+    data = connection.recv(RECV_SIZE)
+    if not data:
+        raise UpstreamError("connection closed before the end of the response body")
+    return data
+
+
+def encode_request(address, method, path, body, headers):
+    # request bytes with extra (name, value) headers
+    host, port = address
+    body = body.encode()
+    extra = "".join(f"{name}: {value}\r\n" for name, value in headers)
+    return f"{method} {path} HTTP/1.1\r\nHost: {host}:{port}\r\n{extra}Content-Length: {len(body)}\r\n\r\n".encode() + body
+
+
+def with_query(path, params):
+    # path with percent-encoded query parameters
+    return f"{path}?{urlencode(params)}" if params else path
+
+
+def decode_json(address, body):
+    try:
+        return json.loads(body)
+    except ValueError as error:
+        raise UpstreamError(f"invalid JSON from {address[0]}:{address[1]}: {error}") from error
+
+
+class UpstreamPool:
+    # pool of persistent HTTP/1.1 connections to one backend server
+
+    def __init__(self, address, size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, metrics=None, retries=DEFAULT_RETRIES,
+                 breaker_failures=DEFAULT_BREAKER_FAILURES, breaker_cooldown=DEFAULT_BREAKER_COOLDOWN):
+        self.address = address
+        self.size = size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.retries = retries
+        self.breaker = CircuitBreaker(breaker_failures, breaker_cooldown)
+        # idle connections as (connection, time it was released), most recently used last
+        self.idle = []
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "connections": 0, "reused": 0, "retries": 0, "errors": 0, "rejected": 0}
+        # metrics.Metrics of the server making the calls, if any
+        self.metrics = metrics
+
+    def configure(self, timeout=None, retries=None, breaker_failures=None, breaker_cooldown=None):
+        # change the settings given, e.g. from options_from_args()
+        if timeout is not None:
+            self.timeout = timeout
+        if retries is not None:
+            self.retries = retries
+        if breaker_failures is not None or breaker_cooldown is not None:
+            self.breaker = CircuitBreaker(self.breaker.failures if breaker_failures is None else breaker_failures,
+                                          self.breaker.cooldown if breaker_cooldown is None else breaker_cooldown)
+
+    def admit(self):
+        # raise UpstreamError without calling the backend while its circuit is open
+        if not self.breaker.allow():
+            self.count("rejected")
+            host, port = self.address
+            raise UpstreamError(f"{host}:{port} keeps failing, not calling it for now")
+
+    def failed(self, message, error):
+        self.count("errors")
+        self.breaker.record(False)
+        return UpstreamError(f"{message}: {error}")
+
+    def acquire(self):
+        # return (connection, reused), preferring the most recently used idle connection
+        now = time.monotonic()
+        with self.lock:
+            self.stats["requests"] += 1
+            while self.idle:
+                connection, released = self.idle.pop()
+                if now - released < self.idle_timeout:
+                    self.stats["reused"] += 1
+                    return connection, True
+                connection.close()
+            self.stats["connections"] += 1
+        return socket.create_connection(self.address, timeout=self.timeout), False
+
+    def release(self, connection):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((connection, time.monotonic()))
+                return
+        connection.close()
+
+    def request(self, method, path, body="", headers=()):
+        # send one request and return (status, body)
+        status, _, response_body = self.exchange(method, path, body, headers)
+        return status, response_body
+
+    def exchange(self, method, path, body="", headers=()):
+        # send one request with extra (name, value) headers and return (status, headers, body)
+        if self.metrics is None:
+            return self.send(method, path, body, headers)
+        host, port = self.address
+        start = time.perf_counter()
+        status = None
+        try:
+            status, response_headers, response_body = self.send(method, path, body, headers)
+        finally:
+            self.metrics.observe_upstream(f"{host}:{port}", status, time.perf_counter() - start)
+        return status, response_headers, response_body
+
+    def send(self, method, path, body, headers):
+        self.admit()
+        host, port = self.address
+        data = encode_request(self.address, method, path, body, headers)
+        attempt = 0
+        while True:
+            try:
+                connection, reused = self.acquire()
+            except OSError as error:
+                # nothing was sent, so trying again cannot make the request happen twice
+                if attempt < self.retries:
+                    attempt += 1
+                    self.count("retries")
+                    time.sleep(retry_delay(attempt))
+                    continue
+                raise self.failed(f"cannot connect to {host}:{port}", error) from error
+            try:
+                connection.sendall(data)
+                first = connection.recv(RECV_SIZE)
+                if not first:
+                    raise UpstreamError("connection closed before the response")
+            except (OSError, UpstreamError) as error:
+                connection.close()
+                # the server may have closed an idle connection just before it was reused, which
+                # shows as a failed send or a close before any byte of the answer; in that case try
+                # again on a fresh connection. A request that timed out is not sent again, the
+                # backend may be acting on it
+                if reused and not isinstance(error, socket.timeout):
+                    self.count("retries")
+                    continue
+                raise self.failed(f"request to {host}:{port} failed", error) from error
+            try:
+                status, response_headers, response_body, keep_alive = read_response(connection, first)
+            except (OSError, UpstreamError, ValueError) as error:
+                # part of the answer came, so the backend acted on the request: never sent again
+                connection.close()
+                raise self.failed(f"request to {host}:{port} failed", error) from error
+            if keep_alive:
+                self.release(connection)
+            else:
+                connection.close()
+            self.breaker.record(status not in BREAKER_STATUSES)
+            return status, response_headers, response_body
+
+    def get(self, path, **params):
+        # send a GET request with percent-encoded query parameters
+        return self.request("GET", with_query(path, params))
+
+    def get_json(self, path, **params):
+        # send a GET request asking for JSON, returns (status, decoded body)
+        status, body = self.request("GET", with_query(path, params), headers=JSON_HEADERS)
+        return status, decode_json(self.address, body)
+
+    def post(self, path, body, **params):
+        # send a POST request with a body and percent-encoded query parameters
+        return self.request("POST", with_query(path, params), body)
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def snapshot(self):
+        # return a copy of the statistics together with the number of idle connections
+        with self.lock:
+            return dict(self.stats, idle=len(self.idle), circuit=self.breaker.state())
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection, _ in idle:
+            connection.close()
+
+
+async def read_response_async(reader, first=b""):
+    # read_response() on an asyncio stream, first is the part of the response already read
+    try:
+        head = first + await reader.readuntil(b"\r\n\r\n")
+        status, headers, keep_alive = parse_head(head[:-4])
+        if "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        elif chunked(headers):
+            chunks = []
+            while True:
+                size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                # the chunk and the line break after it, the last chunk is empty
+                chunk = await reader.readexactly(size + 2)
+                if not size:
+                    break
+                chunks.append(chunk[:-2])
+            body = b"".join(chunks)
+        else:
+            body = await reader.read()
+            keep_alive = False
+    except asyncio.IncompleteReadError as error:
+        raise UpstreamError("connection closed before the end of the response") from error
+    except asyncio.LimitOverrunError as error:
+        raise UpstreamError("response line too long") from error
+    return status, headers, body.decode(), keep_alive
+
+
+class AsyncUpstreamPool(UpstreamPool):
+    # UpstreamPool for handlers running on an event loop: requests wait on non-blocking streams,
+    # so one thread can have many of them in flight. The settings, statistics and circuit breaker
+    # are the same; the idle connections are only used from the loop.
+
+    async def acquire(self):
+        # return (reader, writer, reused), preferring the most recently used idle connection
+        now = time.monotonic()
+        self.count("requests")
+        while self.idle:
+            reader, writer, released = self.idle.pop()
+            if now - released < self.idle_timeout:
+                self.count("reused")
+                return reader, writer, True
+            writer.close()
+        self.count("connections")
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(*self.address), self.timeout)
+        return reader, writer, False
+
+    def release(self, reader, writer):
+        if len(self.idle) < self.size:
+            self.idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+
+    async def request(self, method, path, body="", headers=()):
+        # send one request and return (status, body)
+        status, _, response_body = await self.exchange(method, path, body, headers)
+        return status, response_body
+
+    async def exchange(self, method, path, body="", headers=()):
+        # send one request with extra (name, value) headers and return (status, headers, body)
+        if self.metrics is None:
+            return await self.send(method, path, body, headers)
+        host, port = self.address
+        start = time.perf_counter()
+        status = None
+        try:
+            status, response_headers, response_body = await self.send(method, path, body, headers)
+        finally:
+            self.metrics.observe_upstream(f"{host}:{port}", status, time.perf_counter() - start)
+        return status, response_headers, response_body
+
+    async def send(self, method, path, body, headers):
+        self.admit()
+        host, port = self.address
+        data = encode_request(self.address, method, path, body, headers)
+        attempt = 0
+        while True:
+            try:
+                reader, writer, reused = await self.acquire()
+            except (OSError, asyncio.TimeoutError) as error:
+                if attempt < self.retries:
+                    attempt += 1
+                    self.count("retries")
+                    await asyncio.sleep(retry_delay(attempt))
+                    continue
+                raise self.failed(f"cannot connect to {host}:{port}", error) from error
+            try:
+                writer.write(data)
+                # the first byte alone, so that what follows is still framed by the stream
+                first = await asyncio.wait_for(reader.read(1), self.timeout)
+                if not first:
+                    raise UpstreamError("connection closed before the response")
+            except (OSError, UpstreamError, asyncio.TimeoutError) as error:
+                writer.close()
+                # retried only while nothing of the answer came, as in UpstreamPool.send()
+                if reused and not isinstance(error, asyncio.TimeoutError):
+                    self.count("retries")
+                    continue
+                raise self.failed(f"request to {host}:{port} failed", error) from error
+            try:
+                status, response_headers, response_body, keep_alive = await asyncio.wait_for(
+                    read_response_async(reader, first), self.timeout)
+            except (OSError, UpstreamError, ValueError, asyncio.TimeoutError) as error:
+                writer.close()
+                raise self.failed(f"request to {host}:{port} failed", error) from error
+            if keep_alive:
+                self.release(reader, writer)
+            else:
+                writer.close()
+            self.breaker.record(status not in BREAKER_STATUSES)
+            return status, response_headers, response_body
+
+    async def get(self, path, **params):
+        return await self.request("GET", with_query(path, params))
+
+    async def get_json(self, path, **params):
+        status, body = await self.request("GET", with_query(path, params), headers=JSON_HEADERS)
+        return status, decode_json(self.address, body)
+
+    async def post(self, path, body, **params):
+        return await self.request("POST", with_query(path, params), body)
+
+    def close(self):
+        idle, self.idle = self.idle, []
+        for _, writer, _ in idle:
+            writer.close()
+
+
+def add_arguments(parser):
+    parser.add_argument("--upstream-timeout", type=float, default=DEFAULT_TIMEOUT,
+                        help="seconds to wait for another server to accept a connection or answer")
+    parser.add_argument("--upstream-retries", type=int, default=DEFAULT_RETRIES,
+                        help="further attempts to connect to another server that cannot be reached")
+    parser.add_argument("--breaker-failures", type=int, default=DEFAULT_BREAKER_FAILURES,
+                        help="failures in a row after which another server is not called for a while, 0 never")
+    parser.add_argument("--breaker-cooldown", type=float, default=DEFAULT_BREAKER_COOLDOWN,
+                        help="seconds a failing server is not called before it is tried again")
+
+
+def options_from_args(args):
+    # UpstreamPool settings from parsed arguments
+    return {"timeout": args.upstream_timeout, "retries": args.upstream_retries,
+            "breaker_failures": args.breaker_failures, "breaker_cooldown": args.breaker_cooldown}
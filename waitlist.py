@@ -0,0 +1,234 @@
+import heapq
+import threading
+import time
+from collections import OrderedDict
+
+import store
+
+# seconds a waiter stays on the list, and its outcome can be asked for afterwards
+DEFAULT_TTL = 3600
+DEFAULT_MAX_WAITERS = 10000
+# longest a status request waits for the outcome, a client waiting longer asks again
+MAX_WAIT = 30
+# status requests waiting at the same time; each holds a server worker, so further ones are
+# answered at once with the current state rather than using up the pool
+DEFAULT_MAX_POLLERS = 4
+
+WAITING = "waiting"
+BOOKING = "booking"
+BOOKED = "booked"
+FAILED = "failed"
+CANCELLED = "cancelled"
+EXPIRED = "expired"
+
+
+class Waiter:
+    # a reservation that could not be made yet, booked when its slots are freed
+
+    __slots__ = ("id", "room", "activity", "day", "hour", "duration", "priority", "slots", "expires", "state",
+                 "reservation_id")
+
+    def __init__(self, waiter_id, room, activity, day, hour, duration, priority, slots, expires):
+        self.id = waiter_id
+        self.room = room
+        self.activity = activity
+        self.day = day
+        self.hour = hour
+        self.duration = duration
+        self.priority = priority
+        # (day index, first slot, number of slots)
+        self.slots = slots
+        self.expires = expires
+        self.state = WAITING
+        self.reservation_id = None
+
+    def snapshot(self):
+        return {"id": self.id, "state": self.state, "reservation": self.reservation_id, "room": self.room,
+                "activity": self.activity, "day": self.day, "hour": self.hour, "duration": self.duration,
+                "priority": self.priority}
+
+
+class Waitlist:
+    # waiters for booked slots, in a priority queue per slot of every room
+    #
+    # promote() is called after slots of a room were freed and tries the waiters wanting any of
+    # them, highest priority first and in the order they joined for equal priorities, with
+    # book(waiter) -> (status, reservation id). A waiter whose slots are still partly taken (403)
+    # keeps waiting, one whose room or time is no longer valid fails. Promotions of one room and
+    # day are serialized, so a waiter is never booked twice. Waiters that are done leave the queues
+    # when they reach the top of one, and every waiter is forgotten ttl seconds after joining.
+
+    def __init__(self, layout, book, ttl=DEFAULT_TTL, max_waiters=DEFAULT_MAX_WAITERS,
+                 max_pollers=DEFAULT_MAX_POLLERS):
+        self.layout = layout
+        self.book = book
+        self.ttl = ttl
+        self.max_waiters = max_waiters
+        self.max_pollers = max_pollers
+        # wait() calls blocked right now
+        self.pollers = 0
+        # id -> Waiter, oldest first, which is also the order they expire in
+        self.waiters = OrderedDict()
+        # (room, day index, slot) -> heap of (-priority, id)
+        self.queues = {}
+        self.ids = store.IdAllocator()
+        self.stripes = store.LockStripes()
+        # guards the dicts and the waiter states, and is waited on for outcomes
+        self.changed = threading.Condition()
+
+    def __len__(self):
+        return len(self.waiters)
+
+    def add(self, room, activity, day, hour, duration, priority=0):
+        # put a reservation on the waitlist and book it right away if its slots are free by now,
+        # returns the Waiter, None if the time is invalid or the list is full
+        day_index = self.layout.day_index(day)
+        span = self.layout.span(hour, duration)
+        if day_index is None or span is None:
+            return None
+        with self.changed:
+            self.expire()
+            if len(self.waiters) >= self.max_waiters:
+                return None
+            waiter = Waiter(self.ids.allocate(), room, activity, day, hour, duration, priority,
+                            (day_index, *span), time.monotonic() + self.ttl)
+            self.waiters[waiter.id] = waiter
+            for slot in range(span[0], span[0] + span[1]):
+                heapq.heappush(self.queues.setdefault((room, day_index, slot), []), (-priority, waiter.id))
+        # the slots may have been freed between the failed reservation and joining the list
+        self.promote(room, day_index, *span)
+        return waiter
+
+    def get(self, waiter_id):
+        with self.changed:
+            self.expire()
+            return self.waiters.get(waiter_id)
+
+    def wait(self, waiter_id, timeout):
+        # the waiter once it was booked, failed or left the list, or when timeout seconds passed,
+        # None if there is no such waiter; with max_pollers calls waiting already it does not wait
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            self.expire()
+            waiter = self.waiters.get(waiter_id)
+            if waiter is None or waiter.state not in (WAITING, BOOKING) or self.pollers >= self.max_pollers:
+                return waiter
+            self.pollers += 1
+            try:
+                while waiter.state in (WAITING, BOOKING):
+                    now = time.monotonic()
+                    if now >= deadline:
+                        break
+                    # wake up when the waiter expires as well, nothing else would notice
+                    self.changed.wait(min(deadline, max(waiter.expires, now + 0.01)) - now)
+                    self.expire()
+            finally:
+                self.pollers -= 1
+            return waiter
+
+    def cancel(self, waiter_id):
+        # take a waiter off the list, returns it in its final state, None if there is no such waiter
+        with self.changed:
+            waiter = self.waiters.get(waiter_id)
+            if waiter is not None and waiter.state == WAITING:
+                waiter.state = CANCELLED
+                self.changed.notify_all()
+            return waiter
+
+    def promote(self, room, day_index, first, count, book=None):
+        # book the waiters that want any of the slots first..first+count-1 of a room on a day,
+        # with book instead of self.book if it is given
+        book = book or self.book
+        with self.stripes.lock((room, day_index)):
+            for waiter in self.candidates(room, day_index, first, count):
+                with self.changed:
+                    # cancelled or expired since the candidates were picked
+                    if waiter.state != WAITING:
+                        continue
+                    waiter.state = BOOKING
+                status = None
+                try:
+                    status, reservation_id = book(waiter)
+                finally:
+                    with self.changed:
+                        if status == 200:
+                            waiter.state, waiter.reservation_id = BOOKED, reservation_id
+                        elif status in (400, 404):
+                            waiter.state = FAILED
+                        else:
+                            # kept for the next release, also when book() raised
+                            waiter.state = WAITING
+                        self.changed.notify_all()
+                if status >= 500:
+                    # the room server is not answering, the next release tries again
+                    break
+
+    def fail_room(self, room):
+        # the room is gone, none of its waiters can be booked any more
+        with self.changed:
+            for waiter in self.waiters.values():
+                if waiter.room == room and waiter.state == WAITING:
+                    waiter.state = FAILED
+            self.changed.notify_all()
+
+    def candidates(self, room, day_index, first, count):
+        # the waiting waiters wanting one of the slots, best first
+        found = {}
+        with self.changed:
+            self.expire()
+            for slot in range(first, first + count):
+                queue = self.queues.get((room, day_index, slot))
+                if queue is None:
+                    continue
+                while queue and self.state_of(queue[0][1]) not in (WAITING, BOOKING):
+                    heapq.heappop(queue)
+                if not queue:
+                    del self.queues[(room, day_index, slot)]
+                    continue
+                for priority, waiter_id in queue:
+                    if self.state_of(waiter_id) == WAITING:
+                        found[waiter_id] = priority
+            return [self.waiters[waiter_id] for waiter_id in sorted(found, key=lambda key: (found[key], key))]
+
+    def state_of(self, waiter_id):
+        waiter = self.waiters.get(waiter_id)
+        return waiter.state if waiter else None
+
+    def expire(self):
+        # needs self.changed, forget the waiters whose time is up, oldest first
+        # a waiter being booked right now is left for a later call
+        now = time.monotonic()
+        expired = []
+        for waiter in self.waiters.values():
+            if waiter.expires > now:
+                break
+            if waiter.state != BOOKING:
+                expired.append(waiter)
+        for waiter in expired:
+            del self.waiters[waiter.id]
+            if waiter.state == WAITING:
+                waiter.state = EXPIRED
+                self.changed.notify_all()
+            self.unqueue(waiter)
+
+    def unqueue(self, waiter):
+        # needs self.changed, drop the entries of a forgotten waiter from the queues of its slots
+        day_index, first, count = waiter.slots
+        for slot in range(first, first + count):
+            key = (waiter.room, day_index, slot)
+            queue = self.queues.get(key)
+            if queue is None:
+                continue
+            queue[:] = [entry for entry in queue if entry[1] != waiter.id]
+            if queue:
+                heapq.heapify(queue)
+            else:
+                del self.queues[key]
+
+    def snapshot(self):
+        with self.changed:
+            self.expire()
+            states = {}
+            for waiter in self.waiters.values():
+                states[waiter.state] = states.get(waiter.state, 0) + 1
+            return dict(states, size=len(self.waiters), pollers=self.pollers)